@@ -1,16 +1,103 @@
 import argparse
 import os
 import re
+import time
 
 import numpy as np
-from flask import Flask, jsonify, request
+from flask import Flask, g, jsonify, request, Response
 from flask import render_template, send_from_directory
 
 # import model specific functions and variables
-from model import model_train, model_load, model_predict
+from batcher import MicroBatcher
+from cache import ResponseCache
+from logger import flush_logs, query_predict_log
+import metrics
+from model import MODEL_DIR, model_predict, model_predict_batch, query_date, SEARCH_STRATEGIES
+from jobs import TrainingJobs
+from registry import ModelRegistry
 
 app = Flask(__name__)
 
+# models and features are loaded once and kept in memory between requests
+production_data_dir = os.path.join("data", "cs-production")
+# set AAVAIL_PRECOMPUTE=1 (or run with --precompute) to serve predictions from a forecast table
+# countries are loaded on their first query, AAVAIL_PRELOAD=all,united_kingdom loads some at startup
+registry = ModelRegistry(data_dir=production_data_dir,
+                         precompute=os.environ.get("AAVAIL_PRECOMPUTE", "0") == "1",
+                         preload=[c for c in os.environ.get("AAVAIL_PRELOAD", "").split(",") if c])
+
+# concurrent /predict queries for the same model are predicted together, the first
+# waits up to AAVAIL_BATCH_WINDOW_MS for AAVAIL_BATCH_MAX_ROWS queries (a window of 0 disables it)
+batch_window = float(os.environ.get("AAVAIL_BATCH_WINDOW_MS", "2")) / 1000.0
+batcher = MicroBatcher(window=batch_window,
+                       max_rows=int(os.environ.get("AAVAIL_BATCH_MAX_ROWS", "64")))
+
+# the last AAVAIL_CACHE_SIZE /predict responses, evicted when a model or data file changes
+response_cache = ResponseCache(max_size=int(os.environ.get("AAVAIL_CACHE_SIZE", "4096")))
+
+
+def hold_models(job):
+    """
+    keep serving the current models while a production job rewrites them
+    """
+
+    if not job.params.get('test'):
+        registry.hold()
+
+
+def swap_models(job):
+    """
+    swap the retrained models in at once when a production job ends
+    """
+
+    if not job.params.get('test'):
+        try:
+            registry.release(reload=job.status == 'done')
+        except Exception as e:
+            print("ERROR: could not reload the models: {}".format(e))
+
+
+# training runs in a background thread, one job at a time across the server processes
+training_jobs = TrainingJobs(on_start=hold_models, on_finish=swap_models,
+                             state_dir=os.path.join(MODEL_DIR, "jobs"),
+                             lock_file=os.path.join(MODEL_DIR, ".training.lock"))
+
+
+def _cache_counters():
+    stats = response_cache.stats()
+    return [('aavail_response_cache_total', {'event': event}, stats[event])
+            for event in ['hits', 'misses', 'not_modified', 'evictions']]
+
+
+def _batcher_counters():
+    return [('aavail_batches_total', {}, batcher.batches),
+            ('aavail_batched_queries_total', {}, batcher.rows)]
+
+
+metrics.METRICS.collect(_cache_counters)
+metrics.METRICS.collect(_batcher_counters)
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    """
+    latency and status of every request, see /metrics
+    """
+
+    start = g.get('request_start')
+    if start is not None:
+        # the route pattern keeps one series per endpoint ('/train/<job_id>', not every job id)
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.METRICS.observe('aavail_request_seconds', time.perf_counter() - start, endpoint=endpoint)
+        metrics.METRICS.inc('aavail_requests_total', endpoint=endpoint, status=response.status_code)
+        metrics.share()
+    return response
+
 
 @app.route("/")
 def landing():
@@ -81,21 +168,44 @@ def predict():
     #    print("ERROR API (predict): only dict data types have been implemented")
     #    return jsonify([])
 
-    # load model
-    #_, model = model_load()
-    production_data_dir = os.path.join("data", "cs-production")
-    all_data, all_models = model_load(data_dir=production_data_dir)
+    # look up the model and its features (only reloaded when the files change)
+    registry.refresh()
 
     country = query['country']
 
-    if not all_models:
+    if not registry.countries():
         print("ERROR: model is not available")
         return jsonify([])
 
-    if country not in all_models.keys():
+    # repeated queries are answered from the cache, or with 304 when the client has the answer
+    # (only answers that are cached, the others go through the checks below)
+    version = registry.version
+    cache_key = _cache_key(query, test)
+    etag = None
+    if cache_key is not None and response_cache.max_size > 0:
+        etag = response_cache.etag(cache_key, version)
+        cached = response_cache.get(cache_key, version)
+        if cached is not None:
+            if etag in request.if_none_match:
+                response_cache.revalidated()
+                return _cached_response(Response(status=304), etag)
+            return _cached_response(jsonify(cached), etag)
+
+    entry = registry.get(country)
+    if entry is None or entry['data'] is None:
         _result = {'ErrorMessage': "ERROR: model for country '{}' could not be found".format(country)}
     else:
-        _result = model_predict(query, data=all_data[country], model=all_models[country], test=test)
+        # a bad query gets the same ErrorMessage with or without micro-batching
+        try:
+            if batch_window > 0:
+                _result = batcher.predict(query, entry['data'], entry['model'], test=test,
+                                          version=entry['version'])
+            else:
+                _result = model_predict(query, data=entry['data'], model=entry['model'], test=test,
+                                        version=entry['version'])
+        except Exception as e:
+            print("ERROR: API (predict): {}".format(e))
+            _result = {'ErrorMessage': str(e)}
 
     result = {}
 
@@ -107,16 +217,123 @@ def predict():
             result[key] = item
 
     print('predict end_point result: ', result)
-    return jsonify(result)
+    if etag is None or 'y_pred' not in result:
+        return jsonify(result)
 
+    response_cache.put(cache_key, version, result)
+    return _cached_response(jsonify(result), etag)
+
+
+def _cache_key(query, test):
+    """
+    (country, date, test) of a predict query, None when the date is not valid
+    """
+
+    try:
+        target = query_date(query['year'], query['month'], query['day'])
+    except Exception:
+        return None
+    return (query['country'], target.isoformat(), test)
+
+
+def _cached_response(response, etag):
+    # clients keep the response and revalidate it with If-None-Match
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/predict/cache', methods=['GET'])
+def predict_cache():
+    """
+    hit, miss, 304 and eviction counters of the /predict response cache
+    """
+
+    return jsonify(response_cache.stats())
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    """
+    latency histograms and counters in the Prometheus text format
+    """
+
+    return Response(metrics.exposition(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/predict/batch', methods=['POST'])
+def predict_batch():
+    """
+    predict many dates and countries in one call
+
+    the request holds either a list of queries
+    {'queries': [{'country':..,'year':..,'month':..,'day':..}, ...]}
+    or a date range {'country':.., 'start':'YYYY-MM-DD', 'end':'YYYY-MM-DD'}
+    """
+
+    # input checking
+    if not request.json:
+        print("ERROR: API (predict/batch): did not receive request data")
+        return jsonify([])
+
+    if 'queries' in request.json:
+        queries = request.json['queries']
+        if not isinstance(queries, list):
+            print("ERROR API (predict/batch): 'queries' must be a list")
+            return jsonify([])
+        for query in queries:
+            if not isinstance(query, dict) or not all(key in query for key in ['country', 'year', 'month', 'day']):
+                print("ERROR API (predict/batch): every query needs 'country', 'year', 'month' and 'day'")
+                return jsonify([])
+    elif all(key in request.json for key in ['country', 'start', 'end']):
+        queries = {'country': request.json['country'],
+                   'start': str(request.json['start']),
+                   'end': str(request.json['end'])}
+    else:
+        print("ERROR API (predict/batch): received request, but no 'queries' or date range found within")
+        return jsonify([])
+
+    # set the test flag
+    test = False
+    if 'mode' in request.json and request.json['mode'] == 'test':
+        test = True
+
+    all_data, all_models, versions = registry.snapshot()
+    if not all_models:
+        print("ERROR: model is not available")
+        return jsonify([])
+
+    try:
+        _results = model_predict_batch(queries, all_data=all_data, all_models=all_models, test=test,
+                                       versions=versions)
+    except Exception as e:
+        print("ERROR API (predict/batch): {}".format(e))
+        return jsonify([])
+
+    # convert numpy objects to ensure they are serializable
+    results = []
+    for _result in _results:
+        result = {}
+        for key, item in _result.items():
+            if isinstance(item, np.ndarray):
+                result[key] = item.tolist()
+            else:
+                result[key] = item
+        results.append(result)
+
+    print('predict/batch end_point results: ', len(results))
+    return jsonify(results)
 
 @app.route('/train', methods=['GET', 'POST'])
 def train():
     """
-    basic predict function for the API
+    basic train function for the API
 
     the 'mode' flag provides the ability to toggle between a test version and a 
     production version of training
+
+    training runs as a background job, the response holds the job id to poll
+    at /train/<job_id> (only one job runs at a time)
     """
 
     # check for request data
@@ -130,12 +347,100 @@ def train():
         print('... test mode = true')
         test = True
 
-    print("... training model")
+    # hyperparameter search: 'grid' (default), 'halving', 'random' or 'warm'
+    search = 'grid'
+    if 'search' in request.json:
+        search = str(request.json['search'])
+    if search not in SEARCH_STRATEGIES:
+        print("ERROR: API (train): unknown search '{}'".format(search))
+        return jsonify(False)
+
+    # seconds the 'random' search may spend
+    time_budget = 60
+    if 'time_budget' in request.json:
+        try:
+            time_budget = float(request.json['time_budget'])
+        except (TypeError, ValueError):
+            time_budget = None
+        if time_budget is None or not np.isfinite(time_budget) or time_budget <= 0:
+            print("ERROR: API (train): invalid time_budget '{}'".format(request.json['time_budget']))
+            return jsonify(False)
+
+    # keep a compressed copy of every model in models/archive
+    archive = bool(request.json.get('archive', False))
+
+    print("... submitting training job")
     data_dir = os.path.join("data", "cs-train")
-    model = model_train(data_dir, test=test)
-    print("... training complete")
+    job = training_jobs.submit(data_dir=data_dir, test=test, search=search, time_budget=time_budget,
+                               archive=archive)
+    if job is None:
+        print("ERROR: API (train): a training job is already running")
+        return jsonify({'ErrorMessage': "ERROR: a training job is already running",
+                        'job_id': training_jobs.running_id()})
 
-    return jsonify(True)
+    return jsonify(job.to_dict())
+
+
+@app.route('/train/<job_id>', methods=['GET'])
+def train_status(job_id):
+    """
+    status, per-country progress and elapsed time of a training job
+    """
+
+    job = training_jobs.get(job_id)
+    if job is None:
+        print("ERROR: API (train): unknown job {}".format(job_id))
+        return jsonify({'ErrorMessage': "ERROR: training job {} could not be found".format(job_id)})
+
+    return jsonify(job.to_dict())
+
+
+@app.route('/train/<job_id>/cancel', methods=['POST'])
+def train_cancel(job_id):
+    """
+    cancel a training job
+    """
+
+    job = training_jobs.cancel(job_id)
+    if job is None:
+        print("ERROR: API (train): unknown job {}".format(job_id))
+        return jsonify({'ErrorMessage': "ERROR: training job {} could not be found".format(job_id)})
+
+    return jsonify(job.to_dict())
+
+
+@app.route('/logs/query', methods=['GET', 'POST'])
+def logs_query():
+    """
+    API endpoint to aggregate the logged predictions
+    url: localhost:8080/logs/query?country=all&start=2021-01-01&end=2021-12-31&model_version=0_1_20210101120000
+
+    returns the count, the mean y_pred and runtime percentiles (ms), overall and per country,
+    and the model store versions that made the predictions
+    """
+
+    params = dict(request.args)
+    if request.is_json and request.json:
+        params.update(request.json)
+
+    country = params.get('country')
+    if isinstance(country, str) and "," in country:
+        country = country.split(",")
+
+    # write the queued rows before the records are read
+    flush_logs()
+
+    try:
+        result = query_predict_log(country=country,
+                                   start=params.get('start'),
+                                   end=params.get('end'),
+                                   model_version=params.get('model_version'),
+                                   test=params.get('mode') == 'test')
+    except Exception as e:
+        print("ERROR: API (logs query): {}".format(e))
+        return jsonify({'ErrorMessage': "ERROR: logs could not be queried: {}".format(e)})
+
+    return jsonify(result)
 
 
 @app.route('/logs/<filename>', methods=['GET'])
@@ -149,6 +454,9 @@ def logs(filename):
         print("ERROR: API (log): file requested was not a log file: {}".format(filename))
         return jsonify([])
 
+    # write the queued rows before the file is read
+    flush_logs()
+
     log_dir = os.path.join(".", "logs")
     if not os.path.isdir(log_dir):
         print("ERROR: API (log): cannot find log dir")
@@ -167,8 +475,14 @@ if __name__ == '__main__':
     # parse arguments for debug mode
     ap = argparse.ArgumentParser()
     ap.add_argument("-d", "--debug", action="store_true", help="debug flask")
+    ap.add_argument("-p", "--precompute", action="store_true", help="predict every date at startup")
     args = vars(ap.parse_args())
 
+    # load the models and features once at startup
+    if args["precompute"]:
+        registry.precompute = True
+    registry.load()
+
     if args["debug"]:
         app.run(debug=True, port=8080)
     else:
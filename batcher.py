@@ -0,0 +1,97 @@
+"""
+micro-batching of the concurrent /predict queries
+"""
+
+import threading
+
+from model import model_predict_batch
+
+
+class _Batch:
+
+    def __init__(self):
+        self.queries = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    collects the queries that arrive for the same model within 'window'
+    seconds (or until 'max_rows' are waiting) and predicts them in one
+    model_predict_batch call
+
+    the first query of a batch waits for the others and runs the batch, the
+    later ones wait for its results; a query that arrives while no other
+    query is in flight runs at once
+    """
+
+    def __init__(self, window=0.002, max_rows=64):
+        self.window = window
+        self.max_rows = max_rows
+        self.batches = 0
+        self.rows = 0
+        self._open = {}
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def predict(self, query, data, model, test=False, version=None):
+        """
+        predict one {'country','year','month','day'} query like model_predict
+        ('version' is the model store version of model, logged with the prediction)
+
+        returns {'y_pred','y_proba'} or {'ErrorMessage'}
+        """
+
+        country = str(query['country'])
+        key = (country, id(model), version, test)
+        with self._lock:
+            self._in_flight += 1
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader:
+                batch = _Batch()
+                self._open[key] = batch
+            index = len(batch.queries)
+            batch.queries.append(query)
+            if len(batch.queries) >= self.max_rows:
+                del self._open[key]
+                batch.full.set()
+            alone = self._in_flight == 1
+
+        try:
+            if leader:
+                if not alone and self.window > 0:
+                    batch.full.wait(self.window)
+                with self._lock:
+                    if self._open.get(key) is batch:
+                        del self._open[key]
+                self._run(batch, country, data, model, test, version)
+            else:
+                batch.done.wait()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+        if batch.error is not None:
+            raise batch.error
+        result = batch.results[index]
+        if 'ErrorMessage' in result:
+            return {'ErrorMessage': result['ErrorMessage']}
+        return {'y_pred': result['y_pred'], 'y_proba': result['y_proba']}
+
+    def _run(self, batch, country, data, model, test, version):
+        versions = None if version is None else {country: version}
+        try:
+            batch.results = model_predict_batch(batch.queries, all_data={country: data},
+                                                all_models={country: model}, test=test,
+                                                versions=versions)
+            with self._lock:
+                self.batches += 1
+                self.rows += len(batch.queries)
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
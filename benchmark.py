@@ -0,0 +1,342 @@
+"""
+reproducible benchmark of the ingestion -> features -> train -> predict pipeline
+
+    ~$ python benchmark.py --months 6 --countries 5 --rows-per-day 100 --output before.json
+    ~$ python benchmark.py --months 6 --countries 5 --rows-per-day 100 --output after.json
+    ~$ python benchmark.py --compare before.json after.json
+
+the invoices are generated from a seed in a scratch directory, so two runs
+with the same parameters time the same work; the models and logs written by
+the benchmark stay in that directory
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import sklearn
+
+from data_ingestion import DataIngestion, DataProcessing
+from logger import flush_logs
+from model import _model_train, model_load, model_predict
+
+BENCHMARK_FORMAT = 1
+COUNTRIES = ['United Kingdom', 'EIRE', 'Germany', 'France', 'Netherlands', 'Norway',
+             'Spain', 'Belgium', 'Portugal', 'Singapore', 'Hong Kong', 'Greece']
+INVOICE_LINES = 25
+
+
+def generate_invoices(data_dir, months=6, countries=5, rows_per_day=100, start="2018-01", seed=42):
+    """
+    write 'invoices-<year>-<month>.json' files in the get_data schema
+
+    every country gets rows_per_day invoice lines on every day of the months;
+    the first country (United Kingdom) has the highest prices so the top ten
+    countries are always the same, returns the number of rows written
+    """
+
+    if countries > len(COUNTRIES):
+        raise Exception("at most {} countries can be generated".format(len(COUNTRIES)))
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+
+    rng = np.random.RandomState(seed)
+    names = np.array(COUNTRIES[:countries])
+    price_scale = np.linspace(3.0, 1.0, countries)
+    streams = np.array([str(20000 + k) for k in range(2000)] + [str(20000 + k) + "A" for k in range(200)])
+
+    n_rows, next_invoice = 0, 480000
+    first = np.datetime64(start, 'M')
+    for month in first + np.arange(months):
+        days = np.arange(month.astype('datetime64[D]'), (month + 1).astype('datetime64[D]'))
+        n = days.size * countries * rows_per_day
+        day = np.repeat(days, countries * rows_per_day)
+        country = np.tile(np.repeat(np.arange(countries), rows_per_day), days.size)
+
+        # consecutive lines of a country and day share an invoice, a few are cancellations
+        line = np.arange(n) // INVOICE_LINES
+        invoice = (next_invoice + line).astype(str).astype(object)
+        cancelled = rng.rand(line[-1] + 1) < 0.02
+        invoice[cancelled[line]] = "C" + invoice[cancelled[line]]
+        next_invoice += line[-1] + 1
+
+        customer_id = rng.randint(12000, 18000, size=line[-1] + 1).astype(float)[line]
+        customer_id[rng.rand(n) < 0.3] = np.nan
+
+        ymd = day.astype(str)
+        df = pd.DataFrame({'country': names[country],
+                           'customer_id': customer_id,
+                           'invoice': invoice,
+                           'price': np.round(rng.lognormal(0.5, 0.8, size=n) * price_scale[country], 2),
+                           'stream_id': streams[rng.randint(0, streams.size, size=n)],
+                           'times_viewed': rng.randint(0, 25, size=n),
+                           'year': [d[:4] for d in ymd],
+                           'month': [d[5:7] for d in ymd],
+                           'day': [d[8:10] for d in ymd]})
+        file_name = os.path.join(data_dir, "invoices-{}.json".format(str(month)))
+        df.to_json(file_name, orient='records')
+        n_rows += n
+
+    return n_rows
+
+
+def _summary(runs):
+    runs = np.array(runs)
+    return {'runs': runs.tolist(),
+            'mean': float(runs.mean()),
+            'median': float(np.median(runs)),
+            'min': float(runs.min()),
+            'p95': float(np.percentile(runs, 95))}
+
+
+def measure(function, repeat=3, setup=None):
+    """
+    time repeat calls of function (seconds)
+
+    a first traced call warms the caches up and gives the peak memory (MB)
+    allocated while it ran, it is not part of the timings; 'setup' is called
+    untimed before every call
+    """
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        time_start = time.perf_counter()
+        function()
+        runs.append(time.perf_counter() - time_start)
+
+    result = _summary(runs)
+    result['peak_mb'] = peak / 1e6
+    return result
+
+
+def _queries(country, dates, n_queries, seed):
+    rng = np.random.RandomState(seed)
+    queries = []
+    for d in dates[rng.randint(0, len(dates), size=n_queries)]:
+        year, month, day = str(d).split("-")
+        queries.append({'country': country, 'year': year, 'month': month, 'day': day})
+    return queries
+
+
+def predict_latency(queries, data, model, threads=1):
+    """
+    latency of every model_predict call and the throughput (queries/s) with 'threads' callers
+    """
+
+    latencies = [None] * len(queries)
+
+    def call(i):
+        time_start = time.perf_counter()
+        model_predict(queries[i], data=data, model=model, test=True)
+        latencies[i] = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(call, range(len(queries))))
+    else:
+        for i in range(len(queries)):
+            call(i)
+    elapsed = time.perf_counter() - time_start
+    flush_logs()
+
+    result = _summary(latencies)
+    result['p99'] = float(np.percentile(latencies, 99))
+    result['threads'] = threads
+    result['queries_per_second'] = len(queries) / elapsed
+    return result
+
+
+def run(work_dir, months=6, countries=5, rows_per_day=100, repeat=3, n_queries=200, threads=4,
+        search='grid', n_jobs=-1, seed=42):
+    """
+    generate the invoices in work_dir and time every stage of the pipeline
+    """
+
+    params = {'months': months, 'countries': countries, 'rows_per_day': rows_per_day, 'repeat': repeat,
+              'n_queries': n_queries, 'threads': threads, 'search': search, 'n_jobs': n_jobs, 'seed': seed}
+    data_dir = os.path.join(work_dir, "data")
+    ts_data_dir = os.path.join(data_dir, "ts-data")
+    print("... generating {} months x {} countries x {} rows/day".format(months, countries, rows_per_day))
+    n_rows = generate_invoices(data_dir, months=months, countries=countries, rows_per_day=rows_per_day,
+                               seed=seed)
+
+    # the models and logs of the benchmark are written under work_dir
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        for folder in ["models", "logs"]:
+            if not os.path.isdir(folder):
+                os.mkdir(folder)
+
+        di = DataIngestion()
+        stages = {}
+
+        def stage(name, function, **kwargs):
+            print("... timing {}".format(name))
+            stages[name] = measure(function, **kwargs)
+
+        def clear_ts_data():
+            if os.path.isdir(ts_data_dir):
+                shutil.rmtree(ts_data_dir)
+
+        stage('get_data', lambda: di.get_data(data_dir), repeat=repeat)
+        df = di.get_data(data_dir)
+        stage('convert_to_ts', lambda: di.convert_to_ts_all(df, countries=COUNTRIES[:countries]), repeat=repeat)
+        del df
+        stage('fetch_ts', lambda: di.fetch_ts(data_dir), repeat=repeat, setup=clear_ts_data)
+        stage('fetch_ts_cached', lambda: di.fetch_ts(data_dir), repeat=repeat)
+
+        ts_data = di.fetch_ts(data_dir)
+        stage('engineer_features', lambda: DataProcessing.engineer_features(ts_data['all']), repeat=repeat)
+
+        # the test flag subsets the rows with np.random, seeded for every fit
+        def train():
+            np.random.seed(seed)
+            _model_train(ts_data['all'], 'all', test=True, n_jobs=n_jobs, search=search)
+        stage('model_train', train, repeat=1)
+
+        def load():
+            all_data, all_models = model_load(prefix='test', data_dir=data_dir)
+            return all_data['all'], all_models['all']
+        stage('model_load', load, repeat=repeat)
+
+        data, model = load()
+        queries = _queries('all', data['dates'], n_queries, seed)
+        print("... timing model_predict")
+        predict_latency(queries[:10], data, model)
+        stages['model_predict'] = predict_latency(queries, data, model)
+        print("... timing model_predict with {} threads".format(threads))
+        stages['model_predict_concurrent'] = predict_latency(queries, data, model, threads=threads)
+    finally:
+        os.chdir(cwd)
+
+    # ru_maxrss is in kB on linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+    return {'format': BENCHMARK_FORMAT,
+            'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'params': params,
+            'n_rows': n_rows,
+            'environment': {'python': platform.python_version(),
+                            'platform': platform.platform(),
+                            'cpu_count': os.cpu_count(),
+                            'numpy': np.__version__,
+                            'pandas': pd.__version__,
+                            'sklearn': sklearn.__version__},
+            'stages': stages,
+            'max_rss_mb': max_rss}
+
+
+def compare(baseline, current, threshold=0.1, min_delta=0.0005):
+    """
+    compare the median time and peak memory of every stage of two runs
+
+    a stage regresses when it got slower (or bigger) by more than 'threshold'
+    (relative) and by more than 'min_delta' seconds, returns one row per
+    (stage, metric) with 'status' set to 'regression', 'improvement' or 'ok'
+    """
+
+    rows = []
+    for name in sorted(set(baseline['stages']) & set(current['stages'])):
+        before, after = baseline['stages'][name], current['stages'][name]
+        for metric, floor in [('median', min_delta), ('peak_mb', 0.0)]:
+            if metric not in before or metric not in after:
+                continue
+            change = (after[metric] - before[metric]) / before[metric] if before[metric] > 0 else 0.0
+            status = 'ok'
+            if abs(after[metric] - before[metric]) > floor:
+                if change > threshold:
+                    status = 'regression'
+                elif change < -threshold:
+                    status = 'improvement'
+            rows.append({'stage': name, 'metric': metric, 'before': before[metric], 'after': after[metric],
+                         'change': change, 'status': status})
+    return rows
+
+
+def print_results(results):
+    print("BENCHMARK ({} rows, {})".format(results['n_rows'],
+                                          ", ".join("{}={}".format(k, v) for k, v in sorted(results['params'].items()))))
+    for name, stage in results['stages'].items():
+        line = "{:<26} median {:10.2f} ms   p95 {:10.2f} ms".format(name, stage['median'] * 1000, stage['p95'] * 1000)
+        if 'peak_mb' in stage:
+            line += "   peak {:8.1f} MB".format(stage['peak_mb'])
+        if 'queries_per_second' in stage:
+            line += "   {:8.0f} queries/s".format(stage['queries_per_second'])
+        print(line)
+    print("max rss {:.1f} MB".format(results['max_rss_mb']))
+
+
+def print_comparison(rows):
+    for row in rows:
+        unit, scale = ('ms', 1000) if row['metric'] == 'median' else ('MB', 1)
+        print("{:<26} {:<8} {:10.2f} -> {:10.2f} {}  {:+7.1%}  {}".format(
+            row['stage'], row['metric'], row['before'] * scale, row['after'] * scale, unit, row['change'],
+            row['status'].upper() if row['status'] != 'ok' else ""))
+
+
+if __name__ == "__main__":
+
+    ap = argparse.ArgumentParser(description="benchmark the ingestion, training and prediction")
+    ap.add_argument("--months", type=int, default=6, help="months of invoices")
+    ap.add_argument("--countries", type=int, default=5, help="countries (at most {})".format(len(COUNTRIES)))
+    ap.add_argument("--rows-per-day", type=int, default=100, help="invoice lines per country and day")
+    ap.add_argument("--repeat", type=int, default=3, help="timed runs of each stage")
+    ap.add_argument("--queries", type=int, default=200, help="model_predict calls")
+    ap.add_argument("--threads", type=int, default=4, help="callers of the concurrent model_predict")
+    ap.add_argument("--search", default='grid', help="search strategy of the training")
+    ap.add_argument("--n-jobs", type=int, default=-1, help="training workers")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--work-dir", help="keep the generated data and models here")
+    ap.add_argument("-o", "--output", help="write the results to this json file")
+    ap.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                    help="compare two result files, exits with 1 on a regression")
+    ap.add_argument("--threshold", type=float, default=0.1, help="relative change flagged by --compare")
+    args = ap.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+        if baseline['params'] != current['params']:
+            print("WARNING: the runs used different parameters")
+        rows = compare(baseline, current, threshold=args.threshold)
+        print_comparison(rows)
+        sys.exit(1 if any(row['status'] == 'regression' for row in rows) else 0)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="aavail-benchmark-")
+    try:
+        results = run(os.path.abspath(work_dir), months=args.months, countries=args.countries,
+                      rows_per_day=args.rows_per_day, repeat=args.repeat, n_queries=args.queries,
+                      threads=args.threads, search=args.search, n_jobs=args.n_jobs, seed=args.seed)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("... results written to {}".format(args.output))
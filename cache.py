@@ -0,0 +1,81 @@
+"""
+bounded LRU cache of the /predict responses
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    the 'max_size' most recently used (query key -> response) entries
+
+    every entry belongs to a version of the models and data (see
+    ModelRegistry.version), all entries are evicted when another version is
+    seen; 'max_size' 0 disables the cache
+    """
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.not_modified = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def etag(key, version):
+        """
+        entity tag of the response to a query key, it only changes with the version
+        """
+
+        text = "{}|{}".format(version, "|".join(str(k) for k in key))
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def _check_version(self, version):
+        if version != self.version:
+            self.evictions += len(self._entries)
+            self._entries.clear()
+            self.version = version
+
+    def get(self, key, version):
+        with self._lock:
+            self._check_version(version)
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, version, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._check_version(version)
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def revalidated(self):
+        """
+        count a request answered with 304 Not Modified
+        """
+
+        with self._lock:
+            self.not_modified += 1
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'not_modified': self.not_modified,
+                    'evictions': self.evictions,
+                    'size': len(self._entries),
+                    'max_size': self.max_size}
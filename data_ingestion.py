@@ -2,25 +2,97 @@
 collection of functions for the final case study solution
 """
 
+import json
 import os
 import re
 import shutil
 import time
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
+
+from metrics import timed
 
 COLORS = ["darkorange", "royalblue", "slategrey"]
+PREVIOUS_WINDOWS = [7, 14, 28, 70]  # [7, 14, 21, 28, 35, 42, 49, 56, 63, 70]
+
+# binary time-series cache (one typed row per country and day)
+TS_CACHE = "ts-cache.npy"
+TS_DAILY = "ts-daily.npy"
+TS_MANIFEST = "ts-manifest.json"
+# 3: caches converted from the csv seed also parse the json files next to it
+TS_CACHE_FORMAT = 3
+TS_SEED = "ts-data"
+TS_COLUMNS = ['purchases', 'unique_invoices', 'unique_streams', 'total_views', 'revenue']
+TS_DTYPE = np.dtype([('date', 'datetime64[D]'),
+                     ('purchases', np.int64),
+                     ('unique_invoices', np.int64),
+                     ('unique_streams', np.int64),
+                     ('total_views', np.int64),
+                     ('revenue', np.float64)])
+DAILY_DTYPE = np.dtype([('source', np.int32), ('country', np.int32)] + TS_DTYPE.descr)
+CORRECT_COLUMNS = ['country', 'customer_id', 'day', 'invoice', 'month',
+                   'price', 'stream_id', 'times_viewed', 'year']
+
+
+def _read_month(file_name, compact=False):
+    """
+    load one json file with normalized columns, invoice dates and invoice ids
+    """
+
+    df = pd.read_json(file_name)
+
+    # ensure the data are formatted with correct columns
+    df.rename(columns={'StreamID': 'stream_id',
+                       'TimesViewed': 'times_viewed',
+                       'total_price': 'price'}, inplace=True)
+    if sorted(df.columns.tolist()) != CORRECT_COLUMNS:
+        raise Exception("columns name could not be matched to correct cols")
+
+    dates = pd.to_datetime(pd.DataFrame({'year': df['year'].astype(int),
+                                         'month': df['month'].astype(int),
+                                         'day': df['day'].astype(int)}))
+    df['invoice_date'] = dates.values.astype('datetime64[D]')
+    df['invoice'] = df['invoice'].astype(str).str.replace(r"\D+", "", regex=True)
+
+    if compact:
+        # the date parts are already in invoice_date
+        df.drop(columns=['year', 'month', 'day'], inplace=True)
+        df['country'] = df['country'].astype('category')
+        df['stream_id'] = df['stream_id'].astype('category')
+        df['invoice'] = pd.to_numeric(df['invoice'], downcast='unsigned')
+        df['times_viewed'] = pd.to_numeric(df['times_viewed'], downcast='integer')
+        df['customer_id'] = pd.to_numeric(df['customer_id'], downcast='float')
+
+    return df
 
 
 class DataIngestion:
     def __init__(self):
         pass
 
-    def get_data(self, data_dir):
+    def get_data(self, data_dir, files=None, n_jobs=None, compact=False):
         """
         laod all json formatted files into a dataframe
+        use 'files' to load only some of the json files in data_dir
+
+        the files are parsed in parallel by n_jobs processes (one per cpu by
+        default) and concatenated column by column as they come back
+
+        compact=True keeps country and stream_id as categoricals, invoice as
+        an integer, downcasts times_viewed and customer_id and drops the
+        year, month and day columns (invoice_date holds the same date)
+        """
+
+        months = self.iter_data(data_dir, files=files, n_jobs=n_jobs, compact=compact)
+        return self._concat_months(df for _, df in months)
+
+    def iter_data(self, data_dir, files=None, n_jobs=None, compact=False):
+        """
+        parse the json files and yield (file name, DataFrame) in file order
         """
 
         # input testing
@@ -29,41 +101,51 @@ class DataIngestion:
         if not len(os.listdir(data_dir)) > 0:
             raise Exception("specified data dir does not contain any files")
 
-        file_list = [os.path.join(data_dir, f) for f in os.listdir(data_dir) if re.search("\.json", f)]
-        correct_columns = ['country', 'customer_id', 'day', 'invoice', 'month',
-                           'price', 'stream_id', 'times_viewed', 'year']
-
-        # read data into a temp structure
-        all_months = {}
-        for file_name in file_list:
-            df = pd.read_json(file_name)
-            all_months[os.path.split(file_name)[-1]] = df
-
-        # ensure the data are formatted with correct columns
-        for f, df in all_months.items():
-            cols = set(df.columns.tolist())
-            if 'StreamID' in cols:
-                df.rename(columns={'StreamID': 'stream_id'}, inplace=True)
-            if 'TimesViewed' in cols:
-                df.rename(columns={'TimesViewed': 'times_viewed'}, inplace=True)
-            if 'total_price' in cols:
-                df.rename(columns={'total_price': 'price'}, inplace=True)
-
-            cols = df.columns.tolist()
-            if sorted(cols) != correct_columns:
-                raise Exception("columns name could not be matched to correct cols")
-
-        # concat all of the data
-        df = pd.concat(list(all_months.values()), sort=True)
-        years, months, days = df['year'].values, df['month'].values, df['day'].values
-        dates = ["{}-{}-{}".format(years[i], str(months[i]).zfill(2), str(days[i]).zfill(2)) for i in
-                 range(df.shape[0])]
-        df['invoice_date'] = np.array(dates, dtype='datetime64[D]')
-        df['invoice'] = [re.sub("\D+", "", i) for i in df['invoice'].values]
+        if files is None:
+            files = [f for f in os.listdir(data_dir) if re.search("\.json", f)]
+        file_list = [os.path.join(data_dir, f) for f in files]
+
+        if n_jobs is None:
+            n_jobs = os.cpu_count() or 1
+        n_jobs = min(n_jobs, len(file_list))
+
+        if n_jobs > 1:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                months = executor.map(_read_month, file_list, [compact] * len(file_list))
+                for f, df in zip(files, months):
+                    yield f, df
+        else:
+            for f, file_name in zip(files, file_list):
+                yield f, _read_month(file_name, compact=compact)
+
+    @staticmethod
+    def _concat_months(months):
+        """
+        concatenate the monthly frames one column at a time
+        sorted by date so that peak memory stays close to the final frame
+        """
+
+        parts = defaultdict(list)
+        for df in months:
+            for column in df.columns:
+                parts[column].append(df[column].values)
+            del df
+
+        if len(parts) == 0:
+            raise Exception("no json files could be loaded")
+        columns = [c for c in CORRECT_COLUMNS + ['invoice_date'] if c in parts]
 
         # sort by date and reset the index
-        df.sort_values(by='invoice_date', inplace=True)
-        df.reset_index(drop=True, inplace=True)
+        invoice_dates = np.concatenate(parts['invoice_date'])
+        order = np.argsort(invoice_dates, kind='quicksort')
+
+        df = pd.DataFrame(index=pd.RangeIndex(order.size))
+        for column in columns:
+            column_parts = parts.pop(column)
+            if isinstance(column_parts[0], pd.Categorical):
+                df[column] = union_categoricals(column_parts).take(order)
+            else:
+                df[column] = np.concatenate(column_parts)[order]
 
         return df
 
@@ -75,42 +157,153 @@ class DataIngestion:
         """
 
         if country:
-            if country not in np.unique(df_orig['country'].values):
-                raise Excpetion("country not found")
+            return self.convert_to_ts_all(df_orig, countries=[country])[country]
+
+        return self.convert_to_ts_all(df_orig)['all']
+
+    def convert_to_ts_all(self, df_orig, countries=None):
+        """
+        given the original DataFrame (get_data())
+        return a dict with the time-series DataFrame for 'all' and for each
+        of the countries, aggregating every day in a single vectorized pass
+        """
+
+        if countries is None:
+            countries = []
+
+        country_codes, country_names = pd.factorize(df_orig['country'].values)
+        lookup = {name: code for code, name in enumerate(country_names)}
+        for country in countries:
+            if country not in lookup:
+                raise Exception("country not found")
+
+        dates = df_orig['invoice_date'].values.astype('datetime64[D]')
+        invoices = pd.factorize(df_orig['invoice'].values)[0]
+        streams = pd.factorize(df_orig['stream_id'].values)[0]
+        views = df_orig['times_viewed'].values
+        prices = df_orig['price'].values
 
-            mask = df_orig['country'] == country
-            df = df_orig[mask]
+        dfs = {}
+        groups = np.zeros(dates.size, dtype=np.int64)
+        dfs['all'] = self._daily_ts(dates, groups, 1, invoices, streams, views, prices)[0]
+        if countries:
+            by_country = self._daily_ts(dates, country_codes.astype(np.int64), len(country_names),
+                                        invoices, streams, views, prices)
+            for country in countries:
+                dfs[country] = by_country[lookup[country]]
+
+        return dfs
+
+    @staticmethod
+    def _daily_ts(dates, groups, n_groups, invoices, streams, views, prices):
+        """
+        aggregate the invoice rows per (group, day)
+        and return one daily time-series DataFrame per group
+        """
+
+        if dates.size == 0:
+            return [DataIngestion._ts_frame(np.array([], dtype='datetime64[D]'), [], [], [], [], [])
+                    for _ in range(n_groups)]
+
+        daily = DataIngestion._daily_aggregates(dates, groups, n_groups, invoices, streams, views, prices)
+        bounds = np.searchsorted(daily['group'], np.arange(n_groups + 1))
+
+        # each series runs from the first month with data up to (but excluding) the last one
+        dfs = []
+        for g in range(n_groups):
+            rows = {key: values[bounds[g]:bounds[g + 1]] for key, values in daily.items()}
+            start = rows['date'].min().astype('datetime64[M]').astype('datetime64[D]')
+            stop = rows['date'].max().astype('datetime64[M]').astype('datetime64[D]')
+            dfs.append(DataIngestion._dense_ts(start, stop, rows['date'], rows))
+        return dfs
+
+    @staticmethod
+    def _daily_aggregates(dates, groups, n_groups, invoices, streams, views, prices):
+        """
+        aggregate the invoice rows per (group, day) in a single vectorized pass
+        only the (group, day) pairs with data are returned, ordered by group and day
+        """
+
+        origin = dates.min()
+        offsets = (dates - origin).astype(np.int64)
+        n_days = int(offsets.max()) + 1
+        keys = groups * n_days + offsets
+
+        # a stable sort keeps the original row order within each day, reduceat
+        # then adds each day's rows sequentially in that order (a per-day
+        # slice .sum() adds pairwise and can differ in the last bits)
+        order = np.argsort(keys, kind='mergesort')
+        sorted_keys = keys[order]
+        bounds = np.flatnonzero(np.diff(sorted_keys)) + 1
+        starts = np.concatenate([[0], bounds])
+        stops = np.concatenate([bounds, [sorted_keys.size]])
+        present = sorted_keys[starts]
+
+        def count_unique(codes):
+            n_codes = codes.max() + 1
+            pairs = np.unique(keys * n_codes + codes) // n_codes
+            return np.bincount(np.searchsorted(present, pairs), minlength=present.size)
+
+        sorted_prices = prices[order]
+        return {'group': present // n_days,
+                'date': origin + present % n_days,
+                'purchases': stops - starts,
+                'unique_invoices': count_unique(invoices),
+                'unique_streams': count_unique(streams),
+                'total_views': np.add.reduceat(views[order].astype(np.int64), starts),
+                'revenue': np.add.reduceat(sorted_prices, starts)}
+
+    @staticmethod
+    def _dense_ts(start, stop, dates, values):
+        """
+        daily time-series DataFrame for every day in [start, stop)
+        the aggregates of rows falling on the same day are added up
+        """
+
+        if np.isnat(start) or np.isnat(stop) or stop <= start:
+            return DataIngestion._ts_frame(np.array([], dtype='datetime64[D]'), [], [], [], [], [])
+
+        days = np.arange(start, stop, dtype='datetime64[D]')
+        index = (dates - start).astype(np.int64)
+        keep = (index >= 0) & (index < days.size)
+
+        columns = []
+        for column in TS_COLUMNS:
+            column_values = np.asarray(values[column])
+            total = np.bincount(index[keep], weights=column_values[keep], minlength=days.size)
+            if column != 'revenue':
+                total = total.astype(np.int64)
+            columns.append(total)
+        return DataIngestion._ts_frame(days, *columns)
+
+    @staticmethod
+    def _ts_frame(days, purchases, invoices, streams, views, revenue):
+        if len(days) == 0:
+            purchases, invoices, streams, views, revenue = [], [], [], [], []
+            year_month = []
         else:
-            df = df_orig
-
-        # use a date range to ensure all days are accounted for in the data
-        invoice_dates = df['invoice_date'].values
-        start_month = '{}-{}'.format(df['year'].values[0], str(df['month'].values[0]).zfill(2))
-        stop_month = '{}-{}'.format(df['year'].values[-1], str(df['month'].values[-1]).zfill(2))
-        df_dates = df['invoice_date'].values.astype('datetime64[D]')
-        days = np.arange(start_month, stop_month, dtype='datetime64[D]')
-
-        purchases = np.array([np.where(df_dates == day)[0].size for day in days])
-        invoices = [np.unique(df[df_dates == day]['invoice'].values).size for day in days]
-        streams = [np.unique(df[df_dates == day]['stream_id'].values).size for day in days]
-        views = [df[df_dates == day]['times_viewed'].values.sum() for day in days]
-        revenue = [df[df_dates == day]['price'].values.sum() for day in days]
-        year_month = ["-".join(re.split("-", str(day))[:2]) for day in days]
-
-        df_time = pd.DataFrame({'date': days,
-                                'purchases': purchases,
-                                'unique_invoices': invoices,
-                                'unique_streams': streams,
-                                'total_views': views,
-                                'year_month': year_month,
-                                'revenue': revenue})
-        return df_time
-
-    def fetch_ts(self, data_dir, clean=False):
+            year_month = days.astype('datetime64[M]').astype(str)
+
+        return pd.DataFrame({'date': days,
+                             'purchases': purchases,
+                             'unique_invoices': invoices,
+                             'unique_streams': streams,
+                             'total_views': views,
+                             'year_month': year_month,
+                             'revenue': revenue})
+
+    @timed('fetch_ts')
+    def fetch_ts(self, data_dir, clean=False, incremental=True, compact=False):
         """
         convenience function to read in new data
-        uses csv to load quickly
+        uses a memory-mapped binary cache to load quickly
         use clean=True when you want to re-create the files
+
+        when json files are added or changed only those files are parsed and
+        their daily aggregates are merged into the cache, use incremental=False
+        to parse every file again
+
+        compact=True parses the files into the compact representation (see get_data)
         """
 
         ts_data_dir = os.path.join(data_dir, "ts-data")
@@ -120,44 +313,299 @@ class DataIngestion:
         if not os.path.exists(ts_data_dir):
             os.mkdir(ts_data_dir)
 
-        # if files have already been processed load them        
-        if len(os.listdir(ts_data_dir)) > 0:
-            print("... loading ts data from files")
-            return (
-            {re.sub("\.csv", "", cf)[3:]: pd.read_csv(os.path.join(ts_data_dir, cf)) for cf in os.listdir(ts_data_dir)})
+        sources = self._source_files(data_dir)
+
+        # if files have already been processed load them
+        manifest = self._read_manifest(ts_data_dir)
+        if manifest is not None and manifest['sources'] == sources:
+            dfs = self._read_ts_cache(ts_data_dir, manifest)
+            if dfs is not None:
+                print("... loading ts data from cache")
+                return dfs
+
+        # daily aggregates of the files that were processed before
+        daily, processed = None, {}
+        if manifest is not None and incremental:
+            daily = self._read_daily(ts_data_dir, manifest)
+            if daily is not None:
+                processed = manifest['sources']
+
+        # csv files written before the cache existed are converted once; they
+        # stop before the last month of the data they were made from, so the
+        # json files are still parsed and their days take precedence
+        csv_files = [f for f in os.listdir(ts_data_dir) if re.search(r"^ts-.+\.csv$", f)]
+        if manifest is None and len(csv_files) > 0:
+            print("... converting ts data csv files to cache")
+            daily = self._daily_from_csv(ts_data_dir, sorted(csv_files))
+            processed = {}
+
+        if daily is None:
+            daily = self._daily_frames(np.zeros(0, dtype=DAILY_DTYPE), [], [], [])
+
+        # only parse the new or changed files and drop the removed ones
+        changed = [f for f in sources if processed.get(f) != sources[f]]
+        stale = set(changed) | (set(processed) - set(sources))
+        daily = {key: table[~table['source'].isin(stale)] for key, table in daily.items()}
+
+        if len(changed) > 0:
+            print("... processing {} new or changed data files".format(len(changed)))
+        for f, df in self.iter_data(data_dir, files=changed, compact=compact):
+            rows, ranges = self._daily_table(df, source=f)
+            daily = {'rows': pd.concat([daily['rows'], rows], ignore_index=True),
+                     'ranges': pd.concat([daily['ranges'], ranges], ignore_index=True)}
+
+        dfs = self._series_from_daily(daily)
+
+        # save the data to the cache
+        self._write_ts_cache(ts_data_dir, dfs, sources, daily)
 
-        # get original data
-        print("... processing data for loading")
-        df = self.get_data(data_dir)
+        return dfs
 
-        # find the top ten countries (wrt revenue)
-        table = pd.pivot_table(df, index='country', values="price", aggfunc='sum')
-        table.columns = ['total_revenue']
-        table.sort_values(by='total_revenue', inplace=True, ascending=False)
-        top_ten_countries = np.array(list(table.index))[:10]
+    def _daily_table(self, df, source):
+        """
+        sparse daily aggregates of an invoice table for 'all' and every country
+        together with the range of days each series covers
+        """
+
+        country_codes, country_names = pd.factorize(df['country'].values)
+        country_ids = np.array(['all'] + [re.sub("\s+", "_", str(c).lower()) for c in country_names],
+                               dtype=object)
+
+        dates = df['invoice_date'].values.astype('datetime64[D]')
+        invoices = pd.factorize(df['invoice'].values)[0]
+        streams = pd.factorize(df['stream_id'].values)[0]
+        views = df['times_viewed'].values
+        prices = df['price'].values
+
+        everything = self._daily_aggregates(dates, np.zeros(dates.size, dtype=np.int64), 1,
+                                            invoices, streams, views, prices)
+        by_country = self._daily_aggregates(dates, country_codes.astype(np.int64), len(country_names),
+                                            invoices, streams, views, prices)
+        by_country['group'] = by_country['group'] + 1
+
+        columns = {key: np.concatenate([everything[key], by_country[key]]) for key in everything}
+        rows = pd.DataFrame({'source': source,
+                             'country': country_ids[columns['group']],
+                             'date': columns['date']})
+        for column in TS_COLUMNS:
+            rows[column] = columns[column]
+
+        # each series runs from the first month with data up to (but excluding) the last one
+        ranges = rows.groupby('country', sort=False)['date'].agg(['min', 'max'])
+        ranges = pd.DataFrame({'source': source,
+                               'country': ranges.index.values,
+                               'start': ranges['min'].values.astype('datetime64[M]').astype('datetime64[D]'),
+                               'stop': ranges['max'].values.astype('datetime64[M]').astype('datetime64[D]')})
+        return rows, ranges
+
+    def _daily_from_csv(self, ts_data_dir, csv_files):
+        """
+        daily aggregates and ranges from the ts-<country>.csv files
+        """
+
+        rows, ranges = [], []
+        for cf in csv_files:
+            country = re.sub(r"^ts-|\.csv$", "", cf)
+            df = pd.read_csv(os.path.join(ts_data_dir, cf))
+            dates = df['date'].values.astype('datetime64[D]')
+            if dates.size > 0:
+                start, stop = dates.min(), dates.max() + np.timedelta64(1, 'D')
+            else:
+                start, stop = np.datetime64('NaT', 'D'), np.datetime64('NaT', 'D')
+            ranges.append({'source': TS_SEED, 'country': country, 'start': start, 'stop': stop})
+
+            table = pd.DataFrame({'source': TS_SEED, 'country': country, 'date': dates})
+            for column in TS_COLUMNS:
+                table[column] = df[column].values.astype(TS_DTYPE[column])
+            rows.append(table)
+
+        return {'rows': pd.concat(rows, ignore_index=True), 'ranges': pd.DataFrame(ranges)}
+
+    def _series_from_daily(self, daily):
+        """
+        dense time-series for 'all' and the top ten countries (wrt revenue)
+        """
+
+        rows, ranges = daily['rows'], daily['ranges']
 
-        file_list = [os.path.join(data_dir, f) for f in os.listdir(data_dir) if re.search("\.json", f)]
-        countries = [os.path.join(data_dir, "ts-" + re.sub("\s+", "_", c.lower()) + ".csv") for c in top_ten_countries]
+        # days covered by parsed json files take precedence over converted csv files
+        seeded = (rows['source'] == TS_SEED).values
+        if seeded.any() and not seeded.all():
+            spans = rows[~seeded].groupby('source')['date'].agg(['min', 'max'])
+            dates = rows['date'].values
+            shadowed = np.zeros(seeded.size, dtype=bool)
+            for first, last in zip(spans['min'].values, spans['max'].values):
+                shadowed |= seeded & (dates >= first) & (dates <= last)
+            rows = rows[~shadowed]
+
+        # find the top ten countries (wrt revenue)
+        countries = [c for c in pd.unique(ranges['country']) if c != 'all']
+        table = rows.groupby('country')['revenue'].sum().reindex(countries, fill_value=0)
+        table.sort_values(inplace=True, ascending=False)
+        top_ten_countries = list(table.index)[:10]
 
-        # load the data
         dfs = {}
-        dfs['all'] = self.convert_to_ts(df)
-        for country in top_ten_countries:
-            country_id = re.sub("\s+", "_", country.lower())
-            file_name = os.path.join(data_dir, "ts-" + country_id + ".csv")
-            dfs[country_id] = self.convert_to_ts(df, country=country)
+        for key in ['all'] + top_ten_countries:
+            key_ranges = ranges[ranges['country'] == key]
+            if key_ranges.shape[0] == 0:
+                continue
+            key_rows = rows[rows['country'] == key]
+            starts = key_ranges['start'].values.astype('datetime64[D]')
+            stops = key_ranges['stop'].values.astype('datetime64[D]')
+            start = starts[~np.isnat(starts)].min() if not np.isnat(starts).all() else starts[0]
+            stop = stops[~np.isnat(stops)].max() if not np.isnat(stops).all() else stops[0]
+            dfs[key] = self._dense_ts(start, stop, key_rows['date'].values.astype('datetime64[D]'),
+                                      {column: key_rows[column].values for column in TS_COLUMNS})
+        return dfs
+
+    @staticmethod
+    def _source_files(data_dir):
+        """
+        size and modification time of every json file in the data dir
+        """
+
+        sources = {}
+        for f in sorted(os.listdir(data_dir)):
+            if re.search("\.json", f):
+                st = os.stat(os.path.join(data_dir, f))
+                sources[f] = [st.st_size, st.st_mtime_ns]
+        return sources
+
+    @staticmethod
+    def _read_manifest(ts_data_dir):
+        manifest_file = os.path.join(ts_data_dir, TS_MANIFEST)
+        if not os.path.exists(manifest_file):
+            return None
+
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if manifest.get('format') != TS_CACHE_FORMAT:
+            return None
+        return manifest
+
+    @staticmethod
+    def _write_ts_cache(ts_data_dir, dfs, sources, daily):
+        """
+        save every time-series in a single typed array and the daily
+        aggregates of each source file in a second one
+        the manifest records the rows of each series and the source files
+        """
+
+        series = []
+        offset = 0
+        blocks = []
+        for key, df in dfs.items():
+            block = np.zeros(df.shape[0], dtype=TS_DTYPE)
+            if df.shape[0] > 0:
+                block['date'] = df['date'].values.astype('datetime64[D]')
+                for column in TS_COLUMNS:
+                    block[column] = df[column].values
+            blocks.append(block)
+            series.append({'name': key, 'start': offset, 'stop': offset + block.size})
+            offset += block.size
+
+        # sources and countries of the daily aggregates are stored as codes
+        rows, ranges = daily['rows'], daily['ranges']
+        source_codes, source_names = pd.factorize(pd.concat([ranges['source'], rows['source']]))
+        country_codes, country_names = pd.factorize(pd.concat([ranges['country'], rows['country']]))
+        n_ranges = ranges.shape[0]
+
+        table = np.zeros(rows.shape[0], dtype=DAILY_DTYPE)
+        table['source'] = source_codes[n_ranges:]
+        table['country'] = country_codes[n_ranges:]
+        table['date'] = rows['date'].values.astype('datetime64[D]')
+        for column in TS_COLUMNS:
+            table[column] = rows[column].values
+
+        manifest = {'format': TS_CACHE_FORMAT,
+                    'rows': offset,
+                    'series': series,
+                    'sources': sources,
+                    'daily': {'rows': int(table.size),
+                              'sources': [str(name) for name in source_names],
+                              'countries': [str(name) for name in country_names],
+                              'ranges': [[int(s), int(c), str(start), str(stop)] for s, c, start, stop in
+                                         zip(source_codes[:n_ranges], country_codes[:n_ranges],
+                                             ranges['start'].values.astype('datetime64[D]'),
+                                             ranges['stop'].values.astype('datetime64[D]'))]}}
+
+        # write to temporary files first so readers never see a partial cache
+        cache_file = os.path.join(ts_data_dir, TS_CACHE)
+        daily_file = os.path.join(ts_data_dir, TS_DAILY)
+        manifest_file = os.path.join(ts_data_dir, TS_MANIFEST)
+        with open(cache_file + ".tmp", 'wb') as f:
+            np.save(f, np.concatenate(blocks) if blocks else np.zeros(0, dtype=TS_DTYPE))
+        os.replace(cache_file + ".tmp", cache_file)
+        with open(daily_file + ".tmp", 'wb') as f:
+            np.save(f, table)
+        os.replace(daily_file + ".tmp", daily_file)
+        with open(manifest_file + ".tmp", 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_file + ".tmp", manifest_file)
 
-        # save the data as csvs    
-        for key, item in dfs.items():
-            item.to_csv(os.path.join(ts_data_dir, "ts-" + key + ".csv"), index=False)
+    @staticmethod
+    def _read_daily(ts_data_dir, manifest):
+        """
+        load the daily aggregates of the files that were already processed
+        """
 
+        daily_file = os.path.join(ts_data_dir, TS_DAILY)
+        if not os.path.exists(daily_file):
+            return None
+
+        table = np.load(daily_file)
+        if table.dtype != DAILY_DTYPE or table.size != manifest['daily']['rows']:
+            return None
+
+        return DataIngestion._daily_frames(table, manifest['daily']['sources'],
+                                           manifest['daily']['countries'], manifest['daily']['ranges'])
+
+    @staticmethod
+    def _daily_frames(table, source_names, country_names, ranges):
+        """
+        daily aggregates and ranges as DataFrames from their stored form
+        """
+
+        source_names = np.array(source_names, dtype=object)
+        country_names = np.array(country_names, dtype=object)
+        rows = pd.DataFrame({'source': source_names[table['source']],
+                             'country': country_names[table['country']],
+                             'date': table['date']})
+        for column in TS_COLUMNS:
+            rows[column] = table[column]
+
+        ranges = pd.DataFrame({'source': [source_names[r[0]] for r in ranges],
+                               'country': [country_names[r[1]] for r in ranges],
+                               'start': np.array([r[2] for r in ranges], dtype='datetime64[D]'),
+                               'stop': np.array([r[3] for r in ranges], dtype='datetime64[D]')})
+        return {'rows': rows, 'ranges': ranges}
+
+    @staticmethod
+    def _read_ts_cache(ts_data_dir, manifest):
+        """
+        map the cache into memory and slice out each time-series
+        """
+
+        cache_file = os.path.join(ts_data_dir, TS_CACHE)
+        if not os.path.exists(cache_file):
+            return None
+
+        cache = np.load(cache_file, mmap_mode='r')
+        if cache.dtype != TS_DTYPE or cache.size != manifest['rows']:
+            return None
+
+        dfs = {}
+        for entry in manifest['series']:
+            rows = np.array(cache[entry['start']:entry['stop']])
+            dfs[entry['name']] = DataIngestion._ts_frame(rows['date'], *[rows[c] for c in TS_COLUMNS])
         return dfs
 
 
 class DataProcessing:
 
     @staticmethod
-    def engineer_features(df, training=True):
+    @timed('engineer_features')
+    def engineer_features(df, training=True, previous=None):
         """
         for any given day the target becomes the sum of the next days revenue
         for that day we engineer several features that help predict the summed revenue
@@ -165,41 +613,55 @@ class DataProcessing:
         the 'training' flag will trim data that should not be used for training
         when set to false all data will be returned
 
+        'previous' lists the sizes (in days) of the revenue windows used as
+        features, it defaults to PREVIOUS_WINDOWS
         """
 
+        if previous is None:
+            previous = PREVIOUS_WINDOWS
+
         # extract dates
         dates = df['date'].values.copy()
         dates = dates.astype('datetime64[D]')
 
-        # engineer some features
+        # window sums come from cumulative sums over a dense daily index
+        # a window [lo, hi) around a day is then cum[day + hi] - cum[day + lo]
         eng_features = defaultdict(list)
-        previous = [7, 14, 28, 70]  # [7, 14, 21, 28, 35, 42, 49, 56, 63, 70]
         y = np.zeros(dates.size)
-        for d, day in enumerate(dates):
+        if dates.size > 0:
+            offsets = (dates - dates.min()).astype(np.int64)
+            n_days = int(offsets.max()) + 1
+
+            def cumulative(column):
+                values = df[column].values.astype(np.float64)
+                valid = ~np.isnan(values)
+                totals = np.bincount(offsets[valid], weights=values[valid], minlength=n_days)
+                counts = np.bincount(offsets[valid], minlength=n_days)
+                return (np.concatenate([[0.0], np.cumsum(totals)]),
+                        np.concatenate([[0], np.cumsum(counts)]))
+
+            def window(cum, lo, hi):
+                return (cum[np.clip(offsets + hi, 0, n_days)] -
+                        cum[np.clip(offsets + lo, 0, n_days)])
+
+            revenue, _ = cumulative('revenue')
+            invoices, invoice_counts = cumulative('unique_invoices')
+            views, view_counts = cumulative('total_views')
 
             # use windows in time back from a specific date
             for num in previous:
-                current = np.datetime64(day, 'D')
-                prev = current - np.timedelta64(num, 'D')
-                mask = np.in1d(dates, np.arange(prev, current, dtype='datetime64[D]'))
-                eng_features["previous_{}".format(num)].append(df[mask]['revenue'].sum())
+                eng_features["previous_{}".format(num)] = window(revenue, -num, 0)
 
             # get get the target revenue
-            plus_30 = current + np.timedelta64(30, 'D')
-            mask = np.in1d(dates, np.arange(current, plus_30, dtype='datetime64[D]'))
-            y[d] = df[mask]['revenue'].sum()
+            y = window(revenue, 0, 30)
 
             # attempt to capture monthly trend with previous years data (if present)
-            start_date = current - np.timedelta64(365, 'D')
-            stop_date = plus_30 - np.timedelta64(365, 'D')
-            mask = np.in1d(dates, np.arange(start_date, stop_date, dtype='datetime64[D]'))
-            eng_features['previous_year'].append(df[mask]['revenue'].sum())
-
-            # add some non-revenue features
-            minus_30 = current - np.timedelta64(30, 'D')
-            mask = np.in1d(dates, np.arange(minus_30, current, dtype='datetime64[D]'))
-            eng_features['recent_invoices'].append(df[mask]['unique_invoices'].mean())
-            eng_features['recent_views'].append(df[mask]['total_views'].mean())
+            eng_features['previous_year'] = window(revenue, -365, 30 - 365)
+
+            # add some non-revenue features (means are NaN for empty windows)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                eng_features['recent_invoices'] = window(invoices, -30, 0) / window(invoice_counts, -30, 0)
+                eng_features['recent_views'] = window(views, -30, 0) / window(view_counts, -30, 0)
 
         X = pd.DataFrame(eng_features)
         # combine features in to df and remove rows with all zeros
@@ -0,0 +1,210 @@
+"""
+flat, memory-mappable layout of the fitted scaler + random forest pipelines
+"""
+
+import json
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+FOREST_FORMAT = 2
+NODE_DTYPE = np.dtype([('left', np.int64),
+                       ('right', np.int64),
+                       ('feature', np.int64),
+                       ('threshold', np.float64),
+                       ('value', np.float64)])
+
+
+SIGN = np.uint64(1 << 63)
+
+
+def _float_key(x):
+    """
+    map float64 to uint64 keys that sort in the same order as the floats
+    """
+
+    u = x.view(np.uint64)
+    return np.where(u & SIGN, ~u, u | SIGN)
+
+
+def _key_float(k):
+    u = np.where(k & SIGN, k & ~SIGN, ~k)
+    return u.view(np.float64)
+
+
+def fold_scaler(nodes, meta):
+    """
+    move the StandardScaler into the split thresholds
+
+    a tree sends a row left when float32((x - mean) / scale) <= threshold;
+    that test only grows with x, so it equals x <= T for the largest float64
+    T that still goes left, found by bisection over the ordered float64 bits
+    """
+
+    if meta.get('folded') or meta['mean'] is None and meta['scale'] is None:
+        return nodes, dict(meta, folded=True)
+
+    nodes = nodes.copy()
+    split = nodes['left'] >= 0
+    feature = nodes['feature'][split]
+    threshold = nodes['threshold'][split]
+    mean = np.zeros(meta['n_features']) if meta['mean'] is None else np.array(meta['mean'])
+    scale = np.ones(meta['n_features']) if meta['scale'] is None else np.array(meta['scale'])
+    mean, scale = mean[feature], scale[feature]
+
+    def goes_left(x):
+        return ((x - mean) / scale).astype(np.float32) <= threshold
+
+    # -inf always goes left and +inf never does
+    lo = np.full(threshold.size, _float_key(np.array([-np.inf]))[0])
+    hi = np.full(threshold.size, _float_key(np.array([np.inf]))[0])
+    while (hi - lo > 1).any():
+        mid = lo + (hi - lo) // np.uint64(2)
+        left = goes_left(_key_float(mid))
+        lo = np.where(left, mid, lo)
+        hi = np.where(left, hi, mid)
+
+    nodes['threshold'][split] = _key_float(lo)
+    return nodes, dict(meta, mean=None, scale=None, folded=True)
+
+
+def export_forest(model, fold=True):
+    """
+    flatten a fitted Pipeline(StandardScaler, RandomForestRegressor)
+
+    returns (nodes, meta) or None when the model has another layout; the
+    nodes of every tree are concatenated and the child indices are global,
+    with fold=True the scaler is folded into the thresholds (see fold_scaler)
+    """
+
+    if hasattr(model, 'best_estimator_'):
+        model = model.best_estimator_
+    if not isinstance(model, Pipeline) or len(model.steps) != 2:
+        return None
+    scaler, rf = model.steps[0][1], model.steps[1][1]
+    if not isinstance(scaler, StandardScaler) or not isinstance(rf, RandomForestRegressor):
+        return None
+    if rf.n_outputs_ != 1:
+        return None
+
+    trees = [estimator.tree_ for estimator in rf.estimators_]
+    sizes = np.array([tree.node_count for tree in trees])
+    roots = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+    nodes = np.zeros(sizes.sum(), dtype=NODE_DTYPE)
+    for root, tree in zip(roots, trees):
+        part = nodes[root:root+tree.node_count]
+        leaf = tree.children_left < 0
+        part['left'] = np.where(leaf, -1, tree.children_left + root)
+        part['right'] = np.where(leaf, -1, tree.children_right + root)
+        # leaves have feature -2, any valid column keeps the lookups in bounds
+        part['feature'] = np.where(leaf, 0, tree.feature)
+        part['threshold'] = tree.threshold
+        part['value'] = tree.value[:, 0, 0]
+
+    n_features = int(rf.n_features_in_) if hasattr(rf, 'n_features_in_') else int(rf.n_features_)
+    feature_names = getattr(model, 'feature_names_in_', None)
+    meta = {'format': FOREST_FORMAT,
+            'n_features': n_features,
+            'feature_names': None if feature_names is None else [str(f) for f in feature_names],
+            'mean': None if scaler.mean_ is None else scaler.mean_.tolist(),
+            'scale': None if scaler.scale_ is None else scaler.scale_.tolist(),
+            'roots': roots.tolist(),
+            'max_depth': int(max(tree.max_depth for tree in trees)),
+            'folded': False}
+    if fold:
+        return fold_scaler(nodes, meta)
+    return nodes, meta
+
+
+def save_nodes(nodes, nodes_file):
+    """
+    write the nodes as a plain .npy so they can be memory-mapped
+    """
+
+    with open(nodes_file, 'wb') as f:
+        np.save(f, nodes)
+
+
+def save_meta(meta, meta_file):
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f)
+
+
+class ForestModel:
+    """
+    predicts like the exported pipeline from the flat node arrays
+
+    with mmap_mode='r' the nodes stay in the page cache and are shared by
+    every process that serves the same file
+    """
+
+    def __init__(self, nodes, meta):
+        self.nodes = nodes
+        self.meta = meta
+        self.left = nodes['left']
+        self.right = nodes['right']
+        self.feature = nodes['feature']
+        self.threshold = nodes['threshold']
+        self.value = nodes['value']
+        self.roots = np.array(meta['roots'], dtype=np.int64)
+        self.mean = None if meta['mean'] is None else np.array(meta['mean'])
+        self.scale = None if meta['scale'] is None else np.array(meta['scale'])
+
+    @classmethod
+    def load(cls, nodes_file, meta_file, mmap_mode='r'):
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta.get('format') != FOREST_FORMAT:
+            raise Exception("forest {} has format {} (expected {})".format(meta_file, meta.get('format'), FOREST_FORMAT))
+        return cls(np.load(nodes_file, mmap_mode=mmap_mode), meta)
+
+    def _features(self, X):
+        if isinstance(X, pd.DataFrame):
+            if self.meta['feature_names'] is not None:
+                X = X[self.meta['feature_names']]
+            X = X.values
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim != 2 or X.shape[1] != self.meta['n_features']:
+            raise Exception("expected {} features".format(self.meta['n_features']))
+
+        # folded thresholds compare the raw features
+        if self.meta.get('folded'):
+            return X
+
+        # same arithmetic as StandardScaler.transform, then the float32 the trees compare
+        if self.mean is not None:
+            X = X - self.mean
+        if self.scale is not None:
+            X = X / self.scale
+        return X.astype(np.float32)
+
+    def apply(self, X):
+        """
+        global leaf index of every (row, tree)
+        """
+
+        X = self._features(X)
+        rows = np.arange(X.shape[0])[:, None]
+        node = np.repeat(self.roots[None, :], X.shape[0], axis=0)
+        for _ in range(self.meta['max_depth']):
+            left = self.left[node]
+            split = left >= 0
+            if not split.any():
+                break
+            go_left = X[rows, self.feature[node]] <= self.threshold[node]
+            node = np.where(split, np.where(go_left, left, self.right[node]), node)
+        return node
+
+    def predict(self, X):
+        values = self.value[self.apply(X)]
+
+        # add the trees in order like RandomForestRegressor does
+        y_pred = np.zeros(values.shape[0])
+        for t in range(values.shape[1]):
+            y_pred += values[:, t]
+        y_pred /= values.shape[1]
+        return y_pred
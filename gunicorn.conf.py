@@ -0,0 +1,103 @@
+"""
+gunicorn settings of the production server
+
+    ~$ gunicorn -c gunicorn.conf.py wsgi:application
+
+every setting can be changed from the environment
+    AAVAIL_BIND              address to listen on (0.0.0.0:8080)
+    AAVAIL_WORKERS           worker processes (one per core)
+    AAVAIL_THREADS           threads per worker, their /predict queries are micro-batched (4)
+    AAVAIL_TIMEOUT           seconds before a silent worker is restarted (30)
+    AAVAIL_GRACEFUL_TIMEOUT  seconds the old workers get to finish on a reload (30)
+    AAVAIL_RELOAD_INTERVAL   seconds between checks for new models, 0 disables them (5)
+    AAVAIL_METRICS_DIR       where the processes share their /metrics (a temporary directory)
+
+the models are loaded once in the master (preload_app) and the workers are
+forked from it; when a new model version lands, or on 'kill -HUP <master pid>',
+the master reloads the models and replaces the workers gracefully
+
+every process writes its latency histograms to AAVAIL_METRICS_DIR and
+/metrics adds them up, so any worker answers for the whole server
+"""
+
+import glob
+import multiprocessing
+import os
+import signal
+import tempfile
+import threading
+import time
+
+bind = os.environ.get("AAVAIL_BIND", "0.0.0.0:8080")
+workers = int(os.environ.get("AAVAIL_WORKERS", multiprocessing.cpu_count()))
+threads = int(os.environ.get("AAVAIL_THREADS", "4"))
+timeout = int(os.environ.get("AAVAIL_TIMEOUT", "30"))
+graceful_timeout = int(os.environ.get("AAVAIL_GRACEFUL_TIMEOUT", "30"))
+preload_app = True
+
+model_reload_interval = float(os.environ.get("AAVAIL_RELOAD_INTERVAL", "5"))
+
+# set before the app is preloaded; this file is read again on a reload and keeps the directory
+if "AAVAIL_METRICS_DIR" not in os.environ:
+    os.environ["AAVAIL_METRICS_DIR"] = os.path.join(tempfile.gettempdir(), "aavail-metrics-{}".format(os.getpid()))
+    for f in glob.glob(os.path.join(os.environ["AAVAIL_METRICS_DIR"], "metrics-*.json")):
+        os.remove(f)
+
+
+def _watch_models(server):
+    """
+    send SIGHUP to the master when the model files change (not while a training job rewrites them)
+    """
+
+    import wsgi
+
+    while True:
+        time.sleep(model_reload_interval)
+        try:
+            if not wsgi.training_jobs.running() and wsgi.registry.changed():
+                server.log.info("models changed, reloading")
+                loads = wsgi.loads
+                os.kill(server.pid, signal.SIGHUP)
+                # wait for the reload before checking again
+                deadline = time.time() + graceful_timeout
+                while wsgi.loads == loads and time.time() < deadline:
+                    time.sleep(0.1)
+        except Exception as e:
+            server.log.error("could not check the models: {}".format(e))
+
+
+def when_ready(server):
+    if model_reload_interval > 0:
+        import wsgi
+
+        # the master reloads the models, the workers no longer check the files themselves
+        wsgi.registry.check_interval = float('inf')
+
+        thread = threading.Thread(target=_watch_models, args=(server,))
+        thread.daemon = True
+        thread.start()
+
+
+def post_fork(server, worker):
+    """
+    the master keeps its own metrics (model loads), a worker starts from zero
+    """
+
+    import metrics
+
+    metrics.METRICS.reset()
+
+
+def on_reload(server):
+    """
+    reload the models in the master (SIGHUP) before the new workers are forked
+    """
+
+    import wsgi
+
+    try:
+        wsgi.warm()
+        server.log.info("models reloaded")
+    except Exception as e:
+        # the new workers are forked with the models that were loaded before
+        server.log.error("could not reload the models: {}".format(e))
@@ -0,0 +1,303 @@
+"""
+background training jobs for the API
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from model import model_train
+from model_store import atomic_write
+
+
+class TrainingCancelled(Exception):
+    pass
+
+
+class TrainingLock:
+    """
+    lock file held while a training job runs
+
+    with several server processes (see gunicorn.conf.py) it keeps one job
+    running across all of them and tells the model reloads that the model
+    files are being rewritten; the file holds the id of the running job
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self, owner=""):
+        """
+        take the lock without waiting, False when another job holds it
+        """
+
+        f = open(self.path, 'a+')
+        if fcntl is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                return False
+        f.seek(0)
+        f.truncate()
+        f.write(owner)
+        f.flush()
+        self._file = f
+        return True
+
+    def release(self):
+        f, self._file = self._file, None
+        if f is not None:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            f.close()
+
+    def held(self):
+        """
+        True when a job of any process holds the lock
+        """
+
+        if self._file is not None:
+            return True
+        if fcntl is None or not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return True
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            return False
+
+    def owner(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            return f.read() or None
+
+
+class TrainingJob:
+    """
+    one model_train run with its status, per-country progress and cancel flag
+
+    the status goes from 'queued' to 'running' and ends as 'done',
+    'cancelled' or 'failed'
+
+    with a state_dir the status is also written to '<state_dir>/<job_id>.json'
+    so other server processes can report it, and a '<job_id>.cancel' file
+    there cancels the job
+    """
+
+    def __init__(self, params, state_dir=None):
+        self.id = uuid.uuid4().hex
+        self.state_dir = state_dir
+        self.params = params
+        self.status = 'queued'
+        self.progress = {}
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+
+    def countries(self, tags):
+        with self._lock:
+            self.progress = {tag: {'status': 'searching', 'fits': 0} for tag in tags}
+        self.save()
+
+    def fitted(self, tag, n=1):
+        with self._lock:
+            if tag in self.progress:
+                self.progress[tag]['fits'] += n
+
+    def stage(self, tag, status):
+        with self._lock:
+            if tag in self.progress:
+                self.progress[tag]['status'] = status
+        self.save()
+
+    def check(self):
+        """
+        raise TrainingCancelled if a cancel was requested
+        """
+
+        if self.state_dir is not None and os.path.exists(_cancel_file(self.state_dir, self.id)):
+            self._cancel.set()
+        if self._cancel.is_set():
+            raise TrainingCancelled("training job {} was cancelled".format(self.id))
+
+    def cancel(self):
+        self._cancel.set()
+
+    def to_dict(self):
+        with self._lock:
+            elapsed = None
+            if self.started is not None:
+                elapsed = round((self.finished or time.time()) - self.started, 2)
+            return {'job_id': self.id,
+                    'status': self.status,
+                    'params': dict(self.params),
+                    'progress': {tag: dict(item) for tag, item in self.progress.items()},
+                    'elapsed': elapsed,
+                    'error': self.error}
+
+    def save(self):
+        if self.state_dir is not None:
+            state = self.to_dict()
+            atomic_write(_state_file(self.state_dir, self.id), lambda tmp_path: _write_json(tmp_path, state))
+
+
+class StoredJob:
+    """
+    a job started by another server process, read from its state file
+    """
+
+    def __init__(self, state, state_dir):
+        self.id = state['job_id']
+        self.state = state
+        self.state_dir = state_dir
+
+    def cancel(self):
+        if self.state['status'] in ('queued', 'running'):
+            open(_cancel_file(self.state_dir, self.id), 'w').close()
+
+    def to_dict(self):
+        return dict(self.state)
+
+
+def _state_file(state_dir, job_id):
+    return os.path.join(state_dir, "{}.json".format(job_id))
+
+
+def _cancel_file(state_dir, job_id):
+    return os.path.join(state_dir, "{}.cancel".format(job_id))
+
+
+def _write_json(path, state):
+    with open(path, 'w') as f:
+        json.dump(state, f)
+
+
+class TrainingJobs:
+    """
+    runs one training job at a time in a background thread
+
+    'on_start' and 'on_finish' are called with the job from the training
+    thread, e.g. to hold the served models and swap them in at the end
+
+    'state_dir' and 'lock_file' share the jobs between server processes:
+    the status of every job is written to state_dir and the TrainingLock on
+    lock_file lets one job run at a time across the processes
+    """
+
+    def __init__(self, on_start=None, on_finish=None, state_dir=None, lock_file=None):
+        self.jobs = {}
+        self.current = None
+        self.on_start = on_start
+        self.on_finish = on_finish
+        self.state_dir = state_dir
+        self.lock = None if lock_file is None else TrainingLock(lock_file)
+        self._lock = threading.Lock()
+        if state_dir is not None and not os.path.isdir(state_dir):
+            os.makedirs(state_dir, exist_ok=True)
+
+    def running(self):
+        job = self.current
+        if job is not None and job.status in ('queued', 'running'):
+            return True
+        return self.lock is not None and self.lock.held()
+
+    def running_id(self):
+        """
+        id of the running job, also when another process runs it
+        """
+
+        job = self.current
+        if job is not None and job.status in ('queued', 'running'):
+            return job.id
+        if self.lock is not None and self.lock.held():
+            return self.lock.owner()
+        return None
+
+    def submit(self, **params):
+        """
+        start model_train(**params) in the background
+
+        returns the new job or None when a job is already running
+        """
+
+        with self._lock:
+            if self.current is not None and self.current.status in ('queued', 'running'):
+                return None
+            job = TrainingJob(params, state_dir=self.state_dir)
+            if self.lock is not None and not self.lock.acquire(job.id):
+                return None
+            self.jobs[job.id] = job
+            self.current = job
+            job.save()
+
+        thread = threading.Thread(target=self._run, args=(job,))
+        thread.daemon = True
+        thread.start()
+        return job
+
+    def _run(self, job):
+        job.status = 'running'
+        job.started = time.time()
+        job.save()
+        try:
+            if self.on_start:
+                self.on_start(job)
+            model_train(job=job, **job.params)
+            job.status = 'done'
+        except TrainingCancelled:
+            print("... training job {} cancelled".format(job.id))
+            job.status = 'cancelled'
+        except Exception as e:
+            print("ERROR: training job {} failed: {}".format(job.id, e))
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job.finished = time.time()
+            job.save()
+            try:
+                if self.on_finish:
+                    self.on_finish(job)
+            finally:
+                if self.lock is not None:
+                    self.lock.release()
+
+    def get(self, job_id):
+        """
+        a job of this process, or the stored state of a job of another process
+        """
+
+        job = self.jobs.get(job_id)
+        if job is not None or self.state_dir is None:
+            return job
+        if not all(c in "0123456789abcdef" for c in job_id):
+            return None
+        state_file = _state_file(self.state_dir, job_id)
+        if not os.path.exists(state_file):
+            return None
+        with open(state_file) as f:
+            return StoredJob(json.load(f), self.state_dir)
+
+    def cancel(self, job_id):
+        """
+        ask a job to stop, it ends at the next chunk of fits
+        """
+
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel()
+        return job
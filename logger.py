@@ -2,69 +2,558 @@
 module with functions to enable logging
 """
 
+import atexit
 import csv
 import os
+import queue
+import re
+import threading
 import time
 import uuid
+import zlib
 from datetime import date
 
+import numpy as np
+import pandas as pd
+
+from metrics import timed
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 if not os.path.exists(os.path.join(".","logs")):
     os.mkdir("logs")
 
+TRAIN_HEADER = ['unique_id','timestamp','x_shape','eval_test','model_version',
+                'model_version_note','runtime']
+PREDICT_HEADER = ['unique_id','timestamp','country','y_pred','y_proba','query','model_version','runtime']
+
+# earlier predict logs wrote the country without a header column
+LEGACY_HEADERS = {'unique_id,timestamp,y_pred,y_proba,query,model_version,runtime': PREDICT_HEADER}
+
+# fixed-size prediction records, appended next to the csv log and queried by query_predict_log
+# 'country_id' and 'version_id' are the crc32 of the country name and of the model version
+# (filtered and grouped on instead of the names), 'model_version' is the model store version
+# of the served model (e.g. '0_1_20210101120000'), 'target' is the queried date in days since
+# 1970-01-01 and 'runtime' is in seconds
+RECORD_DTYPE = np.dtype([('timestamp', '<f8'),
+                         ('country_id', '<u4'),
+                         ('country', 'S32'),
+                         ('target', '<i4'),
+                         ('y_pred', '<f8'),
+                         ('version_id', '<u4'),
+                         ('model_version', 'S32'),
+                         ('runtime', '<f8')])
+
+
+def _logfile(kind, test=False, ext="log"):
+    """
+    name the logfile using something that cycles with date (day, month, year)
+    """
+
+    if test:
+        return os.path.join("logs", "{}-test.{}".format(kind, ext))
+    today = date.today()
+    return os.path.join("logs", "{}-{}-{}.{}".format(kind, today.year, today.month, ext))
+
+
+def _lock(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+def _unlock(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _upgrade_header(csvfile, header):
+    """
+    rewrite the header line of a log written with a legacy header
+    """
+
+    csvfile.seek(0)
+    first = csvfile.readline()
+    if LEGACY_HEADERS.get(first.strip()) != header:
+        return
+    rest = csvfile.read()
+    csvfile.seek(0)
+    csvfile.truncate()
+    csv.writer(csvfile, delimiter=',').writerow(header)
+    csvfile.write(rest)
+
+
+def _write_rows(logfile, header, rows):
+    """
+    append rows to a csv log under an exclusive lock
+
+    the header is written when the file is still empty (and a legacy header
+    is replaced), the lock keeps the rows of concurrent processes from interleaving
+    """
+
+    with open(logfile, 'a+', newline='') as csvfile:
+        _lock(csvfile)
+        try:
+            writer = csv.writer(csvfile, delimiter=',')
+            csvfile.seek(0, os.SEEK_END)
+            if csvfile.tell() == 0:
+                writer.writerow(header)
+            else:
+                _upgrade_header(csvfile, header)
+            writer.writerows(rows)
+            csvfile.flush()
+        finally:
+            _unlock(csvfile)
+
+
+def _write_records(recordfile, records):
+    """
+    append whole records to a binary log under an exclusive lock
+    """
+
+    with open(recordfile, 'ab') as f:
+        _lock(f)
+        try:
+            f.write(records.tobytes())
+            f.flush()
+        finally:
+            _unlock(f)
+
+
+class LogWriter:
+    """
+    queues log rows and appends them from a background thread
+
+    the rows are written per file in batches, when 'max_rows' are waiting or
+    every 'interval' seconds, so the request path only puts rows on a queue;
+    the queue and the thread are created lazily in each process (after a
+    fork the child starts its own) and flush() waits until the queued rows
+    are written
+    """
+
+    def __init__(self, max_rows=500, interval=1.0):
+        self.max_rows = max_rows
+        self.interval = interval
+        self._pid = None
+        self._queue = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            thread = threading.Thread(target=self._run, args=(self._queue,))
+            thread.daemon = True
+            thread.start()
+            self._pid = os.getpid()
+
+    def put(self, logfile, header, rows):
+        """
+        queue csv rows, or a RECORD_DTYPE array when header is None
+        """
+
+        self._start()
+        self._queue.put((logfile, header, rows))
+
+    @staticmethod
+    def _write(items):
+        by_file = {}
+        for logfile, header, rows in items:
+            by_file.setdefault(logfile, (header, []))[1].append(rows)
+        for logfile, (header, parts) in by_file.items():
+            n_rows = sum(len(part) for part in parts)
+            try:
+                with timed('log_write'):
+                    if header is None:
+                        _write_records(logfile, np.concatenate(parts))
+                    else:
+                        _write_rows(logfile, header, [row for part in parts for row in part])
+            except Exception as e:
+                print("ERROR: {} rows could not be written to {}: {}".format(n_rows, logfile, e))
+
+    def _run(self, log_queue):
+        while True:
+            items, flushed = [], []
+            deadline = time.time() + self.interval
+            item = log_queue.get()
+            while True:
+                # a flush() request writes the batch right away
+                if isinstance(item, threading.Event):
+                    flushed.append(item)
+                else:
+                    items.append(item)
+                timeout = deadline - time.time()
+                if flushed or len(items) >= self.max_rows or timeout <= 0:
+                    break
+                try:
+                    item = log_queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            self._write(items)
+            for done in flushed:
+                done.set()
+
+    def flush(self, timeout=10.0):
+        """
+        write every queued row before returning
+        """
+
+        if self._pid != os.getpid():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+
+_writer = LogWriter()
+atexit.register(_writer.flush)
+
+
+def flush_logs():
+    """
+    write the queued log rows to disk (e.g. before reading a log file)
+    """
+
+    _writer.flush()
+
 
 def update_train_log(tag, eval_test, runtime, MODEL_VERSION, MODEL_VERSION_NOTE, test=False):
     """
     update train log file
     """
 
-    # name the logfile using something that cycles with date (day, month, year)    
-    today = date.today()
-    if test:
-        logfile = os.path.join("logs", "train-test.log")
-    else:
-        logfile = os.path.join("logs", "train-{}-{}.log".format(today.year, today.month))
+    row = list(map(str, [uuid.uuid4(), time.time(), tag, eval_test,
+                         MODEL_VERSION, MODEL_VERSION_NOTE, runtime]))
+    _writer.put(_logfile("train", test), TRAIN_HEADER, [row])
+
+
+def format_runtime(seconds):
+    """
+    'hhh:mm:ss.sss' runtime of a duration in seconds, to the millisecond
+    """
+
+    m, s = divmod(round(seconds, 3), 60)
+    h, m = divmod(m, 60)
+    return "%03d:%02d:%06.3f"%(h, m, s)
+
+
+def _seconds(runtime):
+    """
+    seconds of a 'hhh:mm:ss' or 'hhh:mm:ss.sss' runtime
+    """
+
+    seconds = 0.0
+    for part in str(runtime).split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def _day(target_date):
+    try:
+        return int(np.datetime64(str(target_date), 'D').astype(np.int64))
+    except ValueError:
+        return np.iinfo(np.int32).min
+
 
-    # write the data to a csv file    
-    header = ['unique_id','timestamp','x_shape','eval_test','model_version',
-              'model_version_note','runtime']
-    write_header = False
-    if not os.path.exists(logfile):
-        write_header = True
-    with open(logfile, 'a') as csvfile:
-        writer = csv.writer(csvfile, delimiter=',')
-        if write_header:
-            writer.writerow(header)
+def _country_id(country):
+    return zlib.crc32(str(country).encode('utf-8'))
 
-        to_write = map(str, [uuid.uuid4(), time.time(), tag, eval_test,
-                             MODEL_VERSION, MODEL_VERSION_NOTE, runtime])
-        writer.writerow(to_write)
 
+def _version_id(version):
+    return zlib.crc32(str(version).encode('utf-8'))
 
-def update_predict_log(country, y_pred, y_proba, target_date, runtime, MODEL_VERSION, test=False):
+
+def _versions(entries, MODEL_VERSION):
+    """
+    the model version of every entry, 'MODEL_VERSION' is one version or a list of them
+    """
+
+    if isinstance(MODEL_VERSION, (list, tuple)):
+        if len(MODEL_VERSION) != len(entries):
+            raise Exception("ERROR (logger) - {} model versions for {} entries".format(len(MODEL_VERSION),
+                                                                                      len(entries)))
+        return [str(version) for version in MODEL_VERSION]
+    return [str(MODEL_VERSION)] * len(entries)
+
+
+def _records(entries, timestamp, versions, elapsed):
+    records = np.zeros(len(entries), dtype=RECORD_DTYPE)
+    records['timestamp'] = timestamp
+    records['runtime'] = elapsed
+    for record, (country, y_pred, y_proba, target_date), version in zip(records, entries, versions):
+        y_pred = np.asarray(y_pred, dtype=np.float64).ravel()
+        record['country_id'] = _country_id(country)
+        record['country'] = str(country).encode('utf-8')[:RECORD_DTYPE['country'].itemsize]
+        record['target'] = _day(target_date)
+        record['y_pred'] = y_pred[0] if y_pred.size > 0 else np.nan
+        record['version_id'] = _version_id(version)
+        record['model_version'] = version.encode('utf-8')[:RECORD_DTYPE['model_version'].itemsize]
+    return records
+
+
+def update_predict_log(country, y_pred, y_proba, target_date, runtime, MODEL_VERSION, test=False,
+                       elapsed=None):
     """
     update predict log file
+
+    'elapsed' is the runtime in seconds for the binary records (parsed from
+    'runtime' when it is not given)
+    """
+
+    update_predict_log_batch([(country, y_pred, y_proba, target_date)], runtime, MODEL_VERSION,
+                             test=test, elapsed=elapsed)
+
+
+def update_predict_log_batch(entries, runtime, MODEL_VERSION, test=False, elapsed=None):
+    """
+    update predict log file with many (country, y_pred, y_proba, target_date)
+    entries in a single write
+
+    'MODEL_VERSION' is the model version of every entry or a list with the
+    version of each entry (the countries may be served by different model
+    store versions)
+
+    every entry is also appended as a record to the binary log next to the csv
+    """
+
+    timestamp = time.time()
+    versions = _versions(entries, MODEL_VERSION)
+    rows = [list(map(str, [uuid.uuid4(), timestamp, country, y_pred, y_proba, target_date,
+                           version, runtime]))
+            for (country, y_pred, y_proba, target_date), version in zip(entries, versions)]
+    _writer.put(_logfile("predict", test), PREDICT_HEADER, rows)
+
+    if elapsed is None:
+        elapsed = _seconds(runtime)
+    _writer.put(_logfile("predict", test, ext="bin"), None,
+                _records(entries, timestamp, versions, elapsed))
+
+
+def read_predict_records(test=False, months=None):
+    """
+    memory-map the binary prediction records
+
+    'months' is an optional (first, last) pair of (year, month) tuples that
+    limits which monthly files are read
     """
 
-    # name the logfile using something that cycles with date (day, month, year)    
-    today = date.today()
     if test:
-        logfile = os.path.join("logs", "predict-test.log")
+        files = [os.path.join("logs", "predict-test.bin")]
     else:
-        logfile = os.path.join("logs", "predict-{}-{}.log".format(today.year, today.month))
+        files = []
+        pattern = re.compile(r"^predict-(\d{4})-(\d{1,2})\.bin$")
+        for f in sorted(os.listdir("logs")):
+            match = pattern.match(f)
+            if not match:
+                continue
+            month = (int(match.group(1)), int(match.group(2)))
+            if months is not None and not months[0] <= month <= months[1]:
+                continue
+            files.append(os.path.join("logs", f))
+
+    parts = []
+    for f in files:
+        if not os.path.exists(f):
+            continue
+        # a record that is still being appended is left out
+        n = os.path.getsize(f) // RECORD_DTYPE.itemsize
+        if n > 0:
+            parts.append(np.memmap(f, dtype=RECORD_DTYPE, mode='r', shape=(n,)))
+    return parts
+
+
+def _timestamp(day):
+    return float(np.datetime64(str(day), 'D').astype('datetime64[s]').astype(np.int64))
+
+
+def _month(day, shift):
+    month = np.datetime64(str(day), 'M') + np.timedelta64(shift, 'M')
+    year, month = str(month).split("-")
+    return int(year), int(month)
+
+
+# runtime percentiles are read from log-spaced buckets 1% wide (1 microsecond to ~3 hours)
+RUNTIME_BUCKET_BASE = 1.01
+RUNTIME_BUCKET_MIN = 1e-6
+RUNTIME_BUCKETS = 2400
+
+
+def _runtime_buckets(runtime):
+    scaled = np.maximum(runtime, RUNTIME_BUCKET_MIN) / RUNTIME_BUCKET_MIN
+    buckets = np.log(scaled) / np.log(RUNTIME_BUCKET_BASE)
+    return np.clip(buckets.astype(np.int64), 0, RUNTIME_BUCKETS - 1)
+
+
+def _percentiles(counts, q):
+    """
+    runtime (s) at the q percentiles of a bucket histogram, to the bucket width
+    """
+
+    rank = np.ceil(np.array(q) / 100.0 * counts.sum()).astype(np.int64)
+    found = np.searchsorted(np.cumsum(counts), np.maximum(rank, 1))
+    # the middle of each bucket in log space
+    return RUNTIME_BUCKET_MIN * RUNTIME_BUCKET_BASE ** (found + 0.5)
+
+
+def _summary(count, y_sum, y_count, runtime_sum, runtime_max, histogram):
+    if count == 0:
+        return {'count': 0, 'y_pred_mean': None, 'runtime_ms': None}
+    p50, p90, p99 = _percentiles(histogram, [50, 90, 99]) * 1000
+    return {'count': int(count),
+            'y_pred_mean': float(y_sum / y_count) if y_count > 0 else None,
+            'runtime_ms': {'mean': float(runtime_sum / count * 1000),
+                           'p50': float(p50),
+                           'p90': float(p90),
+                           'p99': float(p99),
+                           'max': float(runtime_max * 1000)}}
+
+
+ROLLUP_KEYS = ['day', 'country_id', 'version_id']
+_rollups = {}
+_rollups_lock = threading.Lock()
+
+
+def _rollup(records):
+    """
+    aggregate records per (UTC day, country, model version), with sparse runtime histograms
+    """
+
+    frame = pd.DataFrame({'day': (records['timestamp'] // 86400).astype(np.int64),
+                          'country_id': records['country_id'],
+                          'version_id': records['version_id'],
+                          'y_pred': records['y_pred'],
+                          'runtime': records['runtime']})
+    frame['y_count'] = frame['y_pred'].notna().astype(np.int64)
+    frame['y_sum'] = frame['y_pred'].fillna(0)
+    frame['bucket'] = _runtime_buckets(frame['runtime'].values)
+
+    groups = frame.groupby(ROLLUP_KEYS).agg(count=('runtime', 'size'),
+                                            y_sum=('y_sum', 'sum'),
+                                            y_count=('y_count', 'sum'),
+                                            runtime_sum=('runtime', 'sum'),
+                                            runtime_max=('runtime', 'max'))
+    histogram = frame.groupby(ROLLUP_KEYS + ['bucket']).size().rename('count')
+
+    names = {}
+    ids, first = np.unique(records['country_id'], return_index=True)
+    for country_id, k in zip(ids.tolist(), first):
+        names[country_id] = records['country'][k].decode('utf-8')
+    versions = {}
+    ids, first = np.unique(records['version_id'], return_index=True)
+    for version_id, k in zip(ids.tolist(), first):
+        versions[version_id] = records['model_version'][k].decode('utf-8')
+    return groups, histogram, names, versions
+
+
+def _merge_rollups(old, new):
+    if old is None:
+        return new
+    groups = pd.concat([old[0], new[0]])
+    groups = groups.groupby(level=ROLLUP_KEYS).agg({'count': 'sum', 'y_sum': 'sum', 'y_count': 'sum',
+                                                    'runtime_sum': 'sum', 'runtime_max': 'max'})
+    histogram = pd.concat([old[1], new[1]])
+    histogram = histogram.groupby(level=ROLLUP_KEYS + ['bucket']).sum()
+    names = dict(new[2])
+    names.update(old[2])
+    versions = dict(new[3])
+    versions.update(old[3])
+    return groups, histogram, names, versions
+
+
+def _file_rollup(path, records):
+    """
+    the rollup of a record file, only the records appended since the last call are aggregated
+    """
+
+    with _rollups_lock:
+        size, rollup = _rollups.get(path, (0, None))
+        if size > records.shape[0]:
+            # the file was replaced
+            size, rollup = 0, None
+        if size < records.shape[0]:
+            rollup = _merge_rollups(rollup, _rollup(records[size:]))
+            size = records.shape[0]
+            _rollups[path] = (size, rollup)
+        return rollup
+
+
+def query_predict_log(country=None, start=None, end=None, model_version=None, test=False):
+    """
+    aggregate the logged predictions
+
+    'country' is a country or a list of countries, 'start' and 'end' are
+    'YYYY-MM-DD' days (inclusive, UTC) when the predictions were made and
+    'model_version' keeps the predictions of one model store version
+    (e.g. '0_1_20210101120000')
+
+    returns the count, the mean y_pred and the runtime (ms) mean, max and
+    p50/p90/p99 (within 1%) overall and per country, and the model versions
+    that made the selected predictions
+
+    every record file is rolled up per (day, country, model version) once and
+    kept in memory, so a query only reads the records appended since the last one
+    """
+
+    # the monthly files are named in local time, one extra month on each side is read
+    months = None
+    if start is not None or end is not None:
+        months = (_month(start, -1) if start is not None else (0, 0),
+                  _month(end, 1) if end is not None else (9999, 12))
+
+    groups, histograms, names, versions = [], [], {}, {}
+    for records in read_predict_records(test=test, months=months):
+        rollup = _file_rollup(records.filename, records)
+        groups.append(rollup[0])
+        histograms.append(rollup[1])
+        names.update(rollup[2])
+        versions.update(rollup[3])
+
+    result = _summary(0, 0, 0, 0, 0, None)
+    result['countries'] = {}
+    result['model_versions'] = []
+    if not groups:
+        return result
+
+    groups = pd.concat(groups).reset_index()
+    histograms = pd.concat(histograms).reset_index()
+
+    def keep(frame):
+        mask = np.ones(frame.shape[0], dtype=bool)
+        if country is not None:
+            countries = [country] if isinstance(country, str) else list(country)
+            mask &= frame['country_id'].isin([_country_id(c) for c in countries]).values
+        if start is not None:
+            mask &= frame['day'].values >= _timestamp(start) // 86400
+        if end is not None:
+            mask &= frame['day'].values <= _timestamp(end) // 86400
+        if model_version is not None:
+            mask &= frame['version_id'].values == _version_id(model_version)
+        return frame[mask]
+
+    groups = keep(groups)
+    histograms = keep(histograms)
 
-    # write the data to a csv file    
-    header = ['unique_id','timestamp','y_pred','y_proba','query','model_version','runtime']
-    write_header = False
-    if not os.path.exists(logfile):
-        write_header = True
-    with open(logfile,'a') as csvfile:
-        writer = csv.writer(csvfile, delimiter=',')
-        if write_header:
-            writer.writerow(header)
+    def summary(selected, histogram):
+        counts = np.zeros(RUNTIME_BUCKETS, dtype=np.int64)
+        np.add.at(counts, histogram['bucket'].values, histogram['count'].values)
+        return _summary(selected['count'].sum(), selected['y_sum'].sum(), selected['y_count'].sum(),
+                        selected['runtime_sum'].sum(), selected['runtime_max'].max(), counts)
 
-        to_write = map(str, [uuid.uuid4(), time.time(), country, y_pred,y_proba, target_date,
-                             MODEL_VERSION, runtime])
-        writer.writerow(to_write)
+    result = summary(groups, histograms)
+    result['countries'] = {}
+    by_country = dict(list(histograms.groupby('country_id')))
+    for country_id, selected in sorted(groups.groupby('country_id'), key=lambda item: names[item[0]]):
+        result['countries'][names[country_id]] = summary(selected, by_country[country_id])
+    result['model_versions'] = sorted(versions[version_id] for version_id in groups['version_id'].unique())
+    if result['count'] > 0:
+        result['first_day'] = str(np.datetime64(int(groups['day'].min()), 'D'))
+        result['last_day'] = str(np.datetime64(int(groups['day'].max()), 'D'))
+    return result
 
 
 if __name__ == "__main__":
@@ -81,3 +570,4 @@ if __name__ == "__main__":
     # predict logger
     update_predict_log('united_kingdom', "[0]","2021-01-01",
                        "00:00:01", MODEL_VERSION, test=True)
+    flush_logs()
@@ -0,0 +1,279 @@
+"""
+latency histograms and counters in the Prometheus text format
+"""
+
+import functools
+import glob
+import json
+import os
+import threading
+import time
+
+# upper bounds (seconds) of the latency buckets, from 100 microseconds to 5 minutes
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+HELP = {'aavail_stage_seconds': ('histogram', "time spent in each stage of ingestion, training and prediction"),
+        'aavail_request_seconds': ('histogram', "time spent answering each API endpoint"),
+        'aavail_requests_total': ('counter', "answered API requests by endpoint and status"),
+        'aavail_response_cache_total': ('counter', "hits, misses, 304 answers and evictions of the /predict cache"),
+        'aavail_batches_total': ('counter', "micro-batches predicted for /predict"),
+        'aavail_batched_queries_total': ('counter', "/predict queries answered in micro-batches")}
+
+
+class Metrics:
+    """
+    the histograms and counters of one process
+
+    histograms and counters are keyed by name and labels, 'collectors' are
+    functions called at snapshot time that return more (name, labels, value)
+    counters, e.g. the counters kept by the response cache
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._histograms = {}
+        self._counters = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            k = 0
+            while k < len(self.buckets) and seconds > self.buckets[k]:
+                k += 1
+            histogram[0][k] += 1
+            histogram[1] += seconds
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def collect(self, collector):
+        self._collectors.append(collector)
+
+    def reset(self):
+        """
+        forget the observations, e.g. those a forked worker inherits from the master
+        """
+
+        with self._lock:
+            self._histograms = {}
+            self._counters = {}
+
+    def snapshot(self):
+        """
+        json friendly copy of every histogram and counter
+        """
+
+        with self._lock:
+            histograms = [[name, dict(labels), list(counts), total]
+                          for (name, labels), (counts, total) in self._histograms.items()]
+            counters = [[name, dict(labels), value] for (name, labels), value in self._counters.items()]
+        for collector in self._collectors:
+            counters.extend([name, dict(labels), value] for name, labels, value in collector())
+        return {'buckets': list(self.buckets), 'histograms': histograms, 'counters': counters}
+
+    def dump(self, metrics_dir):
+        """
+        write the snapshot to '<metrics_dir>/metrics-<pid>.json'
+        """
+
+        snapshot = self.snapshot()
+        if not os.path.isdir(metrics_dir):
+            os.makedirs(metrics_dir, exist_ok=True)
+        path = os.path.join(metrics_dir, "metrics-{}.json".format(os.getpid()))
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+
+    def share(self, metrics_dir, interval=1.0):
+        """
+        dump every 'interval' seconds from a background thread
+
+        the thread is started once per process, so the workers forked by
+        gunicorn each start their own on their first request
+        """
+
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        thread = threading.Thread(target=self._share, args=(metrics_dir, interval))
+        thread.daemon = True
+        thread.start()
+
+    def _share(self, metrics_dir, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.dump(metrics_dir)
+            except Exception as e:
+                print("ERROR: metrics could not be written to {}: {}".format(metrics_dir, e))
+
+
+def merge(snapshots):
+    """
+    add up the snapshots of several processes
+    """
+
+    histograms, counters = {}, {}
+    buckets = snapshots[0]['buckets'] if snapshots else list(BUCKETS)
+    for snapshot in snapshots:
+        for name, labels, counts, total in snapshot['histograms']:
+            key = (name, tuple(sorted(labels.items())))
+            if key not in histograms:
+                histograms[key] = [[0] * len(counts), 0.0]
+            histograms[key][0] = [a + b for a, b in zip(histograms[key][0], counts)]
+            histograms[key][1] += total
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(sorted(labels.items())))
+            counters[key] = counters.get(key, 0) + value
+    return {'buckets': buckets,
+            'histograms': [[name, dict(labels), counts, total] for (name, labels), (counts, total) in histograms.items()],
+            'counters': [[name, dict(labels), value] for (name, labels), value in counters.items()]}
+
+
+def _labels(labels, extra=None):
+    items = sorted(labels.items())
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                          for k, v in items) + "}"
+
+
+def render(snapshot):
+    """
+    the snapshot in the Prometheus text exposition format
+    """
+
+    lines = []
+    described = set()
+
+    def describe(name, default_kind):
+        if name not in described:
+            kind, text = HELP.get(name, (default_kind, name.replace("_", " ")))
+            lines.append("# HELP {} {}".format(name, text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            described.add(name)
+
+    buckets = snapshot['buckets']
+    for name, labels, counts, total in sorted(snapshot['histograms'], key=lambda h: (h[0], sorted(h[1].items()))):
+        describe(name, 'histogram')
+        cumulative = 0
+        for le, count in zip([repr(float(b)) for b in buckets] + ["+Inf"], counts):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(name, _labels(labels, ('le', le)), cumulative))
+        lines.append("{}_sum{} {}".format(name, _labels(labels), repr(float(total))))
+        lines.append("{}_count{} {}".format(name, _labels(labels), cumulative))
+
+    for name, labels, value in sorted(snapshot['counters'], key=lambda c: (c[0], sorted(c[1].items()))):
+        describe(name, 'counter')
+        lines.append("{}{} {}".format(name, _labels(labels), value))
+    return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+def observe(stage, seconds):
+    """
+    record the duration of one stage (fetch_ts, engineer_features, model_load, predict, log_write, fit)
+    """
+
+    METRICS.observe('aavail_stage_seconds', seconds, stage=stage)
+
+
+class timed:
+    """
+    time a stage as a context manager or as a function decorator
+
+        with timed('predict'):
+            ...
+
+        @timed('fetch_ts')
+        def fetch_ts(...):
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.elapsed = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self._start
+        observe(self.stage, self.elapsed)
+        return False
+
+    def __call__(self, function):
+        stage = self.stage
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return function(*args, **kwargs)
+        return wrapper
+
+
+def metrics_dir():
+    """
+    directory shared by the server processes, set by AAVAIL_METRICS_DIR (see gunicorn.conf.py)
+    """
+
+    return os.environ.get("AAVAIL_METRICS_DIR") or None
+
+
+def dump():
+    """
+    write the metrics of this process to the shared directory now
+    """
+
+    folder = metrics_dir()
+    if folder is not None:
+        METRICS.dump(folder)
+
+
+def share(interval=1.0):
+    """
+    keep the shared directory up to date with the metrics of this process
+    """
+
+    folder = metrics_dir()
+    if folder is not None:
+        METRICS.share(folder, interval)
+
+
+def exposition():
+    """
+    Prometheus text of this process, or of every server process when they share a directory
+
+    the snapshots of exited workers are kept so the counters never go down
+    """
+
+    folder = metrics_dir()
+    if folder is None:
+        return render(METRICS.snapshot())
+
+    METRICS.dump(folder)
+    snapshots = []
+    for path in sorted(glob.glob(os.path.join(folder, "metrics-*.json"))):
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return render(merge(snapshots))
@@ -1,39 +1,63 @@
+import json
 import os
 import re
+import threading
 import time
+from collections import defaultdict
+from collections.abc import Mapping
 from datetime import date
 from dateutil.relativedelta import relativedelta
 
 import joblib
+from joblib import Parallel, delayed
 import sys
 import numpy as np
 import pandas as pd
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
-from sklearn.model_selection import train_test_split, GridSearchCV
+from sklearn.model_selection import train_test_split, KFold, ParameterGrid, ParameterSampler
 from sklearn.preprocessing import StandardScaler, OneHotEncoder
 from sklearn.pipeline import Pipeline
 
 from data_ingestion import DataIngestion, DataProcessing
-from logger import update_predict_log, update_train_log
+from forest import ForestModel, export_forest
+from logger import flush_logs, format_runtime, update_predict_log, update_predict_log_batch, update_train_log
+from metrics import observe, timed
+from model_store import ModelStore, atomic_write
 
 # model specific variables (iterate the version and note with each change)
 MODEL_DIR = "models"
 MODEL_VERSION = 0.1
 MODEL_VERSION_NOTE = "learning model for time-series"
+EPOCH = date(1970, 1, 1)
 
-def _model_train(df,tag,test=False):
-    """
-    example funtion to train model
-    
-    The 'test' flag when set to 'True':
-        (1) subsets the data and serializes a test version
-        (2) specifies that the use of the 'test' log file 
+PARAM_GRID_RF = {
+    'rf__criterion': ['mse','mae'],
+    'rf__n_estimators': [10,15,20,25],
+    'rf__max_depth': [5,10,15]
+    }
+PARAM_DIST_RF = {
+    'rf__criterion': ['mse','mae'],
+    'rf__n_estimators': list(range(10,55,5)),
+    'rf__max_depth': list(range(3,21))
+    }
+CV_FOLDS = 5
 
+def _pipeline(params=None):
+    """
+    the scaler + random forest pipeline that is searched and served
     """
 
-    # start timer for runtime
-    time_start = time.time()
+    pipe_rf = Pipeline(steps=[('scaler', StandardScaler()),
+                              ('rf', RandomForestRegressor())])
+    if params:
+        pipe_rf.set_params(**params)
+    return(pipe_rf)
+
+def _train_split(df,test=False):
+    """
+    engineer the features of one country and split them for evaluation
+    """
 
     dp = DataProcessing()
     X,y,dates = dp.engineer_features(df)
@@ -50,57 +74,494 @@ def _model_train(df,tag,test=False):
     ## Perform a train-test split
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.25,
                                                         shuffle=True, random_state=42)
-    ## train a random forest model
-    param_grid_rf = {
-    'rf__criterion': ['mse','mae'],
-    'rf__n_estimators': [10,15,20,25],
-    'rf__max_depth': [5,10,15]
-    }
+    return(X, y, X_train, X_test, y_train, y_test)
 
-    pipe_rf = Pipeline(steps=[('scaler', StandardScaler()),
-                              ('rf', RandomForestRegressor())])
-    
-    grid = GridSearchCV(pipe_rf, param_grid=param_grid_rf, cv=5, n_jobs=-1)
-    grid.fit(X_train, y_train)
-    y_pred = grid.predict(X_test)
-    eval_rmse =  round(np.sqrt(mean_squared_error(y_test,y_pred)))
-    eval_mae =  mean_absolute_error(y_test, y_pred)
-    eval_r2_score = r2_score(y_test, y_pred)
+def _job_cost(n_rows, params):
+    """
+    relative cost of one fit, used to start the longest jobs first
+    """
 
-    ## retrain using all data
-    grid.fit(X, y)
+    return(n_rows * params['rf__n_estimators'])
 
-    model_name = re.sub("\.","_",str(MODEL_VERSION))
-    if test:
-        saved_model = os.path.join(MODEL_DIR,
-                                   "test-{}-{}.joblib".format(tag, model_name))
-        print("... saving test version of model: {}".format(saved_model))
-    else:
-        saved_model = os.path.join(MODEL_DIR,
-                                   "sl-{}-{}.joblib".format(tag,model_name))
-        print("... saving model: {}".format(saved_model))
+def _job_memory(n_rows, n_features, params):
+    """
+    rough peak bytes of one fit: a copy of the data plus the tree node arrays
+    """
+
+    nodes = min(2 * n_rows, 2 ** (params['rf__max_depth'] + 1))
+    return(8 * n_rows * (n_features + 1) + 80 * nodes * params['rf__n_estimators'])
+
+def _n_workers(n_jobs, max_memory, job_memory):
+    """
+    number of workers allowed by n_jobs and by max_memory (in MB)
+    """
+
+    if n_jobs is None:
+        n_jobs = 1
+    if n_jobs < 0:
+        n_jobs = max(1, joblib.cpu_count() + 1 + n_jobs)
+    if max_memory is not None and job_memory > 0:
+        n_jobs = min(n_jobs, int(max_memory * 1024 ** 2 // job_memory))
+    return(max(1, n_jobs))
+
+def _fit_score(X, y, train, test, params):
+    """
+    fit one cross-validation fold and return its r2 score and runtime
+    """
+
+    time_start = time.perf_counter()
+    pipe_rf = _pipeline(params)
+    pipe_rf.fit(X.iloc[train], y[train])
+    return(pipe_rf.score(X.iloc[test], y[test]), time.perf_counter()-time_start)
+
+def _fit_score_warm(X, y, train, test, params, steps):
+    """
+    grow one warm-started forest through the n_estimators steps and score each step
+    """
+
+    time_start = time.perf_counter()
+    pipe_rf = _pipeline(params)
+    pipe_rf.set_params(rf__warm_start=True)
+    scores = []
+    for n_estimators in steps:
+        pipe_rf.set_params(rf__n_estimators=n_estimators)
+        pipe_rf.fit(X.iloc[train], y[train])
+        scores.append(pipe_rf.score(X.iloc[test], y[test]))
+    return(scores, time.perf_counter()-time_start)
+
+def _fit(X, y, params):
+    """
+    fit one pipeline and return it with its runtime
+    """
+
+    time_start = time.perf_counter()
+    pipe_rf = _pipeline(params)
+    pipe_rf.fit(X, y)
+    return(pipe_rf, time.perf_counter()-time_start)
+
+def _run_jobs(parallel, calls, tags, job=None):
+    """
+    run the delayed calls on the pool
+
+    with a training job the calls run in chunks so the per-country progress
+    is reported and a cancel is noticed between chunks
+    """
+
+    if job is None:
+        return(parallel(calls))
+
+    results = []
+    chunk = 4 * max(1, parallel.n_jobs)
+    for start in range(0, len(calls), chunk):
+        job.check()
+        results.extend(parallel(calls[start:start+chunk]))
+        for tag in tags[start:start+chunk]:
+            job.fitted(tag)
+    return(results)
+
+def _cv_scores(parallel, splits, folds, candidates, runtimes, job=None):
+    """
+    score every candidate of every country on every fold in one pool
+
+    returns the (candidate x fold) scores and the number of fits per country
+    """
+
+    jobs = []
+    for tag, param_list in candidates.items():
+        for c, params in enumerate(param_list):
+            for f, (train, valid) in enumerate(folds[tag]):
+                jobs.append((_job_cost(train.size, params), tag, c, f))
+    jobs.sort(key=lambda item: -item[0])
+
+    results = _run_jobs(parallel, [delayed(_fit_score)(splits[tag][2], splits[tag][4],
+                                                       folds[tag][f][0], folds[tag][f][1], candidates[tag][c])
+                                   for _, tag, c, f in jobs],
+                        [tag for _, tag, _, _ in jobs], job=job)
+
+    scores = {tag: np.zeros((len(param_list), CV_FOLDS)) for tag, param_list in candidates.items()}
+    n_fits = defaultdict(int)
+    for (_, tag, c, f), (score, runtime) in zip(jobs, results):
+        scores[tag][c, f] = score
+        runtimes[tag] += runtime
+        # the fits run in the worker processes, their runtimes are recorded here
+        observe('fit', runtime)
+        n_fits[tag] += 1
+    return(scores, n_fits)
+
+def _cv_results(param_list, mean_scores):
+    """
+    json friendly list of the candidates and their mean cross-validation score
+    """
+
+    return([{'params': params, 'score': float(score)} for params, score in zip(param_list, mean_scores)])
 
+def _search_grid(parallel, splits, folds, runtimes, job=None, **kwargs):
+    """
+    exhaustive search over PARAM_GRID_RF
+    """
+
+    param_grid = list(ParameterGrid(PARAM_GRID_RF))
+    scores, n_fits = _cv_scores(parallel, splits, folds,
+                                {tag: param_grid for tag in splits}, runtimes, job=job)
+    best_params = {tag: param_grid[int(np.argmax(scores[tag].mean(axis=1)))] for tag in splits}
+    cv_results = {tag: _cv_results(param_grid, scores[tag].mean(axis=1)) for tag in splits}
+    return(best_params, n_fits, cv_results)
+
+def _search_halving(parallel, splits, folds, runtimes, factor=3, job=None, **kwargs):
+    """
+    successive halving over PARAM_GRID_RF
+
+    the resource is the number of trees: every round keeps the best 1/factor
+    of the candidates and grows their forests factor times larger, the last
+    round fits the full n_estimators (the series are too short for the
+    number of rows to be the expensive part)
+    """
+
+    param_grid = list(ParameterGrid(PARAM_GRID_RF))
+    candidates = {tag: param_grid for tag in splits}
+    n_fits = defaultdict(int)
+    cv_results = {}
+
+    n_rounds = int(np.ceil(np.log(len(param_grid)) / np.log(factor)))
+    for r in range(n_rounds):
+        fraction = float(factor) ** (r - n_rounds + 1)
+        reduced = {tag: [dict(params, rf__n_estimators=max(1, int(np.ceil(fraction * params['rf__n_estimators']))))
+                         for params in param_list]
+                   for tag, param_list in candidates.items()}
+        scores, fits = _cv_scores(parallel, splits, folds, reduced, runtimes, job=job)
+        for tag in splits:
+            n_fits[tag] += fits[tag]
+            cv_results[tag] = _cv_results(reduced[tag], scores[tag].mean(axis=1))
+            n_keep = int(np.ceil(len(candidates[tag]) / float(factor)))
+            order = np.argsort(-scores[tag].mean(axis=1), kind='mergesort')
+            candidates[tag] = [candidates[tag][c] for c in order[:n_keep]]
+
+    best_params = {tag: candidates[tag][0] for tag in splits}
+    return(best_params, n_fits, cv_results)
+
+def _search_random(parallel, splits, folds, runtimes, n_workers=1, time_budget=60, random_state=42,
+                   job=None, **kwargs):
+    """
+    randomized search over PARAM_DIST_RF until the time budget (in seconds) is spent
+
+    candidates are scored in rounds of n_workers per country, at least one round runs
+    """
+
+    samples = list(ParameterSampler(PARAM_DIST_RF, n_iter=len(ParameterGrid(PARAM_DIST_RF)),
+                                    random_state=random_state))
+    batch = max(n_workers, 2)
+    tried = {tag: [] for tag in splits}
+    scores = {tag: [] for tag in splits}
+    n_fits = defaultdict(int)
+
+    time_start = time.time()
+    for start in range(0, len(samples), batch):
+        candidates = {tag: samples[start:start+batch] for tag in splits}
+        batch_scores, fits = _cv_scores(parallel, splits, folds, candidates, runtimes, job=job)
+        for tag in splits:
+            tried[tag].extend(candidates[tag])
+            scores[tag].extend(batch_scores[tag].mean(axis=1))
+            n_fits[tag] += fits[tag]
+        if time.time() - time_start >= time_budget:
+            break
 
-    joblib.dump(grid, saved_model)
+    best_params = {tag: tried[tag][int(np.argmax(scores[tag]))] for tag in splits}
+    cv_results = {tag: _cv_results(tried[tag], scores[tag]) for tag in splits}
+    return(best_params, n_fits, cv_results)
 
-    m, s = divmod(time.time()-time_start, 60)
-    h, m = divmod(m, 60)
-    runtime = "%03d:%02d:%02d"%(h, m, s)
+def _search_warm(parallel, splits, folds, runtimes, job=None, **kwargs):
+    """
+    warm-started forests that grow through the n_estimators of PARAM_GRID_RF
+
+    one forest per (criterion, max_depth, fold) is scored after each growth step
+    """
+
+    steps = sorted(PARAM_GRID_RF['rf__n_estimators'])
+    bases = list(ParameterGrid({key: values for key, values in PARAM_GRID_RF.items()
+                                if key != 'rf__n_estimators'}))
+
+    jobs = []
+    for tag in splits:
+        for b, params in enumerate(bases):
+            for f, (train, valid) in enumerate(folds[tag]):
+                jobs.append((_job_cost(train.size, dict(params, rf__n_estimators=steps[-1])), tag, b, f))
+    jobs.sort(key=lambda item: -item[0])
+
+    results = _run_jobs(parallel, [delayed(_fit_score_warm)(splits[tag][2], splits[tag][4],
+                                                            folds[tag][f][0], folds[tag][f][1], bases[b], steps)
+                                   for _, tag, b, f in jobs],
+                        [tag for _, tag, _, _ in jobs], job=job)
+
+    scores = {tag: np.zeros((len(bases), len(steps), CV_FOLDS)) for tag in splits}
+    n_fits = defaultdict(int)
+    for (_, tag, b, f), (step_scores, runtime) in zip(jobs, results):
+        scores[tag][b, :, f] = step_scores
+        runtimes[tag] += runtime
+        observe('fit', runtime)
+        n_fits[tag] += len(steps)
+
+    best_params = {}
+    cv_results = {}
+    for tag in splits:
+        mean_scores = scores[tag].mean(axis=2)
+        b, s = np.unravel_index(np.argmax(mean_scores), (len(bases), len(steps)))
+        best_params[tag] = dict(bases[b], rf__n_estimators=steps[s])
+        cv_results[tag] = _cv_results([dict(params, rf__n_estimators=n_estimators)
+                                       for params in bases for n_estimators in steps],
+                                      mean_scores.ravel())
+    return(best_params, n_fits, cv_results)
+
+def _search_previous(parallel, splits, folds, runtimes, previous=None, job=None, **kwargs):
+    """
+    refit with the parameters chosen by the last search, without cross-validation
+
+    countries without saved parameters fall back to a grid search
+    """
+
+    previous = previous or {}
+    missing = {tag: split for tag, split in splits.items() if tag not in previous}
+    best_params, n_fits, cv_results = {}, defaultdict(int), {}
+    if missing:
+        print("... no previous parameters for {}, running a grid search".format(", ".join(sorted(missing))))
+        best_params, n_fits, cv_results = _search_grid(parallel, missing, folds, runtimes, job=job)
+
+    for tag in splits:
+        if tag in previous:
+            best_params[tag] = previous[tag]['params']
+            cv_results[tag] = previous[tag]['cv_results']
+    return(best_params, n_fits, cv_results)
+
+def _neighbourhood(params):
+    """
+    the previous parameters and their neighbours in n_estimators and max_depth
+    """
 
-    # update log
-    eval_metrics = {'rmse': eval_rmse, 'mae': eval_mae, 'r2_score': eval_r2_score}
-    print(eval_metrics)
-    update_train_log(tag,eval_metrics,runtime,
-                     MODEL_VERSION, MODEL_VERSION_NOTE, test=True)
+    n_estimators = params['rf__n_estimators']
+    max_depth = params['rf__max_depth']
+    return(list(ParameterGrid({'rf__criterion': [params['rf__criterion']],
+                               'rf__n_estimators': sorted(set([max(1, n_estimators - 5), n_estimators, n_estimators + 5])),
+                               'rf__max_depth': sorted(set([max(1, max_depth - 2), max_depth, max_depth + 2]))})))
+
+def _search_neighbourhood(parallel, splits, folds, runtimes, previous=None, job=None, **kwargs):
+    """
+    cross-validate only a small neighbourhood around the parameters of the last search
+
+    countries without saved parameters fall back to a grid search
+    """
+
+    previous = previous or {}
+    missing = {tag: split for tag, split in splits.items() if tag not in previous}
+    best_params, n_fits, cv_results = {}, defaultdict(int), {}
+    if missing:
+        print("... no previous parameters for {}, running a grid search".format(", ".join(sorted(missing))))
+        best_params, n_fits, cv_results = _search_grid(parallel, missing, folds, runtimes, job=job)
+
+    candidates = {tag: _neighbourhood(previous[tag]['params']) for tag in splits if tag in previous}
+    if candidates:
+        scores, fits = _cv_scores(parallel, splits, folds, candidates, runtimes, job=job)
+        for tag, param_list in candidates.items():
+            best_params[tag] = param_list[int(np.argmax(scores[tag].mean(axis=1)))]
+            n_fits[tag] += fits[tag]
+            cv_results[tag] = _cv_results(param_list, scores[tag].mean(axis=1))
+    return(best_params, n_fits, cv_results)
+
+SEARCH_STRATEGIES = {'grid': _search_grid,
+                     'halving': _search_halving,
+                     'random': _search_random,
+                     'warm': _search_warm,
+                     'previous': _search_previous,
+                     'neighbourhood': _search_neighbourhood}
+
+def _search_candidates(search, tag, previous):
+    """
+    every parameter set a search may fit for one country (sizes the workers under max_memory)
+    """
+
+    if search == 'random':
+        return(list(ParameterGrid(PARAM_DIST_RF)))
+    if search == 'previous' and tag in previous:
+        return([previous[tag]['params']])
+    if search == 'neighbourhood' and tag in previous:
+        return(_neighbourhood(previous[tag]['params']))
+    return(list(ParameterGrid(PARAM_GRID_RF)))
+
+def _model_store(test=False):
+    """
+    the store of the served ('sl') or the test ('test') models
+    """
+
+    return(ModelStore(MODEL_DIR, prefix='test' if test else 'sl'))
+
+def _model_path(tag, test=False):
+    """
+    file of the model served for a country (None before it is first saved)
+    """
+
+    current = _model_store(test=test).current()
+    if tag not in current:
+        return(None)
+    return(current[tag][1])
+
+def params_file(saved_model):
+    """
+    the json file next to a model with the parameters and scores of its search
+    """
+
+    return(re.sub(r"\.joblib$", ".params.json", saved_model))
+
+def save_params(saved_model, params):
+    """
+    save the chosen parameters and the cross-validation scores next to the model
+    """
+
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(params, f, indent=2)
+    atomic_write(params_file(saved_model), write)
+
+def load_params(saved_model):
+    """
+    load the parameters saved next to a model (None if there are none)
+    """
+
+    if saved_model is None:
+        return(None)
+    file_name = params_file(saved_model)
+    if not os.path.exists(file_name):
+        return(None)
+    with open(file_name) as f:
+        return(json.load(f))
+
+def _train_models(datasets,test=False,n_jobs=-1,max_memory=None,search='grid',time_budget=60,job=None,
+                  archive=False):
+    """
+    train one model per country from a single shared pool of jobs
 
+    'search' picks the hyperparameter search (see SEARCH_STRATEGIES), every
+    (country, candidate, fold) fit is a job and the jobs are ordered by
+    estimated cost so the longest start first, then the best parameters of
+    each country are refit on the train split (for evaluation) and on all data
 
-def model_train(data_dir, test=False):
+    'job' (optional) receives the per-country progress and can cancel the run
+    """
+
+    if search not in SEARCH_STRATEGIES:
+        raise Exception("unknown search '{}' (choose from {})".format(search, ", ".join(sorted(SEARCH_STRATEGIES))))
+
+    splits = {tag: _train_split(df,test=test) for tag, df in datasets.items()}
+    if job is not None:
+        job.countries(sorted(splits))
+    folds = {tag: list(KFold(n_splits=CV_FOLDS).split(split[2])) for tag, split in splits.items()}
+
+    # parameters and scores saved by the last search of each country
+    previous = {}
+    for tag in splits:
+        saved = load_params(_model_path(tag, test=test))
+        if saved is not None:
+            previous[tag] = saved
+
+    # the memory cap is sized by the largest fit the chosen search can run
+    job_memory = max([_job_memory(splits[tag][0].shape[0], splits[tag][0].shape[1], params)
+                      for tag in splits
+                      for params in _search_candidates(search, tag, previous)] + [0])
+    n_workers = _n_workers(n_jobs, max_memory, job_memory)
+    print("... {} search for {} models on {} workers".format(search, len(splits), n_workers))
+
+    runtimes = defaultdict(float)
+    with Parallel(n_jobs=n_workers) as parallel:
+        time_start = time.time()
+        best_params, n_fits, cv_results = SEARCH_STRATEGIES[search](parallel, splits, folds, runtimes,
+                                                                    n_workers=n_workers, time_budget=time_budget,
+                                                                    previous=previous, job=job)
+        search_time = time.time() - time_start
+
+        ## refit the best parameters on the train split and on all the data
+        refits = []
+        for tag, (X, y, X_train, X_test, y_train, y_test) in splits.items():
+            refits.append((_job_cost(X_train.shape[0], best_params[tag]), tag, 'train'))
+            refits.append((_job_cost(X.shape[0], best_params[tag]), tag, 'all'))
+        refits.sort(key=lambda refit: -refit[0])
+        if job is not None:
+            for tag in splits:
+                job.stage(tag, 'refitting')
+        fitted = _run_jobs(parallel, [delayed(_fit)(splits[tag][2] if part == 'train' else splits[tag][0],
+                                                    splits[tag][4] if part == 'train' else splits[tag][1],
+                                                    best_params[tag])
+                                      for _, tag, part in refits],
+                           [tag for _, tag, _ in refits], job=job)
+
+    models = defaultdict(dict)
+    for (_, tag, part), (pipe_rf, runtime) in zip(refits, fitted):
+        models[tag][part] = pipe_rf
+        runtimes[tag] += runtime
+        observe('fit', runtime)
+
+    # every run saves a new version, the files of the served one are never rewritten
+    store = _model_store(test=test)
+    model_name = store.new_version(re.sub("\.","_",str(MODEL_VERSION)), splits.keys())
+    for tag, (X, y, X_train, X_test, y_train, y_test) in splits.items():
+        y_pred = models[tag]['train'].predict(X_test)
+        eval_rmse =  round(np.sqrt(mean_squared_error(y_test,y_pred)))
+        eval_mae =  mean_absolute_error(y_test, y_pred)
+        eval_r2_score = r2_score(y_test, y_pred)
+
+        saved_model = store.path(tag, model_name)
+        if test:
+            print("... saving test version of model: {}".format(saved_model))
+        else:
+            print("... saving model: {}".format(saved_model))
+
+        # the parameters first, then the model (not served until every country is saved)
+        save_params(saved_model, {'search': search,
+                                  'params': best_params[tag],
+                                  'cv_results': cv_results.get(tag, [])})
+        store.save(tag, models[tag]['all'], model_name, select=False, archive=archive)
+
+        # runtime is the time spent fitting this country across the workers
+        runtime = format_runtime(runtimes[tag])
+
+        # update log
+        eval_metrics = {'rmse': eval_rmse, 'mae': eval_mae, 'r2_score': eval_r2_score,
+                        'search': search, 'n_fits': n_fits[tag], 'search_time': round(search_time, 2)}
+        print(eval_metrics)
+        update_train_log(tag,eval_metrics,runtime,
+                         MODEL_VERSION, MODEL_VERSION_NOTE, test=True)
+        if job is not None:
+            job.stage(tag, 'saved')
+
+    # one manifest write publishes the new version of every country at once
+    store.select_versions({tag: model_name for tag in splits})
+
+def _model_train(df,tag,test=False,n_jobs=-1,search='grid',time_budget=60):
+    """
+    example funtion to train model
+    
+    The 'test' flag when set to 'True':
+        (1) subsets the data and serializes a test version
+        (2) specifies that the use of the 'test' log file 
+
+    """
+
+    _train_models({tag: df},test=test,n_jobs=n_jobs,search=search,time_budget=time_budget)
+
+
+def model_train(data_dir, test=False, n_jobs=-1, max_memory=None, search='grid', time_budget=60, job=None,
+                archive=False):
     """
     function to train model given a df
     
     'mode' -  can be used to subset data essentially simulating a train
+    'n_jobs' - number of workers shared by every country (-1 uses all cores)
+    'max_memory' - cap in MB on the estimated memory of the running fits
+    'search' - 'grid', 'halving', 'random' (stops after time_budget seconds), 'warm',
+               'previous' or 'neighbourhood' (both reuse the parameters saved by the last search)
+    'job' - optional TrainingJob that follows the progress (see jobs.py)
+    'archive' - also keep a compressed copy of every model in models/archive
     """
 
+    if search not in SEARCH_STRATEGIES:
+        raise Exception("unknown search '{}' (choose from {})".format(search, ", ".join(sorted(SEARCH_STRATEGIES))))
+
     if not os.path.isdir(MODEL_DIR):
         os.mkdir(MODEL_DIR)
 
@@ -113,45 +574,212 @@ def model_train(data_dir, test=False):
     di = DataIngestion()
     ts_data = di.fetch_ts(data_dir)
 
-    # train a different model for each data sets
+    # train a different model for each data sets from one pool of jobs
+    datasets = {}
     for country, df in ts_data.items():
 
         if test and country not in ['all','united_kingdom']:
             continue
 
         if df.shape[0] > 0:
-            _model_train(df,country,test=test)
+            datasets[country] = df
+
+    try:
+        _train_models(datasets,test=test,n_jobs=n_jobs,max_memory=max_memory,
+                      search=search,time_budget=time_budget,job=job,archive=archive)
+    finally:
+        # the train log is complete on disk when model_train returns
+        flush_logs()
 
 
-def model_load(prefix='sl',data_dir=None,training=True):
+def model_files(prefix='sl'):
     """
-    example function to load model
-    
-    The prefix allows the loading of different models
+    map each country to the (version, path) of the model it is served with
+
+    the versions come from the manifest of the model store (or, without a
+    manifest, from files named '<prefix>-<country>-<version>.joblib')
     """
 
-    if not data_dir:
-        data_dir = os.path.join("data","cs-train")
-    
-    models = [f for f in os.listdir(os.path.join(".","models")) if re.search("sl",f)]
+    return(ModelStore(MODEL_DIR, prefix=prefix).current())
 
-    if len(models) == 0:
-        raise Exception("Models with prefix '{}' cannot be found did you train?".format(prefix))
+def _country_data(df, training=True):
+    """
+    clean one time-series and engineer its features
+    """
 
-    all_models = {}
-    for model in models:
-        all_models[re.split("-",model)[1]] = joblib.load(os.path.join(".","models",model))
+    df = clean_data(df)
+    dp = DataProcessing()
+    X,y,dates = dp.engineer_features(df,training=training)
+    dates = np.array([str(d) for d in dates])
+    data = {"X":X,"y":y,"dates": dates}
+    date_index(data)
+    return(data)
+
+def load_data(data_dir=None,training=True):
+    """
+    fetch the time-series and engineer the features for every country
+    """
+
+    if not data_dir:
+        data_dir = os.path.join("data","cs-train")
 
-    ## load data
     di = DataIngestion()
     ts_data = di.fetch_ts(data_dir)
     all_data = {}
     for country, df in ts_data.items():
-        df = clean_data(df)
-        dp = DataProcessing()
-        X,y,dates = dp.engineer_features(df,training=training)
-        dates = np.array([str(d) for d in dates])
-        all_data[country] = {"X":X,"y":y,"dates": dates}
+        all_data[country] = _country_data(df, training=training)
+
+    return(all_data)
+
+class LazyData(Mapping):
+    """
+    country -> {'X','y','dates','index'} engineered on first access and cached
+
+    the time-series are fetched (from the ts cache) the first time any
+    country or the list of countries is needed
+    """
+
+    def __init__(self, data_dir=None, training=True):
+        self.data_dir = data_dir or os.path.join("data","cs-train")
+        self.training = training
+        self._ts_data = None
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _series(self):
+        if self._ts_data is None:
+            with self._lock:
+                if self._ts_data is None:
+                    self._ts_data = DataIngestion().fetch_ts(self.data_dir)
+        return(self._ts_data)
+
+    def __getitem__(self, country):
+        if country not in self._cache:
+            df = self._series()[country]
+            with self._lock:
+                if country not in self._cache:
+                    self._cache[country] = _country_data(df, training=self.training)
+        return(self._cache[country])
+
+    def __contains__(self, country):
+        return(country in self._series())
+
+    def __iter__(self):
+        return(iter(self._series()))
+
+    def __len__(self):
+        return(len(self._series()))
+
+    def loaded(self):
+        return(sorted(self._cache))
+
+class LazyModels(Mapping):
+    """
+    country -> model read from the model store on first access and cached
+    """
+
+    def __init__(self, store, mmap_mode=None, compiled=False):
+        self.store = store
+        self.mmap_mode = mmap_mode
+        self.compiled = compiled
+        self._files = store.current()
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, country):
+        if country not in self._cache:
+            version, path = self._files[country]
+            with self._lock:
+                if country not in self._cache:
+                    model = self.store.open(path, mmap_mode=self.mmap_mode)
+                    self._cache[country] = compile_model(model) if self.compiled else model
+        return(self._cache[country])
+
+    def __contains__(self, country):
+        return(country in self._files)
+
+    def __iter__(self):
+        return(iter(self._files))
+
+    def __len__(self):
+        return(len(self._files))
+
+    def loaded(self):
+        return(sorted(self._cache))
+
+def compile_model(model):
+    """
+    export a fitted scaler + random forest pipeline (or its grid search) for serving
+
+    the scaler is folded into the split thresholds and the trees are flattened
+    into one node array, the returned ForestModel predicts a batch of rows
+    through all trees at once and gives the same values as the pipeline;
+    models of any other kind are returned unchanged
+    """
+
+    if isinstance(model, ForestModel) and model.meta.get('folded'):
+        return(model)
+    exported = export_forest(model)
+    if exported is None:
+        return(model)
+    return(ForestModel(*exported))
+
+def precompute_forecasts(all_data, all_models):
+    """
+    predict every (country, date) row once and keep the table in data['forecast']
+
+    the table remembers the model it was computed with so a changed model
+    falls back to live inference
+    """
+
+    for country, data in all_data.items():
+        if country in all_models and data['X'].shape[0] > 0:
+            model = all_models[country]
+            data['forecast'] = {'model': model, 'y_pred': model.predict(data['X'])}
+
+def forecast_table(data, model):
+    """
+    return the precomputed predictions for data if they were made by model
+    """
+
+    forecast = data.get('forecast')
+    if forecast is None or forecast['model'] is not model:
+        return(None)
+    if forecast['y_pred'].shape[0] != data['X'].shape[0]:
+        return(None)
+    return(forecast['y_pred'])
+
+def model_load(prefix='sl',data_dir=None,training=True,precompute=False,mmap_mode=None,preload=None,
+               compiled=False):
+    """
+    example function to load model
+    
+    The prefix allows the loading of different models
+    'precompute' predicts every date up front so predictions are table lookups
+    'mmap_mode' ('r') memory-maps the flat forest arrays instead of unpickling the pipelines
+    'compiled' serves the pickled pipelines through compile_model
+
+    both returned mappings are lazy: a country's model and features are only
+    loaded the first time it is accessed, 'preload' lists countries to load now
+    """
+
+    store = ModelStore(MODEL_DIR, prefix=prefix)
+    all_models = LazyModels(store, mmap_mode=mmap_mode, compiled=compiled)
+
+    if len(all_models) == 0:
+        raise Exception("Models with prefix '{}' cannot be found did you train?".format(prefix))
+
+    ## load data on demand
+    all_data = LazyData(data_dir=data_dir,training=training)
+
+    for country in preload or []:
+        if country in all_models:
+            all_models[country]
+        if country in all_data:
+            all_data[country]
+
+    if precompute:
+        precompute_forecasts(all_data, all_models)
         
     return(all_data, all_models)
 
@@ -163,11 +791,11 @@ def clean_data(df):
     
     # without negative revenue
     mask = revenue < 0
-    df.at[mask, 'revenue'] = np.nan
+    df.loc[mask, 'revenue'] = np.nan
 
     # without quantile range outliers
     mask = revenue.between(revenue.quantile(.0), revenue.quantile(0.85)) 
-    df.at[~mask, 'revenue'] = np.nan
+    df.loc[~mask, 'revenue'] = np.nan
 
     mask = revenue.notna()
     median = np.median(df[mask]['revenue'])
@@ -176,9 +804,33 @@ def clean_data(df):
     
     return(df)
 
-def model_predict(query, data=None, model=None, test=False):
+def query_date(year, month, day):
+    """
+    build the date of a query, raises on anything that is not a calendar date
+    """
+
+    try:
+        return(date(int(year), int(month), int(day)))
+    except (TypeError, ValueError):
+        raise Exception("ERROR (model_predict) - invalid year, month or day")
+
+def date_index(data):
+    """
+    map days since the epoch to the feature row of each date
+    built once per country and kept in data['index']
+    """
+
+    if 'index' not in data:
+        days = data['dates'].astype('datetime64[D]').astype(np.int64)
+        data['index'] = dict(zip(days.tolist(), range(days.size)))
+    return(data['index'])
+
+def model_predict(query, data=None, model=None, test=False, version=None):
     """
     example funtion to predict from model
+
+    'version' is the model store version of model, it is logged with the
+    prediction (MODEL_VERSION when it is not given)
     """
 
     country = query['country']
@@ -187,44 +839,162 @@ def model_predict(query, data=None, model=None, test=False):
     day = query['day']
 
     # start timer for runtime
-    time_start = time.time()
+    time_start = time.perf_counter()
 
-    for d in [year,month,day]:
-        if re.search("\D",d):
-            raise Exception("ERROR (model_predict) - invalid year, month or day")
+    target = query_date(year, month, day)
+    target_date = target.isoformat()
 
-    target_date = "{}-{}-{}".format(year,str(month).zfill(2),str(day).zfill(2))
-
-    if target_date not in data['dates']:
+    row = date_index(data).get((target - EPOCH).days)
+    if row is None:
         raise Exception("ERROR (model_predict) - date {} not in range {}-{}".format(target_date,
                                                                                     data['dates'][0],
                                                                                     data['dates'][-1]))
-    date_indx = np.where(data['dates'] == target_date)[0][0]
-    query = data['X'].iloc[[date_indx]]
+    query = data['X'].iloc[[row]]
     
     ## sainty check
     if data['dates'].shape[0] != data['X'].shape[0]:
         raise Exception("ERROR (model_predict) - dimensions mismatch")
 
-    ## make prediction and gather data for log entry
-    y_pred = model.predict(query)
-    y_proba = None
-    if 'predict_proba' in dir(model) and 'probability' in dir(model):
-        if model.probability == True:
-            y_proba = model.predict_proba(query)
+    ## make prediction (or read it from the forecast table) and gather data for log entry
+    with timed('predict'):
+        forecast = forecast_table(data, model)
+        y_proba = None
+        if forecast is not None:
+            y_pred = forecast[row:row+1]
+        else:
+            y_pred = model.predict(query)
+            if 'predict_proba' in dir(model) and 'probability' in dir(model):
+                if model.probability == True:
+                    y_proba = model.predict_proba(query)
 
 
-    m, s = divmod(time.time()-time_start, 60)
-    h, m = divmod(m, 60)
-    runtime = "%03d:%02d:%02d"%(h, m, s)
+    elapsed = time.perf_counter()-time_start
+    runtime = format_runtime(elapsed)
 
     # update predict log
     update_predict_log(country, y_pred, y_proba, target_date,
-                       runtime, MODEL_VERSION, test=test)
+                       runtime, MODEL_VERSION if version is None else version, test=test, elapsed=elapsed)
 
     return ({'y_pred':y_pred,'y_proba':y_proba})
 
 
+def _range_queries(query, all_data):
+    """
+    expand {'country', 'start', 'end'} into one query per available date
+    'country' may be a single country or a list of countries
+    """
+
+    countries = query['country']
+    if isinstance(countries, str):
+        countries = [countries]
+
+    start = np.datetime64(str(query['start']), 'D')
+    end = np.datetime64(str(query['end']), 'D')
+    if end < start:
+        raise Exception("ERROR (model_predict_batch) - end date {} before start date {}".format(end, start))
+
+    queries = []
+    for country in countries:
+        country = str(country)
+        if country not in all_data:
+            # keep one query so the missing country is reported
+            dates = np.array([start])
+        else:
+            dates = all_data[country]['dates'].astype('datetime64[D]')
+            dates = dates[(dates >= start) & (dates <= end)]
+        for day in dates.astype(str):
+            year, month, day = day.split("-")
+            queries.append({'country': country, 'year': year, 'month': month, 'day': day})
+
+    return(queries)
+
+def model_predict_batch(queries, all_data=None, all_models=None, test=False, versions=None):
+    """
+    predict many (country, date) queries in one call
+
+    queries is a list of {'country','year','month','day'} dicts or a date range
+    {'country','start','end'} where 'country' may be a list of countries
+    'versions' maps a country to the model store version of its model, it is
+    logged with the predictions (MODEL_VERSION for the countries not in it)
+
+    the queries are grouped by country and each model predicts once
+    returns one result per query (in order) with either 'y_pred' or 'ErrorMessage'
+    """
+
+    # start timer for runtime
+    time_start = time.perf_counter()
+
+    if isinstance(queries, dict):
+        queries = _range_queries(queries, all_data)
+
+    results = [None] * len(queries)
+    by_country = defaultdict(list)
+    for i, query in enumerate(queries):
+        country = str(query['country'])
+        try:
+            target = query_date(query['year'], query['month'], query['day'])
+        except Exception as e:
+            results[i] = {'country': country, 'ErrorMessage': str(e)}
+            continue
+        by_country[country].append((i, target))
+
+    entries = []
+    entry_versions = []
+    for country, items in by_country.items():
+        positions = [i for i, _ in items]
+        target_dates = [target.isoformat() for _, target in items]
+
+        if country not in all_models or country not in all_data:
+            for i, target_date in zip(positions, target_dates):
+                results[i] = {'country': country, 'date': target_date,
+                              'ErrorMessage': "ERROR (model_predict) - model for country '{}' could not be found".format(country)}
+            continue
+
+        data = all_data[country]
+        if data['dates'].shape[0] != data['X'].shape[0]:
+            raise Exception("ERROR (model_predict) - dimensions mismatch")
+
+        index = date_index(data)
+        rows = np.array([index.get((target - EPOCH).days, -1) for _, target in items])
+        found = rows >= 0
+        for k in np.flatnonzero(~found):
+            results[positions[k]] = {'country': country, 'date': target_dates[k],
+                                     'ErrorMessage': "ERROR (model_predict) - date {} not in range {}-{}".format(
+                                         target_dates[k], data['dates'][0], data['dates'][-1])}
+        if not found.any():
+            continue
+
+        ## one vectorized prediction per model (or a read from its forecast table)
+        model = all_models[country]
+        with timed('predict'):
+            forecast = forecast_table(data, model)
+            y_proba = None
+            if forecast is not None:
+                y_pred = forecast[rows[found]]
+            else:
+                X = data['X'].iloc[rows[found]]
+                y_pred = model.predict(X)
+                if 'predict_proba' in dir(model) and 'probability' in dir(model):
+                    if model.probability == True:
+                        y_proba = model.predict_proba(X)
+
+        for j, k in enumerate(np.flatnonzero(found)):
+            proba = None if y_proba is None else y_proba[j:j+1]
+            results[positions[k]] = {'country': country, 'date': target_dates[k],
+                                     'y_pred': y_pred[j:j+1], 'y_proba': proba}
+            entries.append((country, y_pred[j:j+1], proba, target_dates[k]))
+            entry_versions.append((versions or {}).get(country, MODEL_VERSION))
+
+    elapsed = time.perf_counter()-time_start
+    runtime = format_runtime(elapsed)
+
+    # update predict log with every entry at once
+    if entries:
+        update_predict_log_batch(entries, runtime, entry_versions, test=test, elapsed=elapsed)
+
+    return(results)
+
+
 if __name__ == "__main__":
 
     """
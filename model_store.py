@@ -0,0 +1,324 @@
+"""
+versioned model store with atomic writes and a manifest per prefix
+"""
+
+import json
+import os
+import re
+import threading
+import time
+
+import joblib
+
+from forest import ForestModel, export_forest, save_meta, save_nodes
+from metrics import timed
+
+
+def version_key(version):
+    """
+    sort key of a version string such as '0_1'
+    """
+
+    return tuple(int(v) for v in version.split("_"))
+
+
+def atomic_write(path, write):
+    """
+    call write(tmp_path) and rename the temporary file over path
+
+    readers either see the old file or the complete new one, never a partial write
+    """
+
+    folder, name = os.path.split(path)
+    tmp_path = os.path.join(folder, ".{}.tmp-{}".format(name, os.getpid()))
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class ModelStore:
+    """
+    the saved models of one prefix ('sl' or 'test') in model_dir
+
+    '<prefix>-manifest.json' lists the saved versions of every country and
+    the version that is served, e.g.
+        {"countries": {"all": {"current": "0_1",
+                               "versions": {"0_1": {"file": "sl-all-0_1.joblib", "saved": 1600000000.0}}}}}
+
+    directories without a manifest fall back to the '<prefix>-<country>-<version>.joblib'
+    file names and serve the highest version of each country
+
+    every training run saves a new version ('<MODEL_VERSION>_<UTC time>', see
+    new_version) so the files of the served and older versions are never
+    rewritten; old versions are kept until prune() removes them
+
+    next to each model the forest is also written as flat node arrays
+    ('.forest.npy' + '.forest.json', see forest.py) that open() memory-maps,
+    so the processes serving the same file share one copy of the trees
+    """
+
+    def __init__(self, model_dir="models", prefix='sl'):
+        self.model_dir = model_dir
+        self.prefix = prefix
+        self.manifest_path = os.path.join(model_dir, "{}-manifest.json".format(prefix))
+        self._lock = threading.Lock()
+
+    def path(self, tag, version):
+        return os.path.join(self.model_dir, "{}-{}-{}.joblib".format(self.prefix, tag, version))
+
+    @staticmethod
+    def forest_files(path):
+        base = re.sub(r"\.joblib$", "", path)
+        return base + ".forest.npy", base + ".forest.json"
+
+    def _write_forest(self, path, model):
+        """
+        write (or remove a stale) flat copy of the forest of the model at path
+        """
+
+        nodes_file, meta_file = self.forest_files(path)
+        exported = export_forest(model)
+        if exported is None:
+            for f in [nodes_file, meta_file]:
+                if os.path.exists(f):
+                    os.remove(f)
+            return False
+
+        nodes, meta = exported
+        atomic_write(nodes_file, lambda tmp_path: save_nodes(nodes, tmp_path))
+        atomic_write(meta_file, lambda tmp_path: save_meta(meta, tmp_path))
+        return True
+
+    def _archive(self, tag, version, model):
+        """
+        keep a compressed copy of every saved model in model_dir/archive
+        """
+
+        archive_dir = os.path.join(self.model_dir, "archive")
+        if not os.path.isdir(archive_dir):
+            os.mkdir(archive_dir)
+        path = os.path.join(archive_dir, "{}-{}-{}-{}.joblib.z".format(self.prefix, tag, version,
+                                                                       time.strftime("%Y%m%d%H%M%S")))
+        atomic_write(path, lambda tmp_path: joblib.dump(model, tmp_path, compress=('zlib', 3)))
+        return path
+
+    def _scan(self):
+        """
+        build a manifest from the file names
+        """
+
+        countries = {}
+        if not os.path.isdir(self.model_dir):
+            return {'countries': countries}
+
+        pattern = re.compile(r"^{}-(.+)-(\d+(?:_\d+)*)\.joblib$".format(re.escape(self.prefix)))
+        for f in sorted(os.listdir(self.model_dir)):
+            match = pattern.match(f)
+            if not match:
+                continue
+            country, version = match.groups()
+            entry = countries.setdefault(country, {'current': version, 'versions': {}})
+            entry['versions'][version] = {'file': f, 'saved': os.path.getmtime(os.path.join(self.model_dir, f))}
+            if version_key(version) > version_key(entry['current']):
+                entry['current'] = version
+
+        return {'countries': countries}
+
+    def read_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return self._scan()
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest):
+        def write(tmp_path):
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+        atomic_write(self.manifest_path, write)
+
+    def current(self):
+        """
+        map each country to the (version, path) it is served with
+        """
+
+        found = {}
+        for country, entry in self.read_manifest()['countries'].items():
+            version = entry['current']
+            if version is None or version not in entry['versions']:
+                continue
+            path = os.path.join(self.model_dir, entry['versions'][version]['file'])
+            if os.path.exists(path):
+                found[country] = (version, path)
+        return found
+
+    def versions(self, tag):
+        """
+        the saved versions of a country, oldest first
+        """
+
+        entry = self.read_manifest()['countries'].get(tag, {'versions': {}})
+        return sorted(entry['versions'], key=version_key)
+
+    def new_version(self, base, tags=()):
+        """
+        a version id no saved model of the tags uses yet: base + '_' + the UTC time
+
+        e.g. '0_1_20200101120000' (a counter is added when it is taken); ids
+        sort after the plain base and in the order they were made
+        """
+
+        version = "{}_{}".format(base, time.strftime("%Y%m%d%H%M%S", time.gmtime()))
+        taken = set()
+        for tag in tags:
+            taken.update(self.versions(tag))
+        candidate, n = version, 0
+        while candidate in taken:
+            n += 1
+            candidate = "{}_{}".format(version, n)
+        return candidate
+
+    def save(self, tag, model, version, select=True, archive=False):
+        """
+        write the model atomically and record it in the manifest
+
+        with select=True the new version is served from the next reload
+        with archive=True a compressed copy is also kept in model_dir/archive
+        """
+
+        path = self.path(tag, version)
+        with self._lock:
+            if not os.path.isdir(self.model_dir):
+                os.mkdir(self.model_dir)
+            # the model is saved uncompressed, then its forest arrays, the manifest last
+            atomic_write(path, lambda tmp_path: joblib.dump(model, tmp_path))
+            forest = self._write_forest(path, model)
+            if archive:
+                self._archive(tag, version, model)
+
+            manifest = self.read_manifest()
+            entry = manifest['countries'].setdefault(tag, {'current': None, 'versions': {}})
+            entry['versions'][version] = {'file': os.path.basename(path), 'saved': time.time(),
+                                          'forest': forest}
+            if select or entry['current'] is None:
+                entry['current'] = version
+            self._write_manifest(manifest)
+        return path
+
+    def select(self, tag, version):
+        """
+        serve another saved version of a country (hot swap or roll back)
+        """
+
+        self.select_versions({tag: version})
+
+    def select_versions(self, versions):
+        """
+        serve the {country: version} versions from one manifest write, so
+        readers see either all of them or none
+        """
+
+        with self._lock:
+            manifest = self.read_manifest()
+            for tag, version in versions.items():
+                entry = manifest['countries'].get(tag)
+                if entry is None or version not in entry['versions']:
+                    raise Exception("version {} of model '{}' cannot be found".format(version, tag))
+            for tag, version in versions.items():
+                manifest['countries'][tag]['current'] = version
+            self._write_manifest(manifest)
+
+    def prune(self, tag, keep=1):
+        """
+        delete all but the 'keep' newest versions of a country (never the served one)
+
+        returns the versions that were removed
+        """
+
+        with self._lock:
+            manifest = self.read_manifest()
+            entry = manifest['countries'].get(tag)
+            if entry is None:
+                return []
+            versions = sorted(entry['versions'], key=version_key)
+            kept = set(versions[-keep:] if keep > 0 else []) | {entry['current']}
+            removed = [v for v in versions if v not in kept]
+            for version in removed:
+                path = os.path.join(self.model_dir, entry['versions'].pop(version)['file'])
+                base = re.sub(r"\.joblib$", "", path)
+                for f in [path, base + ".params.json"] + list(self.forest_files(path)):
+                    if os.path.exists(f):
+                        os.remove(f)
+            if removed:
+                self._write_manifest(manifest)
+        return removed
+
+    @timed('model_load')
+    def open(self, path, mmap_mode=None):
+        """
+        open the model saved at path
+
+        with mmap_mode ('r') the memory-mapped forest arrays are used when they
+        are at least as recent as the model, otherwise the pickled pipeline
+        """
+
+        if mmap_mode is not None:
+            nodes_file, meta_file = self.forest_files(path)
+            if os.path.exists(nodes_file) and os.path.exists(meta_file):
+                if min(os.path.getmtime(nodes_file), os.path.getmtime(meta_file)) >= os.path.getmtime(path):
+                    try:
+                        return ForestModel.load(nodes_file, meta_file, mmap_mode=mmap_mode)
+                    except Exception as e:
+                        # e.g. exported in an older format, 'python model_store.py' rewrites them
+                        print("... {}, loading {}".format(e, path))
+        return joblib.load(path)
+
+    def load(self, tag, version=None, mmap_mode=None):
+        """
+        load one model (the served version by default)
+        """
+
+        if version is None:
+            current = self.current()
+            if tag not in current:
+                raise Exception("model '{}' cannot be found".format(tag))
+            version, path = current[tag]
+        else:
+            path = self.path(tag, version)
+        return self.open(path, mmap_mode=mmap_mode)
+
+    def export_forests(self):
+        """
+        write the forest arrays of the served models that were saved without them
+        """
+
+        for country, (version, path) in sorted(self.current().items()):
+            if self._write_forest(path, joblib.load(path)):
+                print("... exported forest of {}".format(path))
+            else:
+                print("... {} has no random forest to export".format(path))
+
+
+if __name__ == "__main__":
+
+    """
+    basic procedure: export the forest arrays of the served models
+    with --prune N, only keep the N newest versions of every model
+    """
+
+    import argparse
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-p", "--prefix", default='sl', help="'sl' or 'test' models")
+    ap.add_argument("--prune", type=int, help="delete all but the N newest versions")
+    args = vars(ap.parse_args())
+
+    store = ModelStore(prefix=args["prefix"])
+    if args["prune"] is not None:
+        for country in sorted(store.read_manifest()['countries']):
+            for version in store.prune(country, keep=args["prune"]):
+                print("... removed version {} of {}".format(version, country))
+    else:
+        store.export_forests()
@@ -0,0 +1,220 @@
+"""
+process-wide registry of the served models and engineered features
+"""
+
+import hashlib
+import os
+import re
+import threading
+import time
+
+from model import MODEL_DIR, LazyData, compile_model, precompute_forecasts
+from model_store import ModelStore
+
+
+class ModelRegistry:
+    """
+    keeps the models and the engineered features in memory
+
+    entries are keyed by (country, model version) and are only reloaded
+    when the model store manifest, the model files or the data files on
+    disk change; a model and its features are only loaded the first time
+    its country is requested ('preload' lists countries to load up front)
+    and unchanged models are kept across reloads
+
+    with precompute=True every date is predicted when the models are
+    loaded and /predict reads from that table
+
+    with mmap_mode='r' (the default) the forests are memory-mapped from the
+    flat arrays of the model store when they exist, with compiled=True (the
+    default) pickled pipelines are served through model.compile_model
+
+    'version' is a short hash of the files of the last load, it changes
+    whenever a model or a data file does
+    """
+
+    def __init__(self, data_dir, prefix='sl', check_interval=1.0, precompute=False, mmap_mode='r',
+                 preload=None, compiled=True):
+        self.data_dir = data_dir
+        self.prefix = prefix
+        self.store = ModelStore(MODEL_DIR, prefix=prefix)
+        self.check_interval = check_interval
+        self.precompute = precompute
+        self.mmap_mode = mmap_mode
+        self.preload = list(preload or [])
+        self.compiled = compiled
+        self.held = False
+        self.fingerprint = None
+        self.version = None
+        self.entries = {}
+        self.current = {}
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self._model_lock = threading.Lock()
+
+    def _fingerprint(self):
+        """
+        size and mtime of every file a reload depends on
+
+        only the source files of the data are included (the invoice json files
+        and the ts-<country>.csv seed), the ts cache that fetch_ts writes next
+        to them on first use is not a change
+        """
+
+        paths = [self.store.manifest_path]
+        paths.extend(path for _, path in sorted(self.store.current().values()))
+        for folder, pattern in [(self.data_dir, r"\.json"),
+                                (os.path.join(self.data_dir, "ts-data"), r"^ts-.+\.csv$")]:
+            if os.path.isdir(folder):
+                paths.extend(os.path.join(folder, f) for f in sorted(os.listdir(folder)) if re.search(pattern, f))
+
+        stats = []
+        for path in paths:
+            if os.path.isfile(path):
+                st = os.stat(path)
+                stats.append((path, st.st_size, st.st_mtime_ns))
+        return tuple(stats)
+
+    def load(self, force=True):
+        """
+        (re)load the feature matrices and the served model versions
+
+        the models themselves are read on first use (all at once with precompute)
+        """
+
+        with self._lock:
+            fingerprint = self._fingerprint()
+            if not force and fingerprint == self.fingerprint:
+                # another thread already reloaded while we were waiting
+                return
+            models = self.store.current()
+            if len(models) == 0:
+                raise Exception("Models with prefix '{}' cannot be found did you train?".format(self.prefix))
+
+            all_data = LazyData(data_dir=self.data_dir)
+            entries = {}
+            for country, (version, path) in models.items():
+                st = os.stat(path)
+                stamp = (path, st.st_size, st.st_mtime_ns)
+                previous = self.entries.get((country, version))
+                model = None
+                if previous is not None and previous['stamp'] == stamp:
+                    model = previous['model']
+                entries[(country, version)] = {'model': model,
+                                               'data': None,
+                                               'version': version,
+                                               'path': path,
+                                               'stamp': stamp,
+                                               'country': country,
+                                               'source': all_data,
+                                               'loaded': False}
+
+            for (country, _), entry in entries.items():
+                if self.precompute or country in self.preload:
+                    self._load_entry(entry)
+
+            if self.precompute:
+                precompute_forecasts({country: entry['data'] for (country, _), entry in entries.items()
+                                      if entry['data'] is not None},
+                                     {country: entry['model'] for (country, _), entry in entries.items()})
+
+            # swap the new state in one go so readers never see a partial load
+            self.entries = entries
+            self.current = {country: entries[(country, version)]
+                            for country, (version, _) in models.items()}
+            self.fingerprint = fingerprint
+            self.version = hashlib.sha1(repr(fingerprint).encode('utf-8')).hexdigest()[:16]
+            self._checked = time.time()
+
+    def changed(self):
+        """
+        True when the files on disk differ from the loaded state
+        """
+
+        return self.fingerprint is None or self._fingerprint() != self.fingerprint
+
+    def refresh(self, force=False):
+        """
+        reload if the files on disk changed since the last load
+        """
+
+        if self.held:
+            return False
+
+        now = time.time()
+        if not force and self.fingerprint is not None and now - self._checked < self.check_interval:
+            return False
+
+        self._checked = now
+        if self.fingerprint is not None and self._fingerprint() == self.fingerprint:
+            return False
+
+        self.load(force=False)
+        return True
+
+    def _load_entry(self, entry):
+        """
+        read the model and engineer the features of an entry the first time it is needed
+        """
+
+        if not entry['loaded']:
+            with self._model_lock:
+                if entry['model'] is None:
+                    model = self.store.open(entry['path'], mmap_mode=self.mmap_mode)
+                    entry['model'] = compile_model(model) if self.compiled else model
+                if not entry['loaded']:
+                    source = entry['source']
+                    if entry['country'] in source:
+                        entry['data'] = source[entry['country']]
+                    entry['loaded'] = True
+        return entry
+
+    def hold(self):
+        """
+        keep serving the current models while a retrain saves new ones
+
+        every entry is pinned to the file of the version served at the last
+        load, a retrain saves new versions next to it (see ModelStore) so the
+        countries not loaded yet are still read from the versions the others
+        are served from; release() swaps the new versions in
+        """
+
+        self.held = True
+
+    def release(self, reload=True):
+        """
+        stop holding and swap in whatever is on disk in one go
+        """
+
+        self.held = False
+        if reload:
+            self.load()
+
+    def countries(self):
+        return sorted(self.current.keys())
+
+    def get(self, country):
+        """
+        return the entry ({'model','data','version'}) served for a country
+        """
+
+        self.refresh()
+        entry = self.current.get(country)
+        if entry is not None:
+            self._load_entry(entry)
+        return entry
+
+    def snapshot(self):
+        """
+        return (all_data, all_models, versions) for every served country
+        """
+
+        self.refresh()
+        current = self.current
+        for entry in current.values():
+            self._load_entry(entry)
+        all_data = {country: entry['data'] for country, entry in current.items()
+                    if entry['data'] is not None}
+        all_models = {country: entry['model'] for country, entry in current.items()}
+        versions = {country: entry['version'] for country, entry in current.items()}
+        return all_data, all_models, versions
@@ -0,0 +1,61 @@
+import os
+import time
+
+import numpy as np
+
+from model import model_load, model_predict
+from registry import ModelRegistry
+
+
+def summarize(label, timings):
+    timings = np.array(timings) * 1000.0
+    print("{:<28} mean {:9.2f} ms   p50 {:9.2f} ms   p95 {:9.2f} ms".format(
+        label, timings.mean(), np.percentile(timings, 50), np.percentile(timings, 95)))
+
+
+def main(n_requests=20):
+    production_data_dir = os.path.join("data", "cs-production")
+    query = {'country': 'all',
+             'year': '2019',
+             'month': '11',
+             'day': '30'
+            }
+    country = query['country']
+
+    # before: every request reloads the models and re-engineers the features
+    before = []
+    for _ in range(n_requests):
+        time_start = time.time()
+        all_data, all_models = model_load(data_dir=production_data_dir)
+        model_predict(query, data=all_data[country], model=all_models[country], test=True)
+        before.append(time.time() - time_start)
+
+    # after: the registry is loaded once and every request is a lookup
+    registry = ModelRegistry(data_dir=production_data_dir)
+    registry.load()
+    after = []
+    for _ in range(n_requests):
+        time_start = time.time()
+        entry = registry.get(country)
+        model_predict(query, data=entry['data'], model=entry['model'], test=True)
+        after.append(time.time() - time_start)
+
+    # table: every date is predicted once when the registry loads
+    registry = ModelRegistry(data_dir=production_data_dir, precompute=True)
+    registry.load()
+    table = []
+    for _ in range(n_requests):
+        time_start = time.time()
+        entry = registry.get(country)
+        model_predict(query, data=entry['data'], model=entry['model'], test=True)
+        table.append(time.time() - time_start)
+
+    print("PER-REQUEST LATENCY ({} requests)".format(n_requests))
+    summarize("reload per request", before)
+    summarize("registry lookup", after)
+    summarize("precomputed forecast table", table)
+
+
+if __name__ == "__main__":
+
+    main()
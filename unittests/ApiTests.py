@@ -16,11 +16,15 @@ curl --header "Content-Type: application/json" --request POST --data '{"country"
 
 import os
 import re
+import sys
+import time
 import unittest
 from ast import literal_eval
 
 import requests
 
+sys.path.insert(1, os.path.join('..', os.getcwd()))
+
 port = 8080
 
 try:
@@ -44,8 +48,17 @@ class ApiTest(unittest.TestCase):
 
         request_json = {'mode':'test'}
         r = requests.post('http://127.0.0.1:{}/train'.format(port), json=request_json)
-        train_complete = re.sub("\W+", "", r.text)
-        self.assertEqual(train_complete, 'true')
+        job = r.json()
+        self.assertTrue('job_id' in job)
+
+        # training runs in the background, poll until the job ends
+        for _ in range(600):
+            job = requests.get('http://127.0.0.1:{}/train/{}'.format(port, job['job_id'])).json()
+            if job['status'] not in ['queued', 'running']:
+                break
+            time.sleep(1)
+        self.assertEqual(job['status'], 'done')
+        self.assertTrue(all(item['status'] == 'saved' for item in job['progress'].values()))
 
     @unittest.skipUnless(server_available, "local server is not running")
     def test_02_predict_empty(self):
@@ -79,6 +92,88 @@ class ApiTest(unittest.TestCase):
         if os.path.exists(file_name):
             os.remove(file_name)
 
+    @unittest.skipUnless(server_available,"local server is not running")
+    def test_04_predict_batch(self):
+        """
+        test the batch predict functionality
+        """
+
+        query = {'country': 'all', 'year': '2019', 'month': '11', 'day': '30'}
+        r = requests.post('http://127.0.0.1:{}/predict/batch'.format(port),
+                          json={'queries': [query, query], 'mode': 'test'})
+        response = literal_eval(r.text.replace('null', 'None'))
+        self.assertEqual(len(response), 2)
+        self.assertTrue(response[0]['y_pred'][0] > 0)
+
+        r = requests.post('http://127.0.0.1:{}/predict/batch'.format(port),
+                          json={'country': ['all'], 'start': '2019-11-01', 'end': '2019-11-30', 'mode': 'test'})
+        response = literal_eval(r.text.replace('null', 'None'))
+        self.assertEqual(len(response), 30)
+
+    @unittest.skipUnless(server_available,"local server is not running")
+    def test_05_logs_query(self):
+        """
+        test the logged predictions can be aggregated
+        """
+
+        query = {'country': 'all', 'year': '2019', 'month': '11', 'day': '30', 'mode': 'test'}
+        requests.post('http://127.0.0.1:{}/predict'.format(port), json=query)
+
+        r = requests.get('http://127.0.0.1:{}/logs/query'.format(port),
+                         params={'country': 'all', 'mode': 'test'})
+        response = literal_eval(r.text.replace('null', 'None'))
+        self.assertTrue(response['count'] >= 1)
+        self.assertEqual(list(response['countries'].keys()), ['all'])
+        self.assertTrue(response['runtime_ms']['p99'] >= response['runtime_ms']['p50'])
+
+    @unittest.skipUnless(server_available,"local server is not running")
+    def test_06_predict_cache(self):
+        """
+        test repeated queries are cached and can be revalidated with their ETag
+        """
+
+        query = {'country': 'all', 'year': '2019', 'month': '11', 'day': '29', 'mode': 'test'}
+        first = requests.post('http://127.0.0.1:{}/predict'.format(port), json=query)
+        second = requests.post('http://127.0.0.1:{}/predict'.format(port), json=query)
+        self.assertTrue(first.headers.get('ETag'))
+        self.assertEqual(first.headers['ETag'], second.headers['ETag'])
+        self.assertEqual(first.json(), second.json())
+
+        r = requests.post('http://127.0.0.1:{}/predict'.format(port), json=query,
+                          headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(r.status_code, 304)
+
+        stats = requests.get('http://127.0.0.1:{}/predict/cache'.format(port)).json()
+        self.assertTrue(stats['hits'] >= 1 and stats['not_modified'] >= 1)
+
+    @unittest.skipUnless(server_available, "local server is not running")
+    def test_08_metrics(self):
+        """
+        test the latency histograms are served in the Prometheus text format
+        """
+
+        query = {'country': 'all', 'year': '2019', 'month': '11', 'day': '29', 'mode': 'test'}
+        requests.post('http://127.0.0.1:{}/predict'.format(port), json=query)
+
+        r = requests.get('http://127.0.0.1:{}/metrics'.format(port))
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.headers['Content-Type'].startswith('text/plain'))
+        self.assertTrue('# TYPE aavail_request_seconds histogram' in r.text)
+        self.assertTrue(re.search(r'aavail_request_seconds_count\{endpoint="/predict"\} [1-9]', r.text))
+        self.assertTrue('aavail_stage_seconds_bucket{stage="predict",le="+Inf"}' in r.text)
+
+    @unittest.skipUnless(server_available, "local server is not running")
+    def test_10_train_time_budget(self):
+        """
+        test an invalid time_budget is rejected before a job starts
+        """
+
+        for time_budget in ['soon', 0, -5, None]:
+            r = requests.post('http://127.0.0.1:{}/train'.format(port),
+                              json={'mode': 'test', 'search': 'random', 'time_budget': time_budget})
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.json(), False)
+
 
 # Run the tests
 if __name__ == '__main__':
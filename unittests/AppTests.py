@@ -0,0 +1,69 @@
+"""
+app tests
+
+these tests call the Flask app in-process through its test client, no local server is needed
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(1, os.path.join('..', os.getcwd()))
+
+
+class AppTest(unittest.TestCase):
+    """
+    test the endpoints without a running server
+    """
+
+    def test_01_predict_errors(self):
+        """
+        test a bad query gets the same error with and without micro-batching
+        """
+
+        import app
+
+        client = app.app.test_client()
+        queries = [{'country': 'all', 'year': '2030', 'month': '1', 'day': '1'},
+                   {'country': 'all', 'year': '2019', 'month': '13', 'day': '1'}]
+        window = app.batch_window
+        try:
+            results = []
+            for batch_window in [0.002, 0]:
+                app.batch_window = batch_window
+                results.append([client.post('/predict', json=query) for query in queries])
+        finally:
+            app.batch_window = window
+
+        for batched, direct in zip(*results):
+            self.assertEqual((batched.status_code, direct.status_code), (200, 200))
+            self.assertTrue('ErrorMessage' in batched.get_json())
+            self.assertEqual(batched.get_json(), direct.get_json())
+
+    def test_02_predict_revalidate(self):
+        """
+        test only a cached answer is revalidated with 304
+        """
+
+        import app
+
+        client = app.app.test_client()
+        query = {'country': 'all', 'year': '2019', 'month': '11', 'day': '29', 'mode': 'test'}
+        first = client.post('/predict', json=query)
+        self.assertTrue('y_pred' in first.get_json())
+        r = client.post('/predict', json=query, headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(r.status_code, 304)
+
+        # the tag a client could compute for a query that was never answered
+        for query in [{'country': 'atlantis', 'year': '2019', 'month': '11', 'day': '29', 'mode': 'test'},
+                      {'country': 'all', 'year': '2030', 'month': '1', 'day': '1', 'mode': 'test'}]:
+            etag = app.response_cache.etag(app._cache_key(query, True), app.registry.version)
+            r = client.post('/predict', json=query, headers={'If-None-Match': etag})
+            self.assertEqual(r.status_code, 200)
+            self.assertTrue('ErrorMessage' in r.get_json())
+            self.assertTrue(r.headers.get('ETag') is None)
+
+
+# Run the tests
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+"""
+response cache tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(1, os.path.join('..', os.getcwd()))
+
+from cache import ResponseCache
+
+
+class CacheTest(unittest.TestCase):
+    """
+    test the /predict response cache
+    """
+
+    def test_01_response_cache(self):
+        """
+        test the cache keeps the most recent entries of the current version
+        """
+
+        cache = ResponseCache(max_size=2)
+        for day in ['01', '02', '03']:
+            cache.put(('all', day, False), 'v1', {'y_pred': [day]})
+        self.assertTrue(cache.get(('all', '01', False), 'v1') is None)
+        self.assertEqual(cache.get(('all', '03', False), 'v1'), {'y_pred': ['03']})
+
+        # a new version of the models evicts every entry
+        self.assertTrue(cache.get(('all', '03', False), 'v2') is None)
+        self.assertNotEqual(cache.etag(('all', '03', False), 'v1'), cache.etag(('all', '03', False), 'v2'))
+        self.assertEqual(cache.stats()['evictions'], 3)
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (1, 2))
+
+
+# Run the tests
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,363 @@
+"""
+data ingestion tests
+"""
+
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(1, os.path.join('..', os.getcwd()))
+
+# import data specific functions and variables
+from data_ingestion import DataIngestion, DataProcessing
+
+
+def legacy_convert_to_ts(df_orig, country=None):
+    """
+    reference copy of the original day-by-day convert_to_ts
+    """
+
+    if country:
+        mask = df_orig['country'] == country
+        df = df_orig[mask]
+    else:
+        df = df_orig
+
+    start_month = '{}-{}'.format(df['year'].values[0], str(df['month'].values[0]).zfill(2))
+    stop_month = '{}-{}'.format(df['year'].values[-1], str(df['month'].values[-1]).zfill(2))
+    df_dates = df['invoice_date'].values.astype('datetime64[D]')
+    days = np.arange(start_month, stop_month, dtype='datetime64[D]')
+
+    purchases = np.array([np.where(df_dates == day)[0].size for day in days])
+    invoices = [np.unique(df[df_dates == day]['invoice'].values).size for day in days]
+    streams = [np.unique(df[df_dates == day]['stream_id'].values).size for day in days]
+    views = [df[df_dates == day]['times_viewed'].values.sum() for day in days]
+    revenue = [df[df_dates == day]['price'].values.sum() for day in days]
+    year_month = ["-".join(re.split("-", str(day))[:2]) for day in days]
+
+    return pd.DataFrame({'date': days,
+                         'purchases': purchases,
+                         'unique_invoices': invoices,
+                         'unique_streams': streams,
+                         'total_views': views,
+                         'year_month': year_month,
+                         'revenue': revenue})
+
+
+def legacy_engineer_features(df, previous=(7, 14, 28, 70)):
+    """
+    reference copy of the original date-by-date engineer_features
+    """
+
+    dates = df['date'].values.copy()
+    dates = dates.astype('datetime64[D]')
+
+    eng_features = defaultdict(list)
+    y = np.zeros(dates.size)
+    for d, day in enumerate(dates):
+
+        for num in previous:
+            current = np.datetime64(day, 'D')
+            prev = current - np.timedelta64(num, 'D')
+            mask = np.in1d(dates, np.arange(prev, current, dtype='datetime64[D]'))
+            eng_features["previous_{}".format(num)].append(df[mask]['revenue'].sum())
+
+        plus_30 = current + np.timedelta64(30, 'D')
+        mask = np.in1d(dates, np.arange(current, plus_30, dtype='datetime64[D]'))
+        y[d] = df[mask]['revenue'].sum()
+
+        start_date = current - np.timedelta64(365, 'D')
+        stop_date = plus_30 - np.timedelta64(365, 'D')
+        mask = np.in1d(dates, np.arange(start_date, stop_date, dtype='datetime64[D]'))
+        eng_features['previous_year'].append(df[mask]['revenue'].sum())
+
+        minus_30 = current - np.timedelta64(30, 'D')
+        mask = np.in1d(dates, np.arange(minus_30, current, dtype='datetime64[D]'))
+        eng_features['recent_invoices'].append(df[mask]['unique_invoices'].mean())
+        eng_features['recent_views'].append(df[mask]['total_views'].mean())
+
+    X = pd.DataFrame(eng_features)
+    X.fillna(0, inplace=True)
+    mask = X.sum(axis=1) > 0
+    X = X[mask]
+    y = y[mask]
+    dates = dates[mask]
+    X.reset_index(drop=True, inplace=True)
+
+    return X, y, dates
+
+
+def several_months(df, n_months=4):
+    """
+    repeat the shipped month of invoices over the following months
+    """
+
+    frames = []
+    for k in range(n_months):
+        shifted = df.copy()
+        month = shifted['month'] - 1 + k
+        shifted['year'] = shifted['year'] + month // 12
+        shifted['month'] = month % 12 + 1
+        shifted['day'] = shifted['day'].clip(upper=28)
+        shifted['invoice_date'] = pd.to_datetime(shifted[['year', 'month', 'day']])
+        frames.append(shifted)
+
+    df = pd.concat(frames)
+    df.sort_values(by='invoice_date', inplace=True)
+    df.reset_index(drop=True, inplace=True)
+    return df
+
+
+class IngestionTest(unittest.TestCase):
+    """
+    test the essential functionality
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        di = DataIngestion()
+        cls.df = several_months(di.get_data(os.path.join("data", "cs-train")))
+
+    def test_01_convert_to_ts(self):
+        """
+        ensure the vectorized time-series match the day-by-day version
+        """
+
+        di = DataIngestion()
+        pd.testing.assert_frame_equal(di.convert_to_ts(self.df), legacy_convert_to_ts(self.df))
+
+        for country in np.unique(self.df['country'].values):
+            pd.testing.assert_frame_equal(di.convert_to_ts(self.df, country=country),
+                                          legacy_convert_to_ts(self.df, country=country))
+
+    def test_02_convert_to_ts_all(self):
+        """
+        ensure every country is aggregated in the same call
+        """
+
+        di = DataIngestion()
+        countries = ['United Kingdom', 'France']
+        ts = di.convert_to_ts_all(self.df, countries=countries)
+
+        self.assertEqual(sorted(ts.keys()), sorted(['all'] + countries))
+        self.assertEqual(ts['all']['purchases'].sum(),
+                         sum(legacy_convert_to_ts(self.df)['purchases']))
+        self.assertRaises(Exception, di.convert_to_ts_all, self.df, countries=['Atlantis'])
+
+    def assertSameFeatures(self, expected, result):
+        X, y, dates = result
+        self.assertEqual(list(X.columns), list(expected[0].columns))
+        self.assertTrue(np.allclose(X.values, expected[0].values, rtol=1e-9, atol=1e-6))
+        self.assertTrue(np.allclose(y, expected[1], rtol=1e-9, atol=1e-6))
+        self.assertTrue(np.array_equal(dates, expected[2]))
+
+    def test_03_engineer_features(self):
+        """
+        ensure the rolling windows match the date-by-date features
+        """
+
+        ts_data_dir = os.path.join("data", "cs-production", "ts-data")
+        for file_name in sorted(os.listdir(ts_data_dir)):
+            if not file_name.endswith(".csv"):
+                continue
+            df = pd.read_csv(os.path.join(ts_data_dir, file_name))
+            self.assertSameFeatures(legacy_engineer_features(df),
+                                    DataProcessing.engineer_features(df))
+
+    def test_04_engineer_features_windows(self):
+        """
+        ensure extra windows can be requested
+        """
+
+        previous = [7, 14, 21, 28, 35, 42, 49, 56, 63, 70]
+        df = pd.read_csv(os.path.join("data", "cs-train", "ts-data", "ts-united_kingdom.csv"))
+        self.assertSameFeatures(legacy_engineer_features(df, previous=previous),
+                                DataProcessing.engineer_features(df, previous=previous))
+
+    def test_05_fetch_ts_cache(self):
+        """
+        ensure the binary cache reproduces the csv files and follows the json files
+        """
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            data_dir = os.path.join(tmp_dir, "cs-production")
+            shutil.copytree(os.path.join("data", "cs-production"), data_dir)
+            ts_data_dir = os.path.join(data_dir, "ts-data")
+
+            di = DataIngestion()
+            converted = di.fetch_ts(data_dir)
+            self.assertTrue(os.path.exists(os.path.join(ts_data_dir, "ts-cache.npy")))
+
+            cached = di.fetch_ts(data_dir)
+            self.assertEqual(sorted(cached.keys()), sorted(converted.keys()))
+            csv = pd.read_csv(os.path.join(ts_data_dir, "ts-all.csv"))
+            self.assertTrue(np.array_equal(cached['all']['revenue'].values, csv['revenue'].values))
+            self.assertTrue(np.array_equal(cached['all']['date'].values.astype('datetime64[D]'),
+                                           csv['date'].values.astype('datetime64[D]')))
+
+            # a changed json file invalidates the cache
+            json_file = os.path.join(data_dir, "invoices-2019-12.json")
+            os.utime(json_file, (0, 0))
+            di.fetch_ts(data_dir)
+            manifest = di._read_manifest(ts_data_dir)
+            self.assertEqual(manifest['sources']["invoices-2019-12.json"][1], 0)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_06_fetch_ts_incremental(self):
+        """
+        ensure merging one new file at a time matches parsing every file
+        """
+
+        with open(os.path.join("data", "cs-train", "invoices-2017-11.json")) as f:
+            invoices = json.load(f)
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            step_dir = os.path.join(tmp_dir, "step")
+            full_dir = os.path.join(tmp_dir, "full")
+            os.mkdir(step_dir)
+            os.mkdir(full_dir)
+
+            di = DataIngestion()
+            for k in range(3):
+                month = [dict(row, year=str(2017 + (10 + k) // 12), month=str((10 + k) % 12 + 1),
+                              day=str(min(int(row['day']), 28))) for row in invoices]
+                file_name = "invoices-{}-{}.json".format(month[0]['year'], month[0]['month'].zfill(2))
+                for data_dir in [step_dir, full_dir]:
+                    with open(os.path.join(data_dir, file_name), 'w') as f:
+                        json.dump(month, f)
+                step = di.fetch_ts(step_dir)
+
+            full = di.fetch_ts(full_dir, incremental=False)
+            self.assertEqual(list(step.keys()), list(full.keys()))
+            for key in full:
+                self.assertTrue(np.array_equal(step[key]['unique_invoices'].values,
+                                               full[key]['unique_invoices'].values))
+                self.assertTrue(np.allclose(step[key]['revenue'].values, full[key]['revenue'].values))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_07_get_data_parallel(self):
+        """
+        ensure the parallel loader matches the serial one across schema variants
+        """
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            shutil.copy(os.path.join("data", "cs-train", "invoices-2017-11.json"), tmp_dir)
+            shutil.copy(os.path.join("data", "cs-production", "invoices-2019-12.json"), tmp_dir)
+
+            di = DataIngestion()
+            serial = di.get_data(tmp_dir, n_jobs=1)
+            parallel = di.get_data(tmp_dir, n_jobs=2)
+            pd.testing.assert_frame_equal(serial, parallel)
+
+            self.assertEqual(serial.columns.tolist()[-1], 'invoice_date')
+            self.assertTrue((np.diff(serial['invoice_date'].values) >= np.timedelta64(0)).all())
+            self.assertFalse(serial['invoice'].str.contains(r"\D").any())
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_08_get_data_compact(self):
+        """
+        ensure the compact representation gives the same time-series
+        """
+
+        data_dir = os.path.join("data", "cs-train")
+        di = DataIngestion()
+        compact = di.get_data(data_dir, compact=True)
+
+        self.assertNotIn('year', compact.columns)
+        self.assertEqual(compact['country'].dtype.name, 'category')
+        self.assertTrue(np.issubdtype(compact['invoice'].dtype, np.integer))
+        self.assertLess(compact.memory_usage(deep=True).sum(),
+                        di.get_data(data_dir).memory_usage(deep=True).sum())
+
+        compact = several_months(compact.assign(year=compact['invoice_date'].dt.year,
+                                                month=compact['invoice_date'].dt.month,
+                                                day=compact['invoice_date'].dt.day))
+        ts = di.convert_to_ts_all(compact.drop(columns=['year', 'month', 'day']),
+                                  countries=['United Kingdom'])
+        expected = di.convert_to_ts_all(self.df, countries=['United Kingdom'])
+        for key in expected:
+            pd.testing.assert_frame_equal(ts[key], expected[key])
+
+    def test_09_synthetic_invoices(self):
+        """
+        ensure the benchmark invoices are read like the real ones and are reproducible
+        """
+
+        from benchmark import generate_invoices
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            n_rows = generate_invoices(os.path.join(tmp_dir, "a"), months=3, countries=3, rows_per_day=10)
+            generate_invoices(os.path.join(tmp_dir, "b"), months=3, countries=3, rows_per_day=10)
+            self.assertEqual(sorted(os.listdir(os.path.join(tmp_dir, "a"))),
+                             ["invoices-2018-01.json", "invoices-2018-02.json", "invoices-2018-03.json"])
+
+            di = DataIngestion()
+            df = di.get_data(os.path.join(tmp_dir, "a"), n_jobs=1)
+            self.assertEqual(df.shape[0], n_rows)
+            self.assertEqual(n_rows, (31 + 28 + 31) * 3 * 10)
+            self.assertFalse(df['invoice'].str.contains(r"\D").any())
+            pd.testing.assert_frame_equal(df, di.get_data(os.path.join(tmp_dir, "b"), n_jobs=1))
+
+            ts = di.fetch_ts(os.path.join(tmp_dir, "a"))
+            self.assertEqual(sorted(ts), ['all', 'eire', 'germany', 'united_kingdom'])
+            # like convert_to_ts, the days run up to the first day of the last month
+            self.assertEqual(ts['all'].shape[0], 31 + 28)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_10_fetch_ts_seed_new_month(self):
+        """
+        ensure the json month after the csv seed is kept when a new month is added
+        """
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            # the shipped seed without any cache built from it
+            data_dir = os.path.join(tmp_dir, "cs-production")
+            os.makedirs(os.path.join(data_dir, "ts-data"))
+            shutil.copy(os.path.join("data", "cs-production", "invoices-2019-12.json"), data_dir)
+            seed_dir = os.path.join("data", "cs-production", "ts-data")
+            for f in os.listdir(seed_dir):
+                if f.endswith(".csv"):
+                    shutil.copy(os.path.join(seed_dir, f), os.path.join(data_dir, "ts-data"))
+
+            di = DataIngestion()
+            di.fetch_ts(data_dir)
+
+            with open(os.path.join(data_dir, "invoices-2019-12.json")) as f:
+                december = json.load(f)
+            with open(os.path.join(data_dir, "invoices-2020-01.json"), 'w') as f:
+                json.dump([dict(row, year="2020", month="01") for row in december], f)
+
+            ts = di.fetch_ts(data_dir)['all']
+            dates = ts['date'].values.astype('datetime64[D]')
+            self.assertEqual(dates[-1], np.datetime64("2019-12-31"))
+            in_december = dates >= np.datetime64("2019-12-01")
+            self.assertEqual(ts['purchases'].values[in_december].sum(), len(december))
+            self.assertGreater(ts['revenue'].values[in_december].sum(), 0)
+
+            # the seed is still used for the months before the json files
+            csv = pd.read_csv(os.path.join(seed_dir, "ts-all.csv"))
+            self.assertTrue(np.array_equal(ts['revenue'].values[:csv.shape[0]], csv['revenue'].values))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+# Run the tests
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,10 @@
 model tests
 """
 
+import multiprocessing
 import os
 import sys
+import time
 import unittest
 from ast import literal_eval
 
@@ -12,7 +14,8 @@ import pandas as pd
 sys.path.insert(1, os.path.join('..', os.getcwd()))
 
 # import model specific functions and variables
-from logger import update_train_log, update_predict_log
+from logger import (PREDICT_HEADER, flush_logs, format_runtime, query_predict_log, read_predict_records,
+                    update_train_log, update_predict_log, update_predict_log_batch)
 
 
 class LoggerTest(unittest.TestCase):
@@ -38,6 +41,7 @@ class LoggerTest(unittest.TestCase):
         
         update_train_log(tag, eval_test, runtime,
                          model_version, model_version_note, test=True)
+        flush_logs()
 
         self.assertTrue(os.path.exists(log_file))
         
@@ -57,6 +61,7 @@ class LoggerTest(unittest.TestCase):
         
         update_train_log(tag, eval_test, runtime,
                          model_version, model_version_note, test=True)
+        flush_logs()
 
         df = pd.read_csv(log_file)
         logged_eval_test = [literal_eval(i) for i in df['eval_test'].copy()][-1]
@@ -81,6 +86,7 @@ class LoggerTest(unittest.TestCase):
 
         update_predict_log(country, y_pred, y_proba, target_date, runtime,
                            model_version, test=True)
+        flush_logs()
         
         self.assertTrue(os.path.exists(log_file))
 
@@ -101,11 +107,131 @@ class LoggerTest(unittest.TestCase):
 
         update_predict_log(country, y_pred, y_proba, target_date, runtime,
                            model_version, test=True)
+        flush_logs()
 
         df = pd.read_csv(log_file)
         logged_y_pred = [literal_eval(i) for i in df['y_pred'].copy()][-1]
         self.assertEqual(y_pred,logged_y_pred)
 
+    def test_05_predict_batch(self):
+        """
+        ensure that a batch of entries is written at once
+        """
+
+        log_file = os.path.join("logs","predict-test.log")
+
+        # update the log
+        entries = [('united_kingdom', [1], None, "2021-01-01"),
+                   ('united_kingdom', [2], None, "2021-01-02")]
+        runtime = "00:00:02"
+        model_version = 0.1
+
+        update_predict_log_batch(entries, runtime, model_version, test=True)
+        flush_logs()
+
+        df = pd.read_csv(log_file)
+        logged_y_pred = [literal_eval(i) for i in df['y_pred'].copy()][-2:]
+        self.assertEqual([[1], [2]], logged_y_pred)
+
+    def test_06_concurrent_writers(self):
+        """
+        ensure rows from several processes and threads are not interleaved
+        """
+
+        log_file = os.path.join("logs","predict-test.log")
+        flush_logs()
+        with open(log_file) as f:
+            n_lines = len(f.readlines())
+
+        processes = [multiprocessing.Process(target=_write_predictions, args=(k,)) for k in range(4)]
+        for process in processes:
+            process.start()
+        _write_predictions(4)
+        for process in processes:
+            process.join()
+        flush_logs()
+
+        with open(log_file) as f:
+            lines = f.readlines()[n_lines:]
+        self.assertEqual(len(lines), 5 * 200)
+        self.assertTrue(all(line.count(",") == 7 for line in lines))
+
+    def test_07_predict_header(self):
+        """
+        ensure the predict log columns line up with the header
+        """
+
+        log_file = os.path.join("logs","predict-test.log")
+        update_predict_log('france', [3], None, "2021-01-03", "00:00:00", 0.1, test=True)
+        flush_logs()
+
+        df = pd.read_csv(log_file)
+        self.assertEqual(list(df.columns), PREDICT_HEADER)
+        self.assertEqual(df['country'].values[-1], 'france')
+        self.assertEqual(df['query'].values[-1], "2021-01-03")
+
+    def test_08_query_predict_log(self):
+        """
+        ensure the binary records can be filtered and aggregated
+        """
+
+        flush_logs()
+        before = query_predict_log(country='eire', test=True)['count']
+        today = time.strftime("%Y-%m-%d", time.gmtime())
+        before_version = query_predict_log(country='eire', model_version="0_1_20210102120000", test=True,
+                                           start=today)['count']
+        n_records = sum(records.shape[0] for records in read_predict_records(test=True))
+
+        entries = [('eire', [10.0], None, "2021-01-01"),
+                   ('eire', [20.0], None, "2021-01-02"),
+                   ('france', [30.0], None, "2021-01-03")]
+        update_predict_log_batch(entries, "00:00:00", "0_1_20210101120000", test=True, elapsed=0.002)
+        update_predict_log_batch(entries[:1], "00:00:00", ["0_1_20210102120000"], test=True, elapsed=0.004)
+        flush_logs()
+
+        self.assertEqual(sum(records.shape[0] for records in read_predict_records(test=True)), n_records + 4)
+        result = query_predict_log(country='eire', test=True)
+        self.assertEqual(result['count'], before + 3)
+        self.assertEqual(list(result['countries'].keys()), ['eire'])
+
+        result = query_predict_log(country=['eire', 'france'], model_version="0_1_20210101120000", test=True,
+                                   start=today)
+        self.assertEqual(sorted(result['countries'].keys()), ['eire', 'france'])
+        self.assertAlmostEqual(result['countries']['eire']['runtime_ms']['max'], 2.0)
+        self.assertEqual(result['model_versions'], ["0_1_20210101120000"])
+
+        result = query_predict_log(country='eire', model_version="0_1_20210102120000", test=True,
+                                   start=today)
+        self.assertEqual(result['count'], before_version + 1)
+        self.assertAlmostEqual(result['countries']['eire']['runtime_ms']['max'], 4.0)
+
+        result = query_predict_log(country='eire', model_version="0_1_20210102120000", test=True,
+                                   end="2000-01-01")
+        self.assertEqual(result['count'], 0)
+
+    def test_09_runtime_milliseconds(self):
+        """
+        test the runtimes are logged to the millisecond
+        """
+
+        self.assertEqual(format_runtime(0.0123), "000:00:00.012")
+        self.assertEqual(format_runtime(3725.5), "001:02:05.500")
+
+        update_predict_log('united_kingdom', [0], None, "2021-01-01", format_runtime(0.0123),
+                           0.1, test=True)
+        flush_logs()
+
+        df = pd.read_csv(os.path.join("logs", "predict-test.log"))
+        self.assertEqual(df['runtime'].iloc[-1], "000:00:00.012")
+        records = read_predict_records(test=True)
+        self.assertAlmostEqual(float(records[-1]['runtime'][-1]), 0.012)
+
+
+def _write_predictions(k, n=200):
+    for i in range(n):
+        update_predict_log('united_kingdom', [k], None, "2021-01-01", "00:00:00", 0.1, test=True)
+    flush_logs()
+
 
 # Run the tests
 if __name__ == '__main__':
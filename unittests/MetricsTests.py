@@ -0,0 +1,45 @@
+"""
+metrics tests
+"""
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(1, os.path.join('..', os.getcwd()))
+
+from metrics import Metrics, merge, render, timed
+
+
+class MetricsTest(unittest.TestCase):
+    """
+    test the latency histograms and their Prometheus text
+    """
+
+    def test_01_render_metrics(self):
+        """
+        test the histograms of several processes add up
+        """
+
+        first, second = Metrics(buckets=(0.001, 0.1)), Metrics(buckets=(0.001, 0.1))
+        first.observe('aavail_stage_seconds', 0.0005, stage='predict')
+        first.observe('aavail_stage_seconds', 0.05, stage='predict')
+        second.observe('aavail_stage_seconds', 5.0, stage='predict')
+        second.inc('aavail_requests_total', endpoint='/predict', status=200)
+
+        text = render(merge([first.snapshot(), second.snapshot()]))
+        self.assertTrue('aavail_stage_seconds_bucket{stage="predict",le="0.001"} 1' in text)
+        self.assertTrue('aavail_stage_seconds_bucket{stage="predict",le="0.1"} 2' in text)
+        self.assertTrue('aavail_stage_seconds_bucket{stage="predict",le="+Inf"} 3' in text)
+        self.assertTrue('aavail_stage_seconds_sum{stage="predict"} 5.0505' in text)
+        self.assertTrue('aavail_requests_total{endpoint="/predict",status="200"} 1' in text)
+
+        with timed('predict') as timer:
+            time.sleep(0.01)
+        self.assertTrue(timer.elapsed >= 0.01)
+
+
+# Run the tests
+if __name__ == '__main__':
+    unittest.main()
@@ -3,12 +3,16 @@ model tests
 """
 
 import os
+import shutil
 import sys
+import tempfile
 import unittest
+from ast import literal_eval
 
 sys.path.insert(1, os.path.join('..', os.getcwd()))
 
 # import model specific functions and variables
+import model
 from model import *
 
 
@@ -25,7 +29,8 @@ class ModelTest(unittest.TestCase):
         # train the model
         data_dir = os.path.join("data", "cs-train")
         model_train(data_dir, test=True)
-        self.assertTrue(os.path.exists(os.path.join("models", "test-united_kingdom-0_1.joblib")))
+        saved_model = model._model_path('united_kingdom', test=True)
+        self.assertTrue(saved_model is not None and os.path.exists(saved_model))
 
     def test_02_load(self):
         """
@@ -62,6 +67,502 @@ class ModelTest(unittest.TestCase):
         y_pred = result['y_pred']
         self.assertTrue(y_pred >= 309858.7243333334)
 
+    def test_04_predict_batch(self):
+        """
+        test that a batch matches the single predictions
+        """
+
+        production_data_dir = os.path.join("data", "cs-production")
+        all_data, all_models = model_load(data_dir=production_data_dir)
+
+        queries = [{'country': 'all', 'year': '2019', 'month': '11', 'day': '30'},
+                   {'country': 'atlantis', 'year': '2019', 'month': '11', 'day': '30'},
+                   {'country': 'all', 'year': '2019', 'month': '11', 'day': '3O'}]
+        results = model_predict_batch(queries, all_data=all_data, all_models=all_models, test=True)
+        single = model_predict(queries[0], data=all_data['all'], model=all_models['all'], test=True)
+
+        self.assertEqual(len(results), len(queries))
+        self.assertEqual(results[0]['y_pred'][0], single['y_pred'][0])
+        self.assertTrue('ErrorMessage' in results[1])
+        self.assertTrue('ErrorMessage' in results[2])
+
+        # a date range covers every available date of each country
+        dates = all_data['all']['dates']
+        results = model_predict_batch({'country': ['all'], 'start': dates[0], 'end': dates[-1]},
+                                      all_data=all_data, all_models=all_models, test=True)
+        self.assertEqual([r['date'] for r in results], dates.tolist())
+
+    def test_05_date_index(self):
+        """
+        test the date index agrees with the dates and rejects invalid dates
+        """
+
+        production_data_dir = os.path.join("data", "cs-production")
+        all_data, all_models = model_load(data_dir=production_data_dir)
+        data = all_data['all']
+
+        for row, target_date in enumerate(data['dates']):
+            year, month, day = target_date.split("-")
+            self.assertEqual(date_index(data)[(query_date(year, month, day) - EPOCH).days], row)
+
+        query = {'country': 'all', 'year': '2019', 'month': '2', 'day': '30'}
+        self.assertRaises(Exception, model_predict, query, data=data, model=all_models['all'], test=True)
+        query = {'country': 'all', 'year': '1999', 'month': '1', 'day': '1'}
+        self.assertRaises(Exception, model_predict, query, data=data, model=all_models['all'], test=True)
+
+    def test_06_forecast_table(self):
+        """
+        test the forecast table matches live inference and follows the model
+        """
+
+        production_data_dir = os.path.join("data", "cs-production")
+        all_data, all_models = model_load(data_dir=production_data_dir, precompute=True)
+        data = all_data['all']
+        query = {'country': 'all', 'year': '2019', 'month': '11', 'day': '30'}
+
+        self.assertTrue(np.allclose(forecast_table(data, all_models['all']),
+                                    all_models['all'].predict(data['X'])))
+        result = model_predict(query, data=data, model=all_models['all'], test=True)
+        self.assertEqual(result['y_pred'][0], all_models['all'].predict(data['X'].iloc[[-1]])[0])
+
+        # a different model falls back to live inference
+        other = [key for key in all_models if key != 'all'][0]
+        self.assertTrue(forecast_table(data, all_models[other]) is None)
+        result = model_predict(query, data=data, model=all_models[other], test=True)
+        self.assertEqual(result['y_pred'][0], all_models[other].predict(data['X'].iloc[[-1]])[0])
+
+    def test_07_scheduler_workers(self):
+        """
+        test the worker count follows n_jobs and the memory cap
+        """
+
+        job_memory = 300 * 1024 ** 2
+        self.assertEqual(model._n_workers(4, None, job_memory), 4)
+        self.assertEqual(model._n_workers(4, 1024, job_memory), 3)
+        self.assertEqual(model._n_workers(4, 100, job_memory), 1)
+        self.assertTrue(model._n_workers(-1, None, job_memory) >= 1)
+
+        params = {'rf__n_estimators': 10, 'rf__max_depth': 5}
+        self.assertTrue(model._job_cost(1000, params) > model._job_cost(100, params))
+
+        # the cap only counts the candidates of the search that runs
+        def largest(search, previous={}):
+            return(max(model._job_memory(10000, 10, params)
+                       for params in model._search_candidates(search, 'all', previous)))
+
+        self.assertTrue(largest('grid') < largest('random'))
+        self.assertEqual(largest('halving'), largest('grid'))
+        self.assertEqual(largest('previous'), largest('grid'))
+        saved = {'all': {'params': dict(params, rf__criterion='mse')}}
+        self.assertEqual(largest('previous', saved), model._job_memory(10000, 10, params))
+        self.assertTrue(largest('neighbourhood', saved) < largest('grid'))
+
+    def test_08_search_strategies(self):
+        """
+        test every search strategy trains a model and logs its fits
+        """
+
+        data_dir = os.path.join("data", "cs-train")
+        log_file = os.path.join("logs", "train-test.log")
+        for search in ['halving', 'random', 'warm']:
+            model_train(data_dir, test=True, search=search, time_budget=1)
+            self.assertTrue(os.path.exists(model._model_path('united_kingdom', test=True)))
+
+            df = pd.read_csv(log_file)
+            eval_test = literal_eval(df['eval_test'].values[-1])
+            self.assertEqual(eval_test['search'], search)
+            self.assertTrue(eval_test['n_fits'] > 0)
+
+        self.assertRaises(Exception, model_train, data_dir, test=True, search='exhaustive')
+
+    def test_09_warm_retrain(self):
+        """
+        test the saved parameters are reused by the 'previous' and 'neighbourhood' searches
+        """
+
+        data_dir = os.path.join("data", "cs-train")
+        model_train(data_dir, test=True, search='random', time_budget=1)
+        saved = load_params(model._model_path('united_kingdom', test=True))
+        self.assertTrue(len(saved['cv_results']) > 0)
+
+        # refit with the previous parameters and no cross-validation
+        model_train(data_dir, test=True, search='previous')
+        self.assertEqual(load_params(model._model_path('united_kingdom', test=True))['params'], saved['params'])
+        eval_test = literal_eval(pd.read_csv(os.path.join("logs", "train-test.log"))['eval_test'].values[-1])
+        self.assertEqual(eval_test['n_fits'], 0)
+
+        # search around the previous parameters only
+        model_train(data_dir, test=True, search='neighbourhood')
+        neighbours = model._neighbourhood(saved['params'])
+        self.assertTrue(saved['params'] in neighbours)
+        self.assertTrue(load_params(model._model_path('united_kingdom', test=True))['params'] in neighbours)
+
+    def test_10_training_jobs(self):
+        """
+        test training runs as a single background job that can be cancelled
+        """
+
+        from jobs import TrainingJobs
+
+        training_jobs = TrainingJobs()
+        data_dir = os.path.join("data", "cs-train")
+        job = training_jobs.submit(data_dir=data_dir, test=True)
+        self.assertTrue(training_jobs.submit(data_dir=data_dir, test=True) is None)
+
+        training_jobs.cancel(job.id)
+        for _ in range(120):
+            if not training_jobs.running():
+                break
+            time.sleep(0.5)
+
+        status = training_jobs.get(job.id).to_dict()
+        self.assertEqual(status['status'], 'cancelled')
+        self.assertTrue(status['elapsed'] is not None)
+
+    def test_11_model_store(self):
+        """
+        test the store publishes versions through its manifest
+        """
+
+        from model_store import ModelStore
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            # a directory without a manifest serves the highest version of each file name
+            for name in ["sl-all-0_1.joblib", "sl-all-0_2.joblib", "slow-all-0_3.joblib", "sl-france-0_1.joblib"]:
+                joblib.dump({'name': name}, os.path.join(tmp_dir, name))
+            store = ModelStore(tmp_dir, prefix='sl')
+            self.assertEqual(store.current()['all'][0], '0_2')
+            self.assertEqual(sorted(store.current()), ['all', 'france'])
+
+            # saving records the version in the manifest, select swaps back
+            store.save('all', {'name': 'new'}, '0_3')
+            self.assertTrue(os.path.exists(store.manifest_path))
+            self.assertEqual(store.versions('all'), ['0_1', '0_2', '0_3'])
+            self.assertEqual(store.load('all'), {'name': 'new'})
+            store.select('all', '0_1')
+            self.assertEqual(store.load('all'), {'name': 'sl-all-0_1.joblib'})
+            self.assertRaises(Exception, store.select, 'all', '9_9')
+            self.assertEqual([f for f in os.listdir(tmp_dir) if f.startswith(".")], [])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_12_forest_mmap(self):
+        """
+        test the memory-mapped forest predicts like the saved pipeline
+        """
+
+        from forest import ForestModel
+        from model_store import ModelStore
+
+        production_data_dir = os.path.join("data", "cs-production")
+        all_data = load_data(data_dir=production_data_dir)
+        X, y = all_data['all']['X'], all_data['all']['y']
+        pipe_rf = model._pipeline({'rf__n_estimators': 10, 'rf__max_depth': 8})
+        pipe_rf.fit(X, y)
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            store = ModelStore(tmp_dir, prefix='sl')
+            store.save('all', pipe_rf, '0_1', archive=True)
+            self.assertEqual(len(os.listdir(os.path.join(tmp_dir, "archive"))), 1)
+
+            forest = store.load('all', mmap_mode='r')
+            self.assertTrue(isinstance(forest, ForestModel))
+            self.assertTrue(isinstance(forest.nodes, np.memmap))
+            self.assertTrue(np.array_equal(forest.predict(X), pipe_rf.predict(X)))
+            self.assertTrue('fit' in dir(store.load('all')))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_13_lazy_load(self):
+        """
+        test model_load only loads the countries that are used
+        """
+
+        production_data_dir = os.path.join("data", "cs-production")
+        all_data, all_models = model_load(data_dir=production_data_dir, preload=['all'])
+        self.assertEqual(all_data.loaded(), ['all'])
+        self.assertEqual(all_models.loaded(), ['all'])
+        self.assertTrue('france' in all_models and 'france' in all_data)
+        self.assertEqual(all_models.loaded(), ['all'])
+
+        query = {'country': 'france', 'year': '2019', 'month': '11', 'day': '30'}
+        model_predict(query, data=all_data['france'], model=all_models['france'], test=True)
+        self.assertEqual(all_data.loaded(), ['all', 'france'])
+        self.assertTrue(all_data['france'] is all_data['france'])
+        self.assertRaises(KeyError, lambda: all_data['atlantis'])
+
+    def test_14_compile_model(self):
+        """
+        test the compiled forest predicts like sklearn, also at the folded thresholds
+        """
+
+        production_data_dir = os.path.join("data", "cs-production")
+        all_data, all_models = model_load(data_dir=production_data_dir)
+        for country in ['all', 'united_kingdom']:
+            X = all_data[country]['X']
+            compiled = model.compile_model(all_models[country])
+            self.assertTrue(compiled.meta['folded'])
+
+            # rows that sit exactly on (and one float step around) the split thresholds
+            split = np.flatnonzero(compiled.left >= 0)[:200]
+            rows = np.repeat(X.values[:1], 3 * split.size, axis=0)
+            for k, direction in enumerate([0, np.inf, -np.inf]):
+                threshold = compiled.threshold[split]
+                if direction:
+                    threshold = np.nextafter(threshold, direction)
+                rows[k*split.size + np.arange(split.size), compiled.feature[split]] = threshold
+            X_all = pd.DataFrame(np.vstack([X.values, rows]), columns=X.columns)
+
+            y_pred = all_models[country].predict(X_all)
+            self.assertTrue(np.allclose(compiled.predict(X_all), y_pred, rtol=1e-12, atol=0))
+            self.assertTrue(np.allclose(compiled.predict(X_all.iloc[:1]), y_pred[:1], rtol=1e-12, atol=0))
+            self.assertTrue(model.compile_model(compiled) is compiled)
+
+    def test_15_shared_training_jobs(self):
+        """
+        test a job started by one server process can be followed and cancelled from another
+        """
+
+        from jobs import TrainingJobs
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            state_dir = os.path.join(tmp_dir, "jobs")
+            lock_file = os.path.join(tmp_dir, ".training.lock")
+            worker_a = TrainingJobs(state_dir=state_dir, lock_file=lock_file)
+            worker_b = TrainingJobs(state_dir=state_dir, lock_file=lock_file)
+
+            data_dir = os.path.join("data", "cs-train")
+            job = worker_a.submit(data_dir=data_dir, test=True)
+            self.assertTrue(worker_b.submit(data_dir=data_dir, test=True) is None)
+            self.assertEqual(worker_b.running_id(), job.id)
+            self.assertTrue(worker_b.get(job.id).to_dict()['status'] in ('queued', 'running'))
+
+            worker_b.cancel(job.id)
+            for _ in range(120):
+                if not worker_a.running():
+                    break
+                time.sleep(0.5)
+
+            self.assertFalse(worker_b.running())
+            self.assertEqual(worker_b.get(job.id).to_dict()['status'], 'cancelled')
+            self.assertTrue(worker_b.get("0" * 32) is None)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_16_micro_batcher(self):
+        """
+        test concurrent queries are predicted in batches with the same results
+        """
+
+        import threading
+        from batcher import MicroBatcher
+
+        production_data_dir = os.path.join("data", "cs-production")
+        all_data, all_models = model_load(data_dir=production_data_dir, preload=['all'])
+        data, model_all = all_data['all'], all_models['all']
+        queries = [{'country': 'all', 'year': '2019', 'month': '11', 'day': str(day)} for day in range(1, 21)]
+        queries.append({'country': 'all', 'year': '2030', 'month': '1', 'day': '1'})
+
+        batcher = MicroBatcher(window=0.2, max_rows=8)
+        results = [None] * len(queries)
+
+        def predict(i):
+            results[i] = batcher.predict(queries[i], data, model_all, test=True)
+
+        threads = [threading.Thread(target=predict, args=(i,)) for i in range(len(queries))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(batcher.rows, len(queries))
+        self.assertTrue(batcher.batches < len(queries))
+        for query, result in zip(queries[:-1], results[:-1]):
+            expected = model_predict(query, data=data, model=model_all, test=True)
+            self.assertTrue(np.array_equal(result['y_pred'], expected['y_pred']))
+        self.assertTrue('ErrorMessage' in results[-1])
+
+    def test_17_benchmark_compare(self):
+        """
+        test the benchmark flags the stages that got slower
+        """
+
+        from benchmark import compare
+
+        baseline = {'stages': {'get_data': {'median': 0.100, 'peak_mb': 5.0},
+                               'model_predict': {'median': 0.0020},
+                               'fetch_ts_cached': {'median': 0.0001, 'peak_mb': 0.1}}}
+        current = {'stages': {'get_data': {'median': 0.150, 'peak_mb': 5.1},
+                              'model_predict': {'median': 0.0010},
+                              'fetch_ts_cached': {'median': 0.0002, 'peak_mb': 0.1}}}
+        status = {(row['stage'], row['metric']): row['status'] for row in compare(baseline, current, threshold=0.1)}
+
+        self.assertEqual(status[('get_data', 'median')], 'regression')
+        self.assertEqual(status[('get_data', 'peak_mb')], 'ok')
+        self.assertEqual(status[('model_predict', 'median')], 'improvement')
+        # twice as slow, but by less than min_delta
+        self.assertEqual(status[('fetch_ts_cached', 'median')], 'ok')
+
+    def test_18_model_versions(self):
+        """
+        test every retrain saves a new version and the older one can be served again
+        """
+
+        from model_store import ModelStore
+
+        data_dir = os.path.join("data", "cs-train")
+        store = ModelStore(MODEL_DIR, prefix='test')
+        model_train(data_dir, test=True, search='random', time_budget=1)
+        older = store.current()['united_kingdom']
+        model_train(data_dir, test=True, search='random', time_budget=1)
+        newer = store.current()['united_kingdom']
+
+        self.assertNotEqual(older, newer)
+        self.assertEqual(store.versions('united_kingdom')[-2:], [older[0], newer[0]])
+        self.assertTrue(os.path.exists(older[1]) and os.path.exists(newer[1]))
+        self.assertTrue(load_params(older[1]) is not None)
+
+        # roll back, then forward again and prune
+        store.select('united_kingdom', older[0])
+        self.assertEqual(model._model_path('united_kingdom', test=True), older[1])
+        self.assertTrue(hasattr(store.load('united_kingdom'), 'predict'))
+        store.select('united_kingdom', newer[0])
+        store.prune('united_kingdom', keep=1)
+        self.assertEqual(store.versions('united_kingdom'), [newer[0]])
+        self.assertFalse(os.path.exists(older[1]))
+
+    def test_19_hold_during_retrain(self):
+        """
+        test a held registry loads the countries it has not served yet from the pinned versions
+        """
+
+        from jobs import TrainingJob
+        from model_store import ModelStore
+        from registry import ModelRegistry
+
+        data_dir = os.path.join("data", "cs-train")
+        store = ModelStore(MODEL_DIR, prefix='test')
+        model_train(data_dir, test=True, search='random', time_budget=1)
+        served = store.current()
+
+        # what the manifest serves as each country of the retrain is saved
+        class WatchedJob(TrainingJob):
+            def stage(self, tag, status):
+                if status == 'saved':
+                    self.served_while_saving = getattr(self, 'served_while_saving', []) + [store.current()]
+                super().stage(tag, status)
+
+        registry = ModelRegistry(data_dir=os.path.join("data", "cs-production"), prefix='test')
+        registry.load()
+        registry.get('all')
+        registry.hold()
+        job = WatchedJob({})
+        model_train(data_dir, test=True, search='random', time_budget=1, job=job)
+        self.assertEqual(job.served_while_saving, [served, served])
+
+        # the new versions of both countries were published together
+        current = store.current()
+        self.assertEqual(current['all'][0], current['united_kingdom'][0])
+        self.assertNotEqual(current['united_kingdom'], served['united_kingdom'])
+
+        # a country first requested during the retrain comes from the version served before it
+        entry = registry.get('united_kingdom')
+        self.assertEqual((entry['version'], entry['path']), served['united_kingdom'])
+        self.assertEqual(registry.get('all')['version'], served['all'][0])
+
+        registry.release()
+        self.assertEqual(registry.get('united_kingdom')['version'], current['united_kingdom'][0])
+
+    def test_20_logged_model_versions(self):
+        """
+        test the predictions are logged with the model store version that served them
+        """
+
+        from logger import flush_logs, query_predict_log
+        from model_store import ModelStore
+        from registry import ModelRegistry
+
+        data_dir = os.path.join("data", "cs-train")
+        store = ModelStore(MODEL_DIR, prefix='test')
+        model_train(data_dir, test=True, search='random', time_budget=1)
+        older = store.current()['all'][0]
+        model_train(data_dir, test=True, search='random', time_budget=1)
+        newer = store.current()['all'][0]
+
+        registry = ModelRegistry(data_dir=os.path.join("data", "cs-production"), prefix='test')
+        query = {'country': 'all', 'year': '2019', 'month': '11', 'day': '30'}
+
+        def predict(n):
+            registry.load()
+            entry = registry.get('all')
+            for k in range(n):
+                model_predict(query, data=entry['data'], model=entry['model'], test=True,
+                              version=entry['version'])
+            return entry['version']
+
+        flush_logs()
+        before = {version: query_predict_log(country='all', model_version=version, test=True)['count']
+                  for version in [older, newer]}
+        store.select('all', older)
+        self.assertEqual(predict(2), older)
+        store.select('all', newer)
+        self.assertEqual(predict(3), newer)
+        flush_logs()
+
+        self.assertEqual(query_predict_log(country='all', model_version=older, test=True)['count'],
+                         before[older] + 2)
+        self.assertEqual(query_predict_log(country='all', model_version=newer, test=True)['count'],
+                         before[newer] + 3)
+        result = query_predict_log(country='all', test=True)
+        self.assertTrue(older in result['model_versions'] and newer in result['model_versions'])
+
+    def test_21_registry_cold_cache(self):
+        """
+        test the ts cache written by the first request does not reload the registry
+        """
+
+        from registry import ModelRegistry
+
+        source = os.path.join("data", "cs-production")
+        data_dir = tempfile.mkdtemp()
+        try:
+            for f in os.listdir(source):
+                if f.endswith(".json"):
+                    shutil.copy(os.path.join(source, f), data_dir)
+            os.mkdir(os.path.join(data_dir, "ts-data"))
+            for f in os.listdir(os.path.join(source, "ts-data")):
+                if f.endswith(".csv"):
+                    shutil.copy(os.path.join(source, "ts-data", f), os.path.join(data_dir, "ts-data"))
+
+            registry = ModelRegistry(data_dir=data_dir, prefix='test')
+            registry.load()
+            version = registry.version
+            self.assertTrue(registry.get('all')['data'] is not None)
+            self.assertTrue(os.path.exists(os.path.join(data_dir, "ts-data", "ts-cache.npy")))
+            self.assertFalse(registry.changed())
+            self.assertFalse(registry.refresh(force=True))
+            self.assertEqual(registry.version, version)
+
+            # a new invoice file still reloads
+            shutil.copy(os.path.join(data_dir, "invoices-2019-12.json"),
+                        os.path.join(data_dir, "invoices-2020-01.json"))
+            self.assertTrue(registry.refresh(force=True))
+            self.assertNotEqual(registry.version, version)
+        finally:
+            shutil.rmtree(data_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        # every test training saves a new version, only keep the served ones
+        from model_store import ModelStore
+
+        store = ModelStore(MODEL_DIR, prefix='test')
+        for country in store.read_manifest()['countries']:
+            store.prune(country, keep=1)
+
 
 # Run the tests
 if __name__ == '__main__':
@@ -33,4 +33,21 @@ ModelTestSuite = unittest.TestLoader().loadTestsFromTestCase(ModelTest)
 from LoggerTests import *
 LoggerTestSuite = unittest.TestLoader().loadTestsFromTestCase(LoggerTest)
 
-MainSuite = unittest.TestSuite([LoggerTestSuite,ModelTestSuite,ApiTestSuite])
+## ingestion tests
+from IngestionTests import *
+IngestionTestSuite = unittest.TestLoader().loadTestsFromTestCase(IngestionTest)
+
+## app tests
+from AppTests import *
+AppTestSuite = unittest.TestLoader().loadTestsFromTestCase(AppTest)
+
+## cache tests
+from CacheTests import *
+CacheTestSuite = unittest.TestLoader().loadTestsFromTestCase(CacheTest)
+
+## metrics tests
+from MetricsTests import *
+MetricsTestSuite = unittest.TestLoader().loadTestsFromTestCase(MetricsTest)
+
+MainSuite = unittest.TestSuite([LoggerTestSuite,IngestionTestSuite,CacheTestSuite,MetricsTestSuite,ModelTestSuite,
+                               AppTestSuite,ApiTestSuite])
@@ -0,0 +1,42 @@
+"""
+WSGI entry point of the production server (see gunicorn.conf.py)
+
+    ~$ gunicorn -c gunicorn.conf.py wsgi:application
+
+the models and features of every country are loaded when this module is
+imported, in the gunicorn master before the workers are forked, so the
+workers share them copy-on-write
+"""
+
+import gc
+
+import metrics
+from app import app, registry, training_jobs
+
+# number of completed loads, the reload watcher of gunicorn.conf.py waits on it
+loads = 0
+
+
+def warm():
+    """
+    load every served model and feature matrix in this process
+    """
+
+    # objects frozen by the previous load can be collected again
+    gc.unfreeze()
+    registry.load()
+    registry.snapshot()
+    gc.collect()
+
+    # the gc would otherwise write to every shared object it visits and unshare its pages
+    gc.freeze()
+
+    global loads
+    loads += 1
+
+    # the model_load timings of the master, /metrics adds them to those of the workers
+    metrics.dump()
+
+
+warm()
+application = app